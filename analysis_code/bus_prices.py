@@ -0,0 +1,265 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import json
+import os
+from analysis_code import network_summary
+from analysis_code import pypsa_statistics
+from analysis_code import read_electricity_network
+
+# Bus metadata columns the bus prices are aggregated by
+GROUPS = ["reeds_zone", "trans_reg", "interconnect"]
+# Per-bus selection rules understood by bus_thresholds
+STRATEGIES = ["std", "percentile", "top_k"]
+# A region has a price spike when at least this share of its buses spike
+MIN_SHARE = 0.5
+# Number of snapshots (or buses) held in memory at a time
+CHUNK_SIZE = read_electricity_network.CHUNK_SIZE
+
+
+def price_matrix_path(RUN_NAME):
+    return f"TEMP_OUTPUTS/{RUN_NAME}/bus_prices.npy"
+
+
+def price_matrix(RUN_NAME, source=None, chunk_size=CHUNK_SIZE):
+    """
+    Memory-mapped float32 matrix of the bus prices of a run, of shape
+    (snapshots, buses). It is copied once from the network file, block by
+    block, and rebuilt only when the network file changes, judged by the
+    same size, mtime and hash fingerprint as the network summary.
+
+    :param source: path of the network file, if not DATA/{RUN_NAME}.nc
+    :return: (read-only memmap of prices, bus names of the columns)
+    """
+    source = source or f"DATA/{RUN_NAME}.nc"
+    path = price_matrix_path(RUN_NAME)
+    names_path = path[: -len(".npy")] + "_buses.npy"
+    fingerprint_path = path[: -len(".npy")] + "_source.json"
+    current = False
+    if os.path.exists(path) and os.path.exists(names_path):
+        try:
+            with open(fingerprint_path) as f:
+                fingerprint = json.load(f)
+            current, stamp = network_summary.check_fingerprint(fingerprint, source)
+            if stamp:
+                _write_fingerprint({**fingerprint, **stamp}, fingerprint_path)
+        except (OSError, ValueError):
+            # No fingerprint, e.g. from an interrupted copy: rebuild
+            current = False
+    if not current:
+        # Drop the old fingerprint first, so a partly rebuilt matrix never passes
+        if os.path.exists(fingerprint_path):
+            os.remove(fingerprint_path)
+        fingerprint = network_summary.source_fingerprint(source)
+        with xr.open_dataset(source) as ds:
+            prices = ds["buses_t_marginal_price"].transpose("snapshots", ...)
+            names = prices["buses_t_marginal_price_i"].values.astype(str)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            matrix = np.lib.format.open_memmap(
+                path + ".tmp", mode="w+", dtype=np.float32, shape=prices.shape
+            )
+            for start in range(0, prices.shape[0], chunk_size):
+                block = slice(start, start + chunk_size)
+                matrix[block] = prices[block].values
+            matrix.flush()
+            del matrix
+        # Rename only once complete, so an interrupted copy is never reused
+        np.save(names_path, names)
+        os.replace(path + ".tmp", path)
+        _write_fingerprint(fingerprint, fingerprint_path)
+    return np.load(path, mmap_mode="r"), np.load(names_path)
+
+
+def _write_fingerprint(fingerprint, path):
+    # Replace the file atomically so an interruption never corrupts it
+    with open(path + ".tmp", "w") as f:
+        json.dump(fingerprint, f)
+    os.replace(path + ".tmp", path)
+
+
+def bus_thresholds(
+    prices, strategy="std", n_std=1, percentile=95, top_k=100, chunk_size=CHUNK_SIZE
+):
+    """
+    Spike threshold of every bus, as price_events.select_hours computes it
+    for the system mean: mean + n_std * std, a percentile, or the top_k-th
+    highest price of each bus column.
+
+    :param prices: (snapshots, buses) array, e.g. the memmap of price_matrix
+    :return: float64 array of thresholds, one per bus
+    """
+    n_snapshots, n_buses = prices.shape
+    if strategy == "std":
+        # Sums over blocks of snapshots, so the matrix is read once in order
+        total = np.zeros(n_buses)
+        squares = np.zeros(n_buses)
+        counts = np.zeros(n_buses)
+        for start in range(0, n_snapshots, chunk_size):
+            block = np.asarray(prices[start : start + chunk_size], dtype=np.float64)
+            valid = ~np.isnan(block)
+            block = np.where(valid, block, 0)
+            total += block.sum(axis=0)
+            squares += (block**2).sum(axis=0)
+            counts += valid.sum(axis=0)
+        mean = total / counts
+        std = np.sqrt(np.maximum(squares / counts - mean**2, 0))
+        return mean + n_std * std
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy '{strategy}', expected one of {STRATEGIES}")
+
+    if strategy == "top_k" and top_k < 1:
+        raise ValueError(f"top_k must be at least 1, got {top_k}")
+    # A short (e.g. coarse) series may have fewer snapshots than top_k
+    top_k = min(top_k, n_snapshots)
+    # Order statistics need whole columns, so take blocks of buses instead
+    thresholds = np.empty(n_buses)
+    for start in range(0, n_buses, chunk_size):
+        block = np.asarray(prices[:, start : start + chunk_size], dtype=np.float64)
+        if strategy == "percentile":
+            thresholds[start : start + chunk_size] = np.nanpercentile(
+                block, percentile, axis=0
+            )
+        else:
+            # partition finds the k-th highest of every column without sorting
+            block = np.where(np.isnan(block), -np.inf, block)
+            thresholds[start : start + chunk_size] = np.partition(
+                block, n_snapshots - top_k, axis=0
+            )[n_snapshots - top_k]
+    return thresholds
+
+
+def bus_events(prices, thresholds, chunk_size=CHUNK_SIZE):
+    """
+    Spike mask of every bus and snapshot: price >= the bus threshold, one
+    broadcast comparison per block of snapshots.
+
+    :return: boolean array of shape (snapshots, buses)
+    """
+    mask = np.empty(prices.shape, dtype=bool)
+    for start in range(0, prices.shape[0], chunk_size):
+        block = slice(start, start + chunk_size)
+        mask[block] = prices[block] >= thresholds
+    return mask
+
+
+def bus_metadata(WEATHER_YEAR, GRANULARITY):
+    """
+    Bus table of a run (reeds_zone, trans_reg, interconnect, ...), from the
+    stored pypsa-usa statistics, or parsed from buses.csv if not yet stored.
+
+    :return: DataFrame indexed by bus name
+    """
+    try:
+        buses = pypsa_statistics.load("buses", WEATHER_YEAR, GRANULARITY)
+        return buses.droplevel(["year", "granularity"])
+    except KeyError:
+        name, header_rows, index = pypsa_statistics.TABLES["buses"]
+        for year, granularity, directory in pypsa_statistics.statistics_directories():
+            if (year, granularity) == (int(WEATHER_YEAR), GRANULARITY):
+                return pypsa_statistics.read_table(
+                    f"{directory}/{name}", header_rows, index
+                )
+    raise FileNotFoundError(f"No buses.csv found for {WEATHER_YEAR} {GRANULARITY}")
+
+
+def group_indices(buses, metadata, group):
+    """
+    Region of every bus, as precomputed indices for aggregation. Buses not in
+    the metadata are put in an 'unknown' region.
+
+    :param buses: bus names, in the order of the price matrix columns
+    :param group: metadata column, e.g. 'reeds_zone'
+    :return: (sorted region names, (buses, regions) indicator matrix)
+    """
+    regions = metadata[group].astype(str).reindex(buses).fillna("unknown")
+    names, indicator = read_electricity_network.carrier_indicator(regions.values)
+    return names, indicator.astype(np.float32)
+
+
+def region_events(prices, mask, indicator, min_share=MIN_SHARE, chunk_size=CHUNK_SIZE):
+    """
+    Aggregate bus spikes and prices to regions with one matrix product per
+    block of snapshots.
+
+    :param mask: (snapshots, buses) spike mask from bus_events
+    :param indicator: (buses, regions) matrix from group_indices
+    :return: (share of spiking buses, mean price, region spike mask), each of
+             shape (snapshots, regions)
+    """
+    sizes = indicator.sum(axis=0)
+    share = np.empty((prices.shape[0], indicator.shape[1]), dtype=np.float32)
+    mean_price = np.empty_like(share)
+    for start in range(0, prices.shape[0], chunk_size):
+        block = slice(start, start + chunk_size)
+        share[block] = (mask[block] @ indicator) / sizes
+        mean_price[block] = (np.nan_to_num(prices[block]) @ indicator) / sizes
+    return share, mean_price, share >= min_share
+
+
+def bus_spike_analysis(
+    RUN_NAME,
+    frequency,
+    WEATHER_YEAR,
+    strategy="std",
+    n_std=1,
+    percentile=95,
+    top_k=100,
+    groups=GROUPS,
+    min_share=MIN_SHARE,
+):
+    """
+    Detect price spikes at every bus of a run and in every region, and write
+    TEMP_OUTPUTS/{RUN_NAME}/bus_spikes.nc (thresholds and spike hours per bus,
+    share of spiking buses and mean price per region and snapshot) and
+    bus_spike_regions.csv (spike hours and mean spike price per region).
+
+    :param frequency: time step of the snapshots, e.g. '1H'; also the
+                      granularity of the bus metadata
+    :param strategy, n_std, percentile, top_k: per-bus selection rule, see
+                                               bus_thresholds
+    :param groups: bus metadata columns to aggregate by
+    """
+    prices, buses = price_matrix(RUN_NAME)
+    thresholds = bus_thresholds(prices, strategy, n_std, percentile, top_k)
+    mask = bus_events(prices, thresholds)
+    time = pd.DatetimeIndex(network_summary.load_summary(RUN_NAME, frequency)["time"])
+    metadata = bus_metadata(WEATHER_YEAR, frequency)
+
+    ds = xr.Dataset(
+        {
+            "threshold": ("bus", thresholds),
+            "spike_hours": ("bus", mask.sum(axis=0)),
+        },
+        coords={"time": time, "bus": buses},
+        attrs={"strategy": strategy, "min_share": min_share},
+    )
+    rows = []
+    for group in groups:
+        names, indicator = group_indices(buses, metadata, group)
+        share, mean_price, spikes = region_events(prices, mask, indicator, min_share)
+        ds[f"{group}_share"] = (("time", group), share)
+        ds[f"{group}_mean_price"] = (("time", group), mean_price)
+        ds = ds.assign_coords({group: names})
+        for r, region in enumerate(names):
+            hours = spikes[:, r]
+            rows.append(
+                {
+                    "Group": group,
+                    "Region": region,
+                    "Buses": int(indicator[:, r].sum()),
+                    "Spike Hours": int(hours.sum()),
+                    "Mean Spike Price (USD)": (
+                        float(mean_price[hours, r].mean()) if hours.any() else np.nan
+                    ),
+                    "First Spike": time[hours][0] if hours.any() else pd.NaT,
+                }
+            )
+
+    ds.to_netcdf(f"TEMP_OUTPUTS/{RUN_NAME}/bus_spikes.nc.tmp")
+    os.replace(
+        f"TEMP_OUTPUTS/{RUN_NAME}/bus_spikes.nc.tmp",
+        f"TEMP_OUTPUTS/{RUN_NAME}/bus_spikes.nc",
+    )
+    pd.DataFrame(rows).to_csv(
+        f"TEMP_OUTPUTS/{RUN_NAME}/bus_spike_regions.csv", index=False
+    )
@@ -0,0 +1,202 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import hashlib
+import os
+from analysis_code import era5_composite
+from analysis_code import network_summary
+
+# Saved bus -> ERA5 cell indices, one file per (grid, bus coordinates, method)
+INDEX_ROOT = "TEMP_OUTPUTS/bus_index"
+# Interpolation of the ERA5 fields at the bus locations
+METHODS = ["bilinear", "nearest"]
+
+
+def bus_coordinates(file_path):
+    """
+    Read the bus coordinates from a pypsa-usa network file, in the order of
+    the columns of buses_t_marginal_price.
+
+    :return: (bus names, longitudes x, latitudes y)
+    """
+    with xr.open_dataset(file_path) as ds:
+        names = ds["buses_t_marginal_price_i"].values.astype(str)
+        x = pd.Series(ds["buses_x"].values, index=ds["buses_i"].values.astype(str))
+        y = pd.Series(ds["buses_y"].values, index=ds["buses_i"].values.astype(str))
+    return names, x.reindex(names).values, y.reindex(names).values
+
+
+def _fractional_index(grid, points):
+    # Position of each point on a regular 1D grid (ascending or descending) in
+    # units of cells, clipped to the grid so buses just outside use the edge
+    position = (points - grid[0]) / (grid[1] - grid[0])
+    return np.clip(position, 0, len(grid) - 1)
+
+
+def build_index(lat, lon, x, y, method="bilinear"):
+    """
+    Map every bus to the ERA5 cells that surround it on the regular grid.
+
+    :param lat, lon: 1D ERA5 latitude and longitude coordinates
+    :param x, y: 1D bus longitudes and latitudes
+    :param method: 'bilinear' (four cells with bilinear weights) or
+                   'nearest' (the closest cell)
+    :return: (cells, weights), arrays of shape (buses, 4) or (buses, 1) with
+             flat cell indices into a (latitude x longitude) field and weights
+             summing to one per bus
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    i = _fractional_index(lat, np.asarray(y, dtype=float))
+    j = _fractional_index(lon, np.asarray(x, dtype=float))
+
+    if method == "nearest":
+        cells = np.rint(i).astype(int) * len(lon) + np.rint(j).astype(int)
+        return cells[:, None], np.ones((len(cells), 1))
+    if method != "bilinear":
+        raise ValueError(f"Unknown method '{method}', expected one of {METHODS}")
+
+    # Lower corner of the enclosing cell, kept one cell from the last row and column
+    i0 = np.minimum(np.floor(i).astype(int), len(lat) - 2)
+    j0 = np.minimum(np.floor(j).astype(int), len(lon) - 2)
+    di = i - i0
+    dj = j - j0
+    cells = np.stack(
+        [
+            i0 * len(lon) + j0,
+            i0 * len(lon) + j0 + 1,
+            (i0 + 1) * len(lon) + j0,
+            (i0 + 1) * len(lon) + j0 + 1,
+        ],
+        axis=1,
+    )
+    weights = np.stack(
+        [(1 - di) * (1 - dj), (1 - di) * dj, di * (1 - dj), di * dj], axis=1
+    )
+    return cells, weights
+
+
+def load_index(lat, lon, x, y, method="bilinear"):
+    """
+    As build_index, but the index is saved under INDEX_ROOT and reused for
+    the same grid, bus coordinates and method.
+    """
+    digest = hashlib.sha1()
+    for array in [lat, lon, x, y]:
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    digest.update(method.encode())
+    path = f"{INDEX_ROOT}/{digest.hexdigest()[:16]}.npz"
+
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            return saved["cells"], saved["weights"]
+
+    cells, weights = build_index(lat, lon, x, y, method)
+    os.makedirs(INDEX_ROOT, exist_ok=True)
+    # Write to a temporary file first so a crash never leaves a truncated index
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, cells=cells, weights=weights)
+    os.replace(path + ".tmp", path)
+    return cells, weights
+
+
+def gather(field, cells, weights):
+    """
+    Values of a gridded field at every bus, for all time steps in one indexed read.
+
+    :param field: array of shape (time, latitude, longitude)
+    :param cells, weights: bus index from build_index or load_index
+    :return: array of shape (time, buses)
+    """
+    flat = field.reshape(field.shape[0], -1)
+    return np.einsum("tbk,bk->tb", flat[:, cells], weights)
+
+
+def bus_weather(FOLDER, suffix, file_path, method="bilinear", variables=None):
+    """
+    Per-bus time series of the derived ERA5 fields (temperature, pressure,
+    wind speed, irradiance) of a run, read block by block along time.
+
+    :param FOLDER: run name, e.g. 'fully_renewable-WY2019_1H'
+    :param suffix: ERA5 data folder of the run, e.g. 'era5_data_high-prices'
+    :param file_path: network file with the bus coordinates
+    :return: xarray Dataset with one (valid_time, bus) variable per field
+    """
+    streams = era5_composite.open_streams(
+        FOLDER,
+        "data_stream-oper_stepType-instant.nc",
+        "data_stream-oper_stepType-accum.nc",
+        suffix,
+    )
+    variables = list(era5_composite.DERIVED_FIELDS) if variables is None else variables
+    names, x, y = bus_coordinates(file_path)
+    cells, weights = load_index(
+        streams[0]["latitude"].values, streams[0]["longitude"].values, x, y, method
+    )
+
+    times = []
+    series = {v: [] for v in variables}
+    for block_times, fields in era5_composite.iterate_blocks(streams, variables):
+        times.append(block_times)
+        for variable, field in fields.items():
+            series[variable].append(gather(field, cells, weights))
+    for ds in streams:
+        ds.close()
+
+    return xr.Dataset(
+        {
+            variable: (("valid_time", "bus"), np.concatenate(blocks))
+            for variable, blocks in series.items()
+        },
+        coords={"valid_time": np.concatenate(times), "bus": names},
+    )
+
+
+def price_weather_correlation(prices, time, weather, YEAR):
+    """
+    Pearson correlation between the price and each weather field at every bus,
+    computed for all buses at once.
+
+    :param prices: (snapshots x buses) array or lazy DataArray of bus prices,
+                   with buses in the order of weather['bus']
+    :param time: timestamps of the snapshots
+    :param weather: Dataset from bus_weather
+    :param YEAR: weather year the network snapshots are mapped onto
+    :return: DataFrame of correlations, indexed by bus with one column per field
+    """
+    # Snapshot of the network covering each ERA5 time, with the network year
+    # replaced by the weather year as for the ERA5 requests
+    time = pd.DatetimeIndex([t.replace(year=YEAR) for t in pd.DatetimeIndex(time)])
+    snapshot = time.get_indexer(pd.DatetimeIndex(weather["valid_time"].values), "ffill")
+    keep = snapshot >= 0
+    price = np.asarray(prices[np.unique(snapshot[keep])], dtype=float)
+    price = price[np.searchsorted(np.unique(snapshot[keep]), snapshot[keep])]
+
+    def standardize(values):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0)
+
+    price = standardize(price)
+    correlation = {
+        variable: np.nanmean(
+            price * standardize(weather[variable].values[keep]), axis=0
+        )
+        for variable in weather.data_vars
+    }
+    return pd.DataFrame(correlation, index=pd.Index(weather["bus"].values, name="Bus"))
+
+
+def bus_weather_analysis(RUN_NAME, frequency, suffix, YEAR, method="bilinear"):
+    """
+    Write the per-bus weather series of a run to
+    TEMP_OUTPUTS/{RUN_NAME}/bus_weather.nc and the correlation of each bus
+    price with its local weather to bus_price_weather_correlation.csv.
+    """
+    FILE = f"DATA/{RUN_NAME}.nc"
+    weather = bus_weather(RUN_NAME, suffix, FILE, method)
+    weather.to_netcdf(f"TEMP_OUTPUTS/{RUN_NAME}/bus_weather.nc")
+
+    data = network_summary.load_summary(RUN_NAME, frequency, FILE)
+    with data["prices"]() as prices:
+        correlation = price_weather_correlation(prices, data["time"], weather, YEAR)
+    correlation.to_csv(f"TEMP_OUTPUTS/{RUN_NAME}/bus_price_weather_correlation.csv")
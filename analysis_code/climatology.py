@@ -0,0 +1,236 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+from analysis_code import era5_cache
+from analysis_code import era5_composite
+
+# Root of the climatology accumulators, one file per area and weather year:
+# {CLIMATOLOGY_ROOT}/{area_key}/{YEAR}.nc
+CLIMATOLOGY_ROOT = "TEMP_OUTPUTS/era5_climatology"
+# Area in North, West, South, East (the ERA5 download area)
+AREA = [49.5, -125, 24, -66.5]
+HOURS = np.arange(24)
+
+
+def climatology_path(YEAR, area=AREA):
+    return f"{CLIMATOLOGY_ROOT}/{era5_cache.area_key(area)}/{YEAR}.nc"
+
+
+def cached_dates(YEAR, area=AREA):
+    # Dates of YEAR for which every ERA5 variable is held in the cache
+    dates = None
+    for variable in era5_cache.ERA5_VARIABLES:
+        folder = os.path.dirname(era5_cache.cache_path("", variable, area))
+        held = set()
+        if os.path.isdir(folder):
+            held = {
+                name[: -len(".nc")]
+                for name in os.listdir(folder)
+                if name.startswith(f"{YEAR}-") and name.endswith(".nc")
+            }
+        dates = held if dates is None else dates & held
+    return sorted(dates)
+
+
+def open_day(date, area=AREA):
+    # One Dataset with all cached variables of a day, on the times held for all of them
+    days = []
+    for variable in era5_cache.ERA5_VARIABLES:
+        with xr.open_dataset(era5_cache.cache_path(date, variable, area)) as day:
+            days.append(day.load())
+    return xr.merge(days, join="inner", compat="override")
+
+
+def load_accumulator(YEAR, area=AREA):
+    """
+    Read the accumulator of a weather year.
+
+    :return: dict with numpy arrays 'count', 'mean' and 'm2' (field x hour x
+             latitude x longitude), 'latitude', 'longitude', 'fields' and the
+             set of 'ingested' valid times; None if there is no accumulator yet
+    """
+    path = climatology_path(YEAR, area)
+    if not os.path.exists(path):
+        return None
+    with xr.open_dataset(path) as ds:
+        ds = ds.load()
+    return {
+        "count": ds["count"].values.astype(np.int64),
+        "mean": ds["mean"].values,
+        "m2": ds["m2"].values,
+        "latitude": ds["latitude"].values,
+        "longitude": ds["longitude"].values,
+        "fields": list(ds["field"].values.astype(str)),
+        "ingested": set(ds["ingested"].values),
+    }
+
+
+def save_accumulator(acc, YEAR, area=AREA):
+    dims = ("field", "hour", "latitude", "longitude")
+    ds = xr.Dataset(
+        {
+            "count": (dims, acc["count"].astype(np.int32)),
+            "mean": (dims, acc["mean"]),
+            "m2": (dims, acc["m2"]),
+            "ingested": ("ingested", np.sort(np.array(list(acc["ingested"])))),
+        },
+        coords={
+            "field": acc["fields"],
+            "hour": HOURS,
+            "latitude": acc["latitude"],
+            "longitude": acc["longitude"],
+        },
+    )
+    # Write to a temporary file first so a crash never leaves a truncated accumulator
+    era5_cache._write_atomic(ds, climatology_path(YEAR, area))
+
+
+def _accumulate(count, mean, m2, block):
+    """
+    Merge a block of samples into running counts, means and sums of squared
+    deviations (Welford's update in the pairwise form of Chan et al.), in place.
+
+    :param count, mean, m2: latitude x longitude arrays of one field and hour
+    :param block: time x latitude x longitude samples; NaNs are ignored
+    """
+    n_block = np.isfinite(block).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_block = np.nansum(block, axis=0, dtype=np.float64) / n_block
+        m2_block = np.nansum((block - mean_block) ** 2, axis=0, dtype=np.float64)
+        total = count + n_block
+        delta = mean_block - mean
+        has_data = n_block > 0
+        mean[:] = np.where(has_data, mean + delta * n_block / total, mean)
+        m2[:] = np.where(
+            has_data, m2 + m2_block + delta**2 * count * n_block / total, m2
+        )
+    count[:] = total
+
+
+def update(YEAR, area=AREA, chunk_size=era5_composite.CHUNK_SIZE):
+    """
+    Add every cached ERA5 hour of YEAR that is not yet part of the climatology
+    to the accumulator. Hours already ingested are skipped, so calling this
+    after each download only reads the new days.
+
+    :param YEAR: weather year
+    :param area: [North, West, South, East] bounding box of the cache
+    :return: the updated accumulator (see load_accumulator)
+    """
+    acc = load_accumulator(YEAR, area)
+    dates = cached_dates(YEAR, area)
+    if acc is None and not dates:
+        raise FileNotFoundError(f"No cached ERA5 days for {YEAR} in {area}")
+
+    fields = list(era5_composite.DERIVED_FIELDS)
+    added = 0
+    for date in dates:
+        day = open_day(date, area)
+        if acc is None:
+            shape = (
+                len(fields),
+                len(HOURS),
+                day["latitude"].size,
+                day["longitude"].size,
+            )
+            acc = {
+                "count": np.zeros(shape, dtype=np.int64),
+                "mean": np.zeros(shape),
+                "m2": np.zeros(shape),
+                "latitude": day["latitude"].values,
+                "longitude": day["longitude"].values,
+                "fields": fields,
+                "ingested": set(),
+            }
+        new = [t for t in day["valid_time"].values if t not in acc["ingested"]]
+        if not new:
+            continue
+
+        for times, blocks in era5_composite.iterate_blocks(
+            [day], acc["fields"], new, chunk_size
+        ):
+            hours = pd.DatetimeIndex(times).hour
+            for f, field in enumerate(acc["fields"]):
+                for hour in np.unique(hours):
+                    _accumulate(
+                        acc["count"][f, hour],
+                        acc["mean"][f, hour],
+                        acc["m2"][f, hour],
+                        blocks[field][hours == hour],
+                    )
+        acc["ingested"].update(new)
+        added += len(new)
+
+    if added:
+        save_accumulator(acc, YEAR, area)
+    print(f"Added {added} hours to the {YEAR} climatology")
+    return acc
+
+
+def baseline(acc, valid_times=None):
+    """
+    Climatological mean and standard deviation of each field, in O(grid) time
+    from the per-hour accumulators.
+
+    :param acc: accumulator (see load_accumulator)
+    :param valid_times: optional timestamps, e.g. of a high-price composite.
+                        The hours of day are then weighted as in these times,
+                        so the diurnal cycle matches that of the composite;
+                        otherwise every ingested hour counts once
+    :return: (means, stds), dicts of field -> 2D DataArray (latitude x longitude)
+    """
+    count = acc["count"].astype(np.float64)
+    if valid_times is None:
+        weights = count
+    else:
+        hours = pd.DatetimeIndex(np.asarray(valid_times)).hour
+        weights = np.bincount(hours, minlength=len(HOURS)).astype(np.float64)
+        weights = np.broadcast_to(weights[:, None, None], count.shape[1:])
+    # Cells with no data, or missing an hour of the composite, are left NaN
+    # rather than biased towards the hours that are there
+    missing = ((weights > 0) & (count == 0)).any(axis=1) | (count.sum(axis=1) == 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights = weights / weights.sum(axis=-3, keepdims=True)
+        variance = np.where(count > 0, acc["m2"] / count, 0.0)
+        mean = (weights * acc["mean"]).sum(axis=1)
+        # Variance of the mixture of hours: E[x^2] - E[x]^2
+        second_moment = (weights * (variance + acc["mean"] ** 2)).sum(axis=1)
+        std = np.sqrt(np.maximum(second_moment - mean**2, 0))
+    mean[missing] = np.nan
+    std[missing] = np.nan
+
+    coords = {"latitude": acc["latitude"], "longitude": acc["longitude"]}
+    dims = ["latitude", "longitude"]
+    means = {
+        v: xr.DataArray(mean[f], coords=coords, dims=dims, name=v)
+        for f, v in enumerate(acc["fields"])
+    }
+    stds = {
+        v: xr.DataArray(std[f], coords=coords, dims=dims, name=v)
+        for f, v in enumerate(acc["fields"])
+    }
+    return means, stds
+
+
+def anomalies(composites, acc, valid_times, standardized=False):
+    """
+    Composite minus climatology for each field, optionally divided by the
+    climatological standard deviation.
+
+    :param composites: dict of field -> 2D DataArray, e.g. from
+                       era5_composite.composite_means
+    :param acc: accumulator of the same weather year and area
+    :param valid_times: timestamps of the composite
+    :return: dict of field -> 2D DataArray
+    """
+    means, stds = baseline(acc, valid_times)
+    result = {}
+    for variable, composite in composites.items():
+        anomaly = composite - means[variable].values
+        if standardized:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                anomaly = anomaly / stds[variable].values
+        result[variable] = anomaly.rename(variable)
+    return result
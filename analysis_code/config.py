@@ -0,0 +1,247 @@
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    import tomli as tomllib
+import os
+from analysis_code import run_scheduler
+
+# Run matrix, high-price selection and sweep settings; see config.toml
+CONFIG = "config.toml"
+# Stages of an analysis run, in the order they depend on each other
+STAGES = [
+    "analyse",
+    "bus_spikes",
+    "download",
+    "metrics",
+    "process",
+    "anomaly",
+    "bus_weather",
+    "significance",
+    "cube",
+]
+
+
+def load(path=CONFIG):
+    """
+    Read the settings file.
+
+    :param path: TOML file, by default config.toml in the working directory
+    :return: dict of sections 'runs', 'high_prices', 'bus_spikes',
+             'carrier_classes', 'era5', 'baseline', 'regimes', 'memo',
+             'sweep'
+    """
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def _subset(values, wanted):
+    # Keep the configured values given on the command line, all if none given
+    if not wanted:
+        return list(values)
+    unknown = [w for w in wanted if w not in values]
+    if unknown:
+        raise ValueError(f"{unknown} not in the configured values {list(values)}")
+    return [v for v in values if v in wanted]
+
+
+def runs(config, weather_years=None, granularities=None):
+    """
+    Runs of the configured matrix, optionally restricted to some weather
+    years and granularities.
+
+    :return: list of dicts with keys 'name', 'weather_year', 'granularity'
+    """
+    return [
+        {
+            "name": config["runs"]["name"].format(
+                weather_year=WEATHER_YEAR, granularity=GRANULARITY
+            ),
+            "weather_year": WEATHER_YEAR,
+            "granularity": GRANULARITY,
+        }
+        for WEATHER_YEAR in _subset(config["runs"]["weather_years"], weather_years)
+        for GRANULARITY in _subset(config["runs"]["granularities"], granularities)
+    ]
+
+
+def baseline_runs(config, weather_years=None):
+    # Climatology plots, one per configured weather year
+    return [
+        {
+            "name": config["baseline"]["name"].format(weather_year=WEATHER_YEAR),
+            "weather_year": WEATHER_YEAR,
+        }
+        for WEATHER_YEAR in _subset(config["runs"]["weather_years"], weather_years)
+    ]
+
+
+def make_folders(runs):
+    # Output folders of the runs, made only when their stages are about to run
+    # so that building the stages, e.g. for a dry run, writes nothing
+    for run in runs:
+        os.makedirs(f"TEMP_OUTPUTS/{run['name']}", exist_ok=True)
+        os.makedirs(f"Figures/{run['name']}", exist_ok=True)
+
+
+def analysis_stages(config, runs, stages=None):
+    """
+    Scheduler stages of the given runs. With a subset of stages, dependencies
+    on stages left out are dropped, so e.g. only 'process' can be rerun once
+    the downloads are done.
+
+    :param runs: list from runs()
+    :param stages: names from STAGES, by default the [sweep] stages of the config
+    :return: list of stages for run_scheduler.run
+    """
+    selected = _subset(STAGES, stages or config["sweep"]["stages"])
+    suffix = config["era5"]["suffix"]
+    all_stages = []
+    previous = {}
+    for run in runs:
+        RUN_NAME, WEATHER_YEAR, GRANULARITY = (
+            run["name"],
+            run["weather_year"],
+            run["granularity"],
+        )
+        # Later runs of a weather year start a new chain of downloads and anomalies
+        if previous.get("weather_year") != WEATHER_YEAR:
+            previous = {"weather_year": WEATHER_YEAR, "download": [], "anomaly": []}
+
+        def name(stage, RUN_NAME=RUN_NAME):
+            return f"{RUN_NAME}/{stage}"
+
+        run_stages = {
+            "analyse": run_scheduler.stage(
+                RUN_NAME,
+                "analyse",
+                "analysis_code.read_electricity_network:electricity_analysis",
+                RUN_NAME,
+                GRANULARITY,
+                memoized=True,
+                classes=config.get("carrier_classes"),
+                **config["high_prices"],
+            ),
+            # Price spikes at single buses and in regions, from the bus prices
+            "bus_spikes": run_scheduler.stage(
+                RUN_NAME,
+                "bus_spikes",
+                "analysis_code.bus_prices:bus_spike_analysis",
+                RUN_NAME,
+                GRANULARITY,
+                WEATHER_YEAR,
+                after=[name("analyse")],
+                **config["bus_spikes"],
+            ),
+            # Downloads for one weather year run one after another, so each finds
+            # the days already fetched by the previous granularity in the ERA5 cache
+            "download": run_scheduler.stage(
+                RUN_NAME,
+                "download",
+                "analysis_code.download_era5_data:get_era5",
+                RUN_NAME,
+                WEATHER_YEAR,
+                suffix,
+                after=[name("analyse")],
+                wait_for=previous["download"],
+                memoized=True,
+                mode=config["era5"]["mode"],
+            ),
+            # Wind power density, capacity-factor proxies and degree hours
+            "metrics": run_scheduler.stage(
+                RUN_NAME,
+                "metrics",
+                "analysis_code.energy_metrics:energy_metrics_analysis",
+                RUN_NAME,
+                suffix,
+                after=[name("download")],
+                memoized=True,
+            ),
+            "process": run_scheduler.stage(
+                RUN_NAME,
+                "process",
+                "analysis_code.process_era5_data:era5_processing",
+                RUN_NAME,
+                suffix,
+                after=[name("download")],
+                memoized=True,
+            ),
+            # Anomalies update the climatology of the weather year, so they also
+            # run one after another within a weather year
+            "anomaly": run_scheduler.stage(
+                RUN_NAME,
+                "anomaly",
+                "analysis_code.process_era5_data:era5_processing_anomaly",
+                RUN_NAME,
+                suffix,
+                WEATHER_YEAR,
+                after=[name("download")],
+                wait_for=previous["anomaly"],
+            ),
+            # Per-bus weather series and their correlation with the bus prices
+            "bus_weather": run_scheduler.stage(
+                RUN_NAME,
+                "bus_weather",
+                "analysis_code.bus_weather:bus_weather_analysis",
+                RUN_NAME,
+                GRANULARITY,
+                suffix,
+                WEATHER_YEAR,
+                after=[name("download")],
+            ),
+            # Composite maps with the cells that differ from same-season weather
+            # stippled
+            "significance": run_scheduler.stage(
+                RUN_NAME,
+                "significance",
+                "analysis_code.process_era5_data:era5_processing_significance",
+                RUN_NAME,
+                suffix,
+                after=[name("download")],
+            ),
+            # Add the run to the cross-run cube in TEMP_OUTPUTS/run_cube
+            "cube": run_scheduler.stage(
+                RUN_NAME,
+                "cube",
+                "analysis_code.run_cube:add_run",
+                RUN_NAME,
+                WEATHER_YEAR,
+                GRANULARITY,
+                suffix,
+                after=[name("download")],
+            ),
+        }
+        kept = [name(stage) for stage in selected]
+        for stage in selected:
+            s = run_stages[stage]
+            s["after"] = [dep for dep in s["after"] if dep in kept]
+            all_stages.append(s)
+        for stage in ["download", "anomaly"]:
+            if stage in selected:
+                previous[stage] = [name(stage)]
+    return all_stages
+
+
+def baseline_stages(config, weather_years=None):
+    # Plots the climatology of each weather year from the ERA5 hours held in the
+    # local cache, so no separate monthly-means download is needed, and computes
+    # the energy metrics of the same hours
+    stages = []
+    for run in baseline_runs(config, weather_years):
+        stages.append(
+            run_scheduler.stage(
+                run["name"],
+                "baseline",
+                "analysis_code.process_era5_data:era5_processing_baseline",
+                run["name"],
+                run["weather_year"],
+            )
+        )
+        stages.append(
+            run_scheduler.stage(
+                run["name"],
+                "metrics",
+                "analysis_code.energy_metrics:baseline_metrics",
+                run["weather_year"],
+            )
+        )
+    return stages
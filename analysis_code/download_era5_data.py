@@ -1,14 +1,32 @@
-import cdsapi
 import pandas as pd
-import zipfile
 import os
+import shutil
+from analysis_code import era5_cache
+from analysis_code import era5_retrieval
+from analysis_code import instrumentation
+from analysis_code import memo
 
+# Variables to request from ERA5
+VARIABLES = [
+    "2m_temperature",
+    "mean_sea_level_pressure",
+    "100m_u_component_of_wind",
+    "100m_v_component_of_wind",
+    "surface_solar_radiation_downwards",
+]
+# Times chosen per day (here four snapshots: 00, 06, 12, 18 UTC)
+TIMES = ["00:00", "06:00", "12:00", "18:00"]
+# Area in North, West, South, East (approximate CONUS bounding box)
+AREA = [49.5, -125, 24, -66.5]
 
-def get_dates(FOLDER, YEAR):
+
+def get_dates(FOLDER, YEAR, missing_only=False):
     # Read the CSV produced by the electricity analysis which lists high-price hours.
     # The CSV is expected at TEMP_OUTPUTS/{FOLDER}/highest_hours.csv and contains a
     # 'Time' column. We convert to datetimes, change the year to the requested YEAR,
     # then return unique date strings in 'YYYY-MM-DD' format for ERA5 requests.
+    # With missing_only=True, only the dates not yet held in the local ERA5 cache
+    # are returned.
     dates_df = pd.read_csv(
         f"TEMP_OUTPUTS/{FOLDER}/highest_hours.csv", index_col=None, header=[0]
     )
@@ -16,55 +34,131 @@ def get_dates(FOLDER, YEAR):
     # Replace the year (useful to fetch a particular year's weather on the same month/day)
     dates = dates.map(lambda d: d.replace(year=YEAR))
     dates = dates.dt.strftime("%Y-%m-%d").unique().tolist()
+    if missing_only:
+        dates = era5_cache.missing_dates(dates, VARIABLES, TIMES, AREA)
     return dates
 
 
-def download_data(dates, zip_path):
-    # Create a cdsapi.Client and request ERA5 single-level reanalysis for the given dates.
-    # The requested variables include 2m temperature, surface pressure, 100m wind components,
-    # and surface solar radiation. The output format is NetCDF which the code expects.
-    c = cdsapi.Client()
+def get_hours(FOLDER, YEAR, missing_only=False):
+    # As get_dates, but keeps the exact high-price hours: returns a dict of
+    # 'YYYY-MM-DD' -> sorted list of 'HH:MM' times on the requested YEAR.
+    # With missing_only=True, only the hours not yet held in the local ERA5
+    # cache are returned.
+    dates_df = pd.read_csv(
+        f"TEMP_OUTPUTS/{FOLDER}/highest_hours.csv", index_col=None, header=[0]
+    )
+    times = pd.to_datetime(dates_df["Time"])
+    times = times.map(lambda d: d.replace(year=YEAR))
+    hours = (
+        pd.Series(
+            times.dt.strftime("%H:%M").values, index=times.dt.strftime("%Y-%m-%d")
+        )
+        .groupby(level=0)
+        .apply(lambda day: sorted(set(day)))
+        .to_dict()
+    )
+    if missing_only:
+        hours = era5_cache.missing_hours(hours, VARIABLES, AREA)
+    return hours
+
+
+def group_requests(hours):
+    # A CDS request fetches every listed time on every listed date, so the
+    # fewest requests that fetch no extra hours is one per distinct set of
+    # hours. Returns a list of (dates, times) pairs.
+    groups = {}
+    for date, times in sorted(hours.items()):
+        groups.setdefault(tuple(times), []).append(date)
+    return [(dates, list(times)) for times, dates in groups.items()]
+
 
-    c.retrieve(
-        "reanalysis-era5-single-levels",
+def download_data(dates, directory, client=None):
+    # Request ERA5 single-level reanalysis for the given dates, split into one
+    # request per month that run concurrently. The requested variables include
+    # 2m temperature, surface pressure, 100m wind components, and surface solar
+    # radiation. The output format is NetCDF which the code expects.
+    # Returns the paths of the downloaded archives, one per chunk.
+    # 'dates' may also be a dict of date -> hours, in which case only those
+    # hours are requested, grouped into as few requests as possible.
+    if isinstance(dates, dict):
+        chunks = group_requests(dates)
+    else:
+        chunks = [(chunk, TIMES) for chunk in era5_retrieval.chunk_dates(dates)]
+    requests = [
         {
             "product_type": "reanalysis",
-            # Variables to request from ERA5
-            "variable": [
-                "2m_temperature",
-                "mean_sea_level_pressure",
-                "100m_u_component_of_wind",
-                "100m_v_component_of_wind",
-                "surface_solar_radiation_downwards",
-            ],
-            "date": dates,
-            # Times chosen per day (here four snapshots: 00, 06, 12, 18 UTC)
-            "time": ["00:00", "06:00", "12:00", "18:00"],
-            # Area in North, West, South, East (approximate CONUS bounding box)
-            "area": [49.5, -125, 24, -66.5],
+            "variable": VARIABLES,
+            "date": chunk,
+            "time": times,
+            "area": AREA,
             "format": "netcdf",  # request NetCDF file
-        },
-        zip_path,  # output filename for the retrieved archive
+        }
+        for chunk, times in chunks
+    ]
+    return era5_retrieval.retrieve(
+        "reanalysis-era5-single-levels", requests, directory, client=client
     )
 
 
-def unzip_data(zip_path, unzip_directory):
-    # Ensure the target extraction directory exists and extract all files
-    # from the downloaded ZIP archive into it.
-    os.makedirs(unzip_directory, exist_ok=True)
-
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(unzip_directory)
-
-    print(f"Extracted all files to: {unzip_directory}")
+def get_era5(FOLDER, YEAR, suffix, client=None, mode="day"):
+    # Fetch the run's ERA5 stream files with fetch_era5, memoized on the run's
+    # high-price hours: if they, the mode and the code are unchanged since an
+    # earlier run, the stored stream files are put back without looking at the
+    # cache or the CDS.
+    unzip_directory = f"TEMP_OUTPUTS/{FOLDER}/{suffix}"
+    streams = sorted({era5_cache.ERA5_VARIABLES[v][1] for v in VARIABLES})
+    memo.cached(
+        "download",
+        [f"{unzip_directory}/{stream}" for stream in streams],
+        fetch_era5,
+        FOLDER,
+        YEAR,
+        suffix,
+        client,
+        mode,
+        inputs=[f"TEMP_OUTPUTS/{FOLDER}/highest_hours.csv"],
+        params={"YEAR": YEAR, "mode": mode},
+    )
 
 
-def get_era5(FOLDER, YEAR, suffix):
+def fetch_era5(FOLDER, YEAR, suffix, client=None, mode="day"):
     # High-level helper that determines the zip output path and triggers
     # the retrieval and extraction for the specified run folder and year.
+    # Only days missing from the shared ERA5 cache are fetched; the run's files
+    # are then assembled from the cache, so runs of the same weather year reuse
+    # each other's downloads.
+    # Chunks that were downloaded before an interruption are kept in
+    # chunk_directory and not fetched again.
+    # With mode="day" the fixed TIMES are fetched for every high-price day;
+    # with mode="hour" only the high-price hours themselves are fetched, and
+    # the run's files hold only those time steps.
     unzip_directory = f"TEMP_OUTPUTS/{FOLDER}/{suffix}"
-    zip_path = unzip_directory + ".zip"
+    chunk_directory = unzip_directory + "_chunks"
 
-    dates = get_dates(FOLDER, YEAR)  # list of YYYY-MM-DD strings
-    download_data(dates, zip_path)  # fetch the ERA5 data archive
-    unzip_data(zip_path, unzip_directory)  # extract contents for downstream processing
+    if mode == "day":
+        dates = get_dates(FOLDER, YEAR)  # list of YYYY-MM-DD strings
+        times = TIMES
+        missing = get_dates(FOLDER, YEAR, missing_only=True)  # subset not yet cached
+    elif mode == "hour":
+        times = get_hours(FOLDER, YEAR)  # dict of YYYY-MM-DD -> HH:MM strings
+        dates = list(times)
+        missing = get_hours(FOLDER, YEAR, missing_only=True)  # subset not yet cached
+    else:
+        raise ValueError(f"Unknown mode '{mode}', expected 'day' or 'hour'")
+    if missing:
+        # fetch the ERA5 data archives, one per month (or per set of hours)
+        with instrumentation.measure("download"):
+            zip_paths = download_data(missing, chunk_directory, client=client)
+        for zip_path in zip_paths:
+            # Read the streams straight from the archive (or bare NetCDF file)
+            with instrumentation.measure("read archive"):
+                datasets = era5_cache.read_archive(zip_path)
+            with instrumentation.measure("store"):
+                era5_cache.store(datasets, AREA)  # add them to the shared cache
+            # The cache now holds these days, so the archive is no longer needed
+            os.remove(zip_path)
+        shutil.rmtree(chunk_directory)
+    else:
+        print(f"All {len(dates)} dates for {FOLDER} found in the ERA5 cache")
+    with instrumentation.measure("assemble"):
+        era5_cache.assemble(dates, VARIABLES, times, AREA, unzip_directory)
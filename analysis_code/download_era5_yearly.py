@@ -1,16 +1,17 @@
-import cdsapi
 import zipfile
 import os
+import shutil
+from analysis_code import era5_retrieval
 
 
-def download_data(year, zip_path):
-    # Create a cdsapi.Client and request ERA5 single-level reanalysis for the given dates.
+def download_data(year, directory, client=None):
+    # Request ERA5 monthly means of single-level reanalysis for the given year,
+    # one request per month that run concurrently.
     # The requested variables include 2m temperature, surface pressure, 100m wind components,
     # and surface solar radiation. The output format is NetCDF which the code expects.
-    c = cdsapi.Client()
-
-    c.retrieve(
-        "reanalysis-era5-single-levels-monthly-means",
+    # Returns the paths of the downloaded archives, one per month.
+    months = [f"{month:02d}" for month in range(1, 13)]
+    requests = [
         {
             "product_type": ["monthly_averaged_reanalysis_by_hour_of_day"],
             # Variables to request from ERA5
@@ -22,27 +23,20 @@ def download_data(year, zip_path):
                 "surface_solar_radiation_downwards",
             ],
             "year": [year],
-            "month": [
-                "01",
-                "02",
-                "03",
-                "04",
-                "05",
-                "06",
-                "07",
-                "08",
-                "09",
-                "10",
-                "11",
-                "12",
-            ],
+            "month": [month],
             # Times chosen per day (here four snapshots: 00, 06, 12, 18 UTC)
             "time": ["00:00", "06:00", "12:00", "18:00"],
             # Area in North, West, South, East (approximate CONUS bounding box)
             "area": [49.5, -125, 24, -66.5],
             "format": "netcdf",  # request NetCDF file
-        },
-        zip_path,  # output filename for the retrieved archive
+        }
+        for month in months
+    ]
+    return era5_retrieval.retrieve(
+        "reanalysis-era5-single-levels-monthly-means",
+        requests,
+        directory,
+        client=client,
     )
 
 
@@ -57,11 +51,20 @@ def unzip_data(zip_path, unzip_directory):
     print(f"Extracted all files to: {unzip_directory}")
 
 
-def get_era5(FOLDER, YEAR, suffix):
-    # High-level helper that determines the zip output path and triggers
+def get_era5(FOLDER, YEAR, suffix, client=None):
+    # High-level helper that determines the chunk output folder and triggers
     # the retrieval and extraction for the specified run folder and year.
+    # Months that were downloaded before an interruption are kept in
+    # chunk_directory and not fetched again.
     unzip_directory = f"TEMP_OUTPUTS/{FOLDER}/{suffix}"
-    zip_path = unzip_directory + ".zip"
+    chunk_directory = unzip_directory + "_chunks"
 
-    download_data(YEAR, zip_path)  # fetch the ERA5 data archive
-    unzip_data(zip_path, unzip_directory)  # extract contents for downstream processing
+    # fetch the ERA5 data archives, one per month
+    zip_paths = download_data(YEAR, chunk_directory, client=client)
+    extract_directories = []
+    for zip_path in zip_paths:
+        extract_directories.append(zip_path[: -len(".zip")])
+        unzip_data(zip_path, extract_directories[-1])
+    # join the months into the stream files used for downstream processing
+    era5_retrieval.merge_chunks(extract_directories, unzip_directory)
+    shutil.rmtree(chunk_directory)
@@ -0,0 +1,257 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+from analysis_code import climatology
+from analysis_code import era5_cache
+from analysis_code import era5_composite
+from analysis_code import memo
+
+# Specific gas constant of dry air, J kg^-1 K^-1, for the air density p / (R T)
+R_DRY_AIR = 287.05
+# Generic wind turbine: cut-in, rated and cut-out speed at hub height, m s^-1
+CUT_IN, RATED, CUT_OUT = 3.0, 12.0, 25.0
+# PV module: power temperature coefficient (K^-1), nominal operating cell
+# temperature (C) and irradiance at standard test conditions (W m^-2)
+PV_TEMPERATURE_COEFFICIENT = -0.004
+NOCT = 45.0
+STC_IRRADIANCE = 1000.0
+# Base temperature of heating and cooling degree hours (65 F), C
+HEATING_BASE = 18.3
+COOLING_BASE = 18.3
+
+# Variable name in the output files -> (display name, unit of the time mean)
+METRICS = {
+    "wind_power_density": ("Wind Power Density", "W m$^{-2}$"),
+    "wind_capacity_factor": ("Wind Capacity Factor", "-"),
+    "pv_capacity_factor": ("PV Capacity Factor", "-"),
+    "heating_degree_hours": ("Heating Degree Hours", "K"),
+    "cooling_degree_hours": ("Cooling Degree Hours", "K"),
+}
+# Metrics over all cached hours of a weather year:
+# {METRICS_ROOT}/{area_key}/{YEAR}.nc
+METRICS_ROOT = "TEMP_OUTPUTS/energy_metrics"
+
+
+def metrics_path(FOLDER, suffix):
+    return f"TEMP_OUTPUTS/{FOLDER}/{suffix}_energy_metrics.nc"
+
+
+def baseline_path(YEAR, area=climatology.AREA):
+    return f"{METRICS_ROOT}/{era5_cache.area_key(area)}/{YEAR}.nc"
+
+
+def total_unit(unit):
+    # Unit of the sum over hourly steps, e.g. K -> K h, capacity factor -> h
+    return "h" if unit == "-" else f"{unit} h"
+
+
+def power_curve(cut_in=CUT_IN, rated=RATED, cut_out=CUT_OUT, step=0.5):
+    """
+    Tabulated power curve of a generic turbine: output rises with the cube of
+    the wind speed between cut-in and rated speed, is 1 up to cut-out and 0
+    beyond. Any other tabulated curve can be used in its place.
+
+    :return: (wind speeds in m s^-1, output as a fraction of rated power)
+    """
+    speeds = np.arange(0, cut_out + 2 * step, step)
+    fractions = np.clip((speeds**3 - cut_in**3) / (rated**3 - cut_in**3), 0, 1)
+    fractions[speeds < cut_in] = 0
+    fractions[speeds > cut_out] = 0
+    return speeds, fractions
+
+
+POWER_CURVE = power_curve()
+
+
+def wind_power_density(speed, temperature, pressure):
+    # 0.5 * rho * v^3 with rho = p / (R T), in W m^-2; temperature in C and
+    # pressure in hPa, as derived by era5_composite. Uses the mean sea level
+    # pressure, so the density is that of air at sea level.
+    kelvin = np.add(temperature, 273.15, dtype=np.float32)
+    result = np.power(speed, 3, dtype=np.float32)
+    result *= pressure
+    result /= kelvin
+    result *= 0.5 * 100 / R_DRY_AIR
+    return result
+
+
+def wind_capacity_factor(speed, curve=POWER_CURVE):
+    # Output of the turbine as a fraction of its rated power, read off the
+    # tabulated power curve by linear interpolation
+    return np.interp(speed, *curve).astype(np.float32, copy=False)
+
+
+def pv_capacity_factor(irradiance, temperature):
+    # PV output as a fraction of its rated power: irradiance over the STC
+    # irradiance, derated by the cell temperature, which rises above the air
+    # temperature linearly with irradiance (NOCT model)
+    result = np.multiply(irradiance, (NOCT - 20) / 800, dtype=np.float32)
+    result += temperature
+    result -= 25
+    result *= PV_TEMPERATURE_COEFFICIENT
+    result += 1
+    result *= irradiance
+    result /= STC_IRRADIANCE
+    return np.clip(result, 0, 1, out=result)
+
+
+def degree_hours(temperature, base, heating):
+    # Degrees below (heating) or above (cooling) the base in each hour
+    result = np.subtract(base, temperature, dtype=np.float32)
+    if not heating:
+        np.negative(result, out=result)
+    return np.maximum(result, 0, out=result)
+
+
+def block_metrics(fields, curve=POWER_CURVE):
+    """
+    Energy metrics of one block of derived ERA5 fields (from
+    era5_composite.iterate_blocks). Each metric is one block-sized array built
+    with in-place operations, so memory scales with the block, not the run.
+
+    :return: dict of METRICS name -> array (time x latitude x longitude)
+    """
+    temperature = fields["2m Temperature"]
+    speed = fields["100m Wind Speed"]
+    irradiance = fields["Global Horizontal Irradiance"]
+    return {
+        "wind_power_density": wind_power_density(
+            speed, temperature, fields["Mean Sea Level Pressure"]
+        ),
+        "wind_capacity_factor": wind_capacity_factor(speed, curve),
+        "pv_capacity_factor": pv_capacity_factor(irradiance, temperature),
+        "heating_degree_hours": degree_hours(temperature, HEATING_BASE, True),
+        "cooling_degree_hours": degree_hours(temperature, COOLING_BASE, False),
+    }
+
+
+def accumulate(blocks, lat, lon, curve=POWER_CURVE):
+    """
+    Time-mean, time-sum and domain-mean series of every metric, in one pass
+    over blocks of derived fields.
+
+    :param blocks: iterable of (valid times, fields) as from iterate_blocks
+    :return: Dataset with '{metric}' means and '{metric}_total' sums on
+             (latitude, longitude), and '{metric}_series' on valid_time
+    """
+    shape = (lat.size, lon.size)
+    sums = {m: np.zeros(shape) for m in METRICS}
+    counts = {m: np.zeros(shape) for m in METRICS}
+    series = {m: [] for m in METRICS}
+    times = []
+    for block_times, fields in blocks:
+        times.append(block_times)
+        for metric, values in block_metrics(fields, curve).items():
+            # Accumulate in float64 so long records keep full precision
+            sums[metric] += np.nansum(values, axis=0, dtype=np.float64)
+            counts[metric] += np.isfinite(values).sum(axis=0)
+            series[metric].append(np.nanmean(values, axis=(1, 2)))
+
+    coords = {"latitude": lat, "longitude": lon}
+    ds = xr.Dataset(coords=coords)
+    if times:
+        ds = ds.assign_coords(valid_time=np.concatenate(times))
+    for metric, (name, unit) in METRICS.items():
+        attrs = {"long_name": name, "units": unit}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ds[metric] = (("latitude", "longitude"), sums[metric] / counts[metric])
+        ds[metric].attrs = attrs
+        ds[f"{metric}_total"] = (("latitude", "longitude"), sums[metric])
+        ds[f"{metric}_total"].attrs = {
+            "long_name": f"{name}, sum",
+            "units": total_unit(unit),
+        }
+        if times:
+            ds[f"{metric}_series"] = ("valid_time", np.concatenate(series[metric]))
+            ds[f"{metric}_series"].attrs = {
+                **attrs,
+                "long_name": f"{name}, domain mean",
+            }
+    ds.attrs = {
+        "hours": int(sum(len(t) for t in times)),
+        "cut_in": CUT_IN,
+        "rated": RATED,
+        "cut_out": CUT_OUT,
+        "heating_base": HEATING_BASE,
+        "cooling_base": COOLING_BASE,
+    }
+    return ds
+
+
+def _write(ds, path):
+    # Compressed float32, written to a temporary file first so a crash never
+    # leaves a truncated file behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    encoding = {name: {"zlib": True, "dtype": "float32"} for name in ds.data_vars}
+    ds.to_netcdf(path + ".tmp", encoding=encoding)
+    os.replace(path + ".tmp", path)
+
+
+def run_metrics(FOLDER, suffix, valid_times=None, chunk_size=era5_composite.CHUNK_SIZE):
+    """
+    Energy metrics of the high-price ERA5 hours of a run, written to
+    TEMP_OUTPUTS/{FOLDER}/{suffix}_energy_metrics.nc.
+
+    :param valid_times: optional timestamps; only matching steps are used
+    """
+    extension1 = "data_stream-oper_stepType-instant.nc"
+    extension2 = "data_stream-oper_stepType-accum.nc"
+    streams = era5_composite.open_streams(FOLDER, extension1, extension2, suffix)
+    try:
+        blocks = era5_composite.iterate_blocks(
+            streams, valid_times=valid_times, chunk_size=chunk_size
+        )
+        ds = accumulate(blocks, streams[0]["latitude"], streams[0]["longitude"])
+    finally:
+        for stream in streams:
+            stream.close()
+    _write(ds, metrics_path(FOLDER, suffix))
+
+
+def energy_metrics_analysis(FOLDER, suffix):
+    # Scheduler stage: run_metrics, memoized on the run's ERA5 streams
+    streams = [
+        f"TEMP_OUTPUTS/{FOLDER}/{suffix}/data_stream-oper_stepType-{kind}.nc"
+        for kind in ["instant", "accum"]
+    ]
+    memo.cached(
+        "energy metrics",
+        [metrics_path(FOLDER, suffix)],
+        run_metrics,
+        FOLDER,
+        suffix,
+        inputs=streams,
+    )
+
+
+def baseline_metrics(YEAR, area=climatology.AREA, chunk_size=era5_composite.CHUNK_SIZE):
+    """
+    Energy metrics over every cached ERA5 hour of a weather year, one day at
+    a time, written to {METRICS_ROOT}/{area_key}/{YEAR}.nc. The variables match
+    those of run_metrics, so e.g. the wind capacity factor during high prices
+    relative to the cached hours is run['wind_capacity_factor'] - baseline[...].
+
+    The cache only holds what runs have downloaded: with mode='hour' these are
+    the high-price hours of every run of the weather year, not the rest of
+    the year, and the baseline approaches a climatology only as more days are
+    downloaded.
+    """
+    dates = climatology.cached_dates(YEAR, area)
+    if not dates:
+        raise FileNotFoundError(f"No cached ERA5 days for {YEAR} in {area}")
+    first = climatology.open_day(dates[0], area)
+
+    def blocks():
+        for date in dates:
+            day = first if date == dates[0] else climatology.open_day(date, area)
+            yield from era5_composite.iterate_blocks([day], chunk_size=chunk_size)
+
+    ds = accumulate(blocks(), first["latitude"], first["longitude"])
+    ds.attrs["days"] = len(dates)
+    ds.attrs["valid_time_range"] = (
+        f"{pd.Timestamp(ds['valid_time'].values[0])} to "
+        f"{pd.Timestamp(ds['valid_time'].values[-1])}"
+    )
+    _write(ds, baseline_path(YEAR, area))
+    print(f"Energy metrics of {ds.attrs['hours']} cached hours of {YEAR} written")
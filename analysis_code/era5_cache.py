@@ -0,0 +1,186 @@
+import xarray as xr
+import pandas as pd
+import netCDF4
+import os
+import zipfile
+
+# Root of the ERA5 store shared by every run. Files are laid out as
+# {CACHE_ROOT}/{area_key}/{variable}/{YYYY-MM-DD}.nc so that a (date, variable,
+# area) triple maps to exactly one file, and the times held for that day are
+# read back from its 'valid_time' coordinate.
+CACHE_ROOT = "TEMP_OUTPUTS/era5_cache"
+
+# zlib level of the cached and assembled files; ERA5 fields shrink to about
+# half, which matters more on shared scratch space than the CPU it costs
+COMPRESSION = 4
+
+# CDS request names mapped to the short name used inside the NetCDF files and
+# the stream file the CDS places the variable in.
+ERA5_VARIABLES = {
+    "2m_temperature": ("t2m", "data_stream-oper_stepType-instant.nc"),
+    "mean_sea_level_pressure": ("msl", "data_stream-oper_stepType-instant.nc"),
+    "100m_u_component_of_wind": ("u100", "data_stream-oper_stepType-instant.nc"),
+    "100m_v_component_of_wind": ("v100", "data_stream-oper_stepType-instant.nc"),
+    "surface_solar_radiation_downwards": (
+        "ssrd",
+        "data_stream-oper_stepType-accum.nc",
+    ),
+}
+
+
+def area_key(area):
+    # Folder name for a North, West, South, East bounding box
+    return "_".join(str(edge) for edge in area)
+
+
+def cache_path(date, variable, area):
+    # Location of the cached field for one CDS variable on one day
+    return f"{CACHE_ROOT}/{area_key(area)}/{variable}/{date}.nc"
+
+
+def cached_times(date, variable, area):
+    """
+    Return the set of 'HH:MM' times already cached for a variable on a date.
+    :param date: 'YYYY-MM-DD' string
+    :param variable: CDS variable name, e.g. '2m_temperature'
+    :param area: [North, West, South, East] bounding box
+    :return: set of 'HH:MM' strings (empty if nothing is cached)
+    """
+    path = cache_path(date, variable, area)
+    if not os.path.exists(path):
+        return set()
+    with xr.open_dataset(path) as ds:
+        return set(pd.DatetimeIndex(ds["valid_time"].values).strftime("%H:%M"))
+
+
+def missing_dates(dates, variables, times, area):
+    """
+    Return the dates for which any of the requested variables or times is not
+    yet held in the cache, preserving the order of 'dates'.
+    """
+    wanted = set(times)
+    return [
+        date
+        for date in dates
+        if any(not wanted <= cached_times(date, var, area) for var in variables)
+    ]
+
+
+def missing_hours(hours, variables, area):
+    """
+    Return the times not yet held in the cache for each date.
+    :param hours: dict of 'YYYY-MM-DD' -> list of 'HH:MM' times
+    :return: dict of date -> sorted list of missing times (dates with none
+             missing are left out)
+    """
+    missing = {}
+    for date, times in hours.items():
+        absent = set()
+        for variable in variables:
+            absent |= set(times) - cached_times(date, variable, area)
+        if absent:
+            missing[date] = sorted(absent)
+    return missing
+
+
+def _write_atomic(ds, path, compress=False):
+    # Write to a temporary file first so a crash never leaves a truncated cache entry.
+    # Compressed fields are chunked one time step at a time, so reading a
+    # block of time steps only decompresses those steps.
+    encoding = {}
+    if compress:
+        for name, variable in ds.data_vars.items():
+            # Float32, not the CDS int16 packing: each download has its own
+            # scale and offset, so one day's packing cannot hold another day's
+            # values once days are merged or concatenated
+            encoding[name] = {
+                "dtype": "float32",
+                "zlib": True,
+                "complevel": COMPRESSION,
+            }
+            if variable.dims and variable.dims[0] == "valid_time":
+                encoding[name]["chunksizes"] = (1,) + variable.shape[1:]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    ds.to_netcdf(tmp_path, encoding=encoding)
+    os.replace(tmp_path, path)
+
+
+def read_archive(path):
+    """
+    Read a CDS download without extracting it. The CDS returns either a ZIP
+    archive holding one NetCDF file per stream (e.g.
+    data_stream-oper_stepType-instant.nc), read here from memory, or, for some
+    requests, a bare NetCDF file.
+
+    :param path: downloaded file, whatever its extension
+    :return: list of loaded Datasets, one per stream file
+    """
+    if not zipfile.is_zipfile(path):
+        with xr.open_dataset(path) as ds:
+            return [ds.load()]
+
+    datasets = []
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.namelist():
+            if not member.endswith(".nc"):
+                continue
+            # netCDF4 opens the member from memory; the name only labels it.
+            # The xarray store closes the netCDF4 dataset with the Dataset.
+            nc = netCDF4.Dataset(f"{path}/{member}", memory=archive.read(member))
+            with xr.open_dataset(xr.backends.NetCDF4DataStore(nc)) as ds:
+                datasets.append(ds.load())
+    return datasets
+
+
+def store(datasets, area):
+    """
+    Split the fields of a CDS download, e.g. from read_archive, into per-day,
+    per-variable compressed cache entries. Times already cached for a day are
+    kept, so downloads for different runs accumulate into the same daily
+    files.
+    """
+    short_to_cds = {short: cds for cds, (short, _) in ERA5_VARIABLES.items()}
+
+    for data in datasets:
+        days = pd.DatetimeIndex(data["valid_time"].values).strftime("%Y-%m-%d")
+        for short_name in data.data_vars:
+            if short_name not in short_to_cds:
+                continue
+            variable = short_to_cds[short_name]
+            for date in days.unique():
+                new = data[[short_name]].isel(valid_time=days == date)
+                target = cache_path(date, variable, area)
+                if os.path.exists(target):
+                    # Merge with the hours already held for this day; fresh values win
+                    with xr.open_dataset(target) as old:
+                        new = new.combine_first(old.load())
+                _write_atomic(new.sortby("valid_time"), target, compress=True)
+
+
+def assemble(dates, variables, times, area, unzip_directory):
+    """
+    Build the run's stream files (as the CDS would deliver them) from the cache
+    for the given dates and times, so downstream processing is unchanged.
+    'times' is either one list of 'HH:MM' times used for every date, or a dict
+    of date -> times for hour-exact runs.
+    """
+    streams = {}
+    for variable in variables:
+        stream = ERA5_VARIABLES[variable][1]
+        days = []
+        for date in dates:
+            with xr.open_dataset(cache_path(date, variable, area)) as day:
+                day = day.load()
+            # Keep only the requested times from the (possibly larger) cached day
+            hours = pd.DatetimeIndex(day["valid_time"].values).strftime("%H:%M")
+            day_times = times[date] if isinstance(times, dict) else times
+            days.append(day.isel(valid_time=hours.isin(day_times)))
+        streams.setdefault(stream, []).append(xr.concat(days, dim="valid_time"))
+
+    for stream, parts in streams.items():
+        _write_atomic(
+            xr.merge(parts, compat="override"),
+            f"{unzip_directory}/{stream}",
+            compress=True,
+        )
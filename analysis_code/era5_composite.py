@@ -0,0 +1,120 @@
+import xarray as xr
+import numpy as np
+
+# Number of time steps read from the ERA5 files at a time. Peak memory scales
+# with this block size and the grid, not with the number of time steps.
+CHUNK_SIZE = 24
+
+
+# Derived fields, computed in place on the raw block arrays to avoid
+# full-size temporaries. Each function receives a dict of raw arrays
+# (time x latitude x longitude) and returns the derived array.
+def _temperature(raw):
+    return np.subtract(raw["t2m"], 273.15, out=raw["t2m"])  # from Kelvin to C
+
+
+def _pressure(raw):
+    return np.divide(raw["msl"], 100, out=raw["msl"])  # from Pa to hPa
+
+
+def _wind_speed(raw):
+    return np.hypot(raw["u100"], raw["v100"], out=raw["u100"])  # m s^-1
+
+
+def _irradiance(raw):
+    # W m^-2 instead of J m^-2 over 1 hour
+    return np.divide(raw["ssrd"], 3600, out=raw["ssrd"])
+
+
+# Display name -> (raw ERA5 variables needed, function computing the field)
+DERIVED_FIELDS = {
+    "2m Temperature": (["t2m"], _temperature),
+    "Mean Sea Level Pressure": (["msl"], _pressure),
+    "100m Wind Speed": (["u100", "v100"], _wind_speed),
+    "Global Horizontal Irradiance": (["ssrd"], _irradiance),
+}
+
+
+def open_streams(FOLDER, extension1, extension2, suffix):
+    # Open the instant and accumulated streams lazily; nothing is read yet
+    streams = []
+    for extension in [extension1, extension2]:
+        FILE = f"TEMP_OUTPUTS/{FOLDER}/{suffix}/{extension}"
+        streams.append(xr.open_dataset(FILE, engine="netcdf4"))
+    return streams
+
+
+def iterate_blocks(streams, variables=None, valid_times=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield derived fields block by block along 'valid_time'.
+
+    :param streams: lazily opened ERA5 Datasets (e.g. from open_streams)
+    :param variables: display names from DERIVED_FIELDS to compute (default all);
+                      raw variables not needed by these are never read
+    :param valid_times: optional timestamps; only matching steps are used
+    :param chunk_size: number of time steps per block
+    :return: generator of (valid_time values, {variable: array}) per block
+    """
+    variables = list(DERIVED_FIELDS) if variables is None else list(variables)
+    needed = {raw for v in variables for raw in DERIVED_FIELDS[v][0]}
+    source = {raw: ds[raw] for ds in streams for raw in ds.data_vars if raw in needed}
+
+    time = streams[0]["valid_time"].values
+    steps = np.arange(len(time))
+    if valid_times is not None:
+        steps = steps[np.isin(time, np.asarray(valid_times, dtype=time.dtype))]
+
+    for start in range(0, len(steps), chunk_size):
+        block = steps[start : start + chunk_size]
+        # Writable float32 arrays, so the derived fields can be computed in place
+        raw = {
+            name: np.require(
+                array.isel(valid_time=block).values, np.float32, requirements="W"
+            )
+            for name, array in source.items()
+        }
+        yield time[block], {v: DERIVED_FIELDS[v][1](raw) for v in variables}
+
+
+def composite_means(
+    FOLDER,
+    extension1,
+    extension2,
+    suffix,
+    variables=None,
+    valid_times=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Time-mean of the derived ERA5 fields, computed in one pass over both
+    streams: every block is read once, all requested fields are derived from
+    it and added to running sums.
+
+    :return: dict of variable -> 2D DataArray (latitude x longitude)
+    """
+    streams = open_streams(FOLDER, extension1, extension2, suffix)
+    variables = list(DERIVED_FIELDS) if variables is None else list(variables)
+    lat = streams[0]["latitude"]
+    lon = streams[0]["longitude"]
+
+    sums = {v: np.zeros((lat.size, lon.size)) for v in variables}
+    counts = {v: np.zeros((lat.size, lon.size)) for v in variables}
+    for _, fields in iterate_blocks(streams, variables, valid_times, chunk_size):
+        for variable, field in fields.items():
+            # Accumulate in float64 so long records keep full precision
+            sums[variable] += np.nansum(field, axis=0, dtype=np.float64)
+            counts[variable] += np.isfinite(field).sum(axis=0)
+
+    for ds in streams:
+        ds.close()
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            v: xr.DataArray(
+                sums[v] / counts[v],
+                coords={"latitude": lat, "longitude": lon},
+                dims=["latitude", "longitude"],
+                name=v,
+            )
+            for v in variables
+        }
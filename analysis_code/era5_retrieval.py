@@ -0,0 +1,130 @@
+import cdsapi
+import xarray as xr
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import threading
+import time
+
+# The CDS queues requests per user, so a handful of concurrent chunks is enough
+# to keep the queue busy without being throttled.
+MAX_WORKERS = 4
+# Number of attempts per chunk and the base delay (seconds) between them; the
+# delay doubles after every failed attempt.
+RETRIES = 3
+BACKOFF = 30
+
+_thread_state = threading.local()
+
+
+def default_client():
+    # cdsapi.Client holds an HTTP session, so give each worker thread its own
+    if not hasattr(_thread_state, "client"):
+        _thread_state.client = cdsapi.Client()
+    return _thread_state.client
+
+
+def chunk_dates(dates, days_per_chunk=None):
+    """
+    Split a list of 'YYYY-MM-DD' dates into chunks for separate CDS requests.
+    :param dates: iterable of date strings
+    :param days_per_chunk: if None, one chunk per calendar month; otherwise
+                           blocks of at most this many dates
+    :return: list of lists of date strings, in date order
+    """
+    dates = sorted(set(dates))
+    if days_per_chunk is None:
+        months = pd.DatetimeIndex(dates).strftime("%Y-%m")
+        return [
+            [d for d, m in zip(dates, months) if m == month]
+            for month in months.unique()
+        ]
+    return [dates[i : i + days_per_chunk] for i in range(0, len(dates), days_per_chunk)]
+
+
+def request_key(dataset, request):
+    # Stable name for a chunk so an interrupted retrieval finds its finished files
+    text = json.dumps([dataset, request], sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def retrieve_chunk(dataset, request, target, client=None, retries=RETRIES):
+    """
+    Retrieve one request to 'target', retrying with exponential backoff.
+    The download is written to a temporary file and only renamed to 'target'
+    once complete, so an existing 'target' is always a finished chunk and is
+    not fetched again.
+    """
+    if os.path.exists(target):
+        return target
+
+    tmp_path = target + ".part"
+    for attempt in range(1, retries + 1):
+        try:
+            (client or default_client()).retrieve(dataset, request, tmp_path)
+            os.replace(tmp_path, target)
+            return target
+        except Exception as err:
+            print(f"Attempt {attempt}/{retries} failed for {target}: {err}")
+            if attempt == retries:
+                raise
+            time.sleep(BACKOFF * 2 ** (attempt - 1))
+
+
+def retrieve(dataset, requests, directory, client=None, max_workers=MAX_WORKERS):
+    """
+    Retrieve several CDS requests concurrently into 'directory'.
+
+    :param dataset: CDS dataset name, e.g. 'reanalysis-era5-single-levels'
+    :param requests: list of request dicts, one per chunk
+    :param directory: folder for the downloaded chunks
+    :param client: object with a cdsapi-style retrieve(dataset, request, target)
+                   method; defaults to one cdsapi.Client per worker thread
+    :param max_workers: number of chunks in flight at once
+    :return: list of downloaded file paths, in the order of 'requests'
+    """
+    os.makedirs(directory, exist_ok=True)
+    targets = [f"{directory}/{request_key(dataset, r)}.zip" for r in requests]
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(retrieve_chunk, dataset, request, target, client): target
+            for request, target in zip(requests, targets)
+        }
+        for future in as_completed(futures):
+            # Let the remaining chunks finish so a rerun only fetches the failures
+            if future.exception() is not None:
+                failed.append(futures[future])
+
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(requests)} ERA5 chunks failed: {sorted(failed)}"
+        )
+    return targets
+
+
+def merge_chunks(chunk_directories, unzip_directory):
+    """
+    Concatenate the stream files extracted from each chunk along 'valid_time'
+    and write them to 'unzip_directory' under their original names.
+    """
+    os.makedirs(unzip_directory, exist_ok=True)
+    streams = sorted(
+        {name for folder in chunk_directories for name in os.listdir(folder)}
+    )
+    for stream in streams:
+        parts = []
+        for folder in chunk_directories:
+            path = f"{folder}/{stream}"
+            if os.path.exists(path):
+                with xr.open_dataset(path) as part:
+                    parts.append(part.load())
+        merged = xr.concat(parts, dim="valid_time").sortby("valid_time")
+
+        # Write atomically so a partially written file is never picked up
+        tmp_path = f"{unzip_directory}/{stream}.tmp"
+        merged.to_netcdf(tmp_path)
+        os.replace(tmp_path, f"{unzip_directory}/{stream}")
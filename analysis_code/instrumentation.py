@@ -0,0 +1,178 @@
+from contextlib import contextmanager
+import cProfile
+import datetime as dt
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+# Structured log of every measured stage, one JSON object per line. Worker
+# processes append to it concurrently; each record is one short write.
+LOG = "TEMP_OUTPUTS/instrumentation.jsonl"
+# cProfile dumps of profiled stages, one file per stage
+PROFILE_DIRECTORY = "TEMP_OUTPUTS/profiles"
+
+# Stages currently being measured in this process, outermost first
+_stack = []
+
+
+def _io_counters():
+    # Bytes read and written by this process (all threads): rchar/wchar count
+    # every read/write call, read_bytes/write_bytes only what reached storage
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _megabytes(end, start, key):
+    return round((end.get(key, 0) - start.get(key, 0)) / 2**20, 2)
+
+
+def _peak_rss():
+    # Peak resident set size in bytes since the last reset (Linux), or of the
+    # whole process elsewhere
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    # Reset VmHWM to the current RSS, so the next reading is this stage's peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def measure(name, log_path=LOG, profile=False, trace_memory=False):
+    """
+    Measure a stage and append a record to the JSON-lines log: wall and CPU
+    time, peak RSS, bytes read and written, and optionally the tracemalloc
+    peak. Stages nest: a stage measured inside another is named
+    '{outer}/{name}', and the outer stage's peak includes the inner one's.
+
+    :param name: stage name, e.g. 'fully_renewable-WY2019_1H/analyse' or a
+                 sub-step such as 'read network'
+    :param profile: also run the stage under cProfile and dump the statistics
+                    to PROFILE_DIRECTORY
+    :param trace_memory: also record the peak of Python allocations (numpy
+                         arrays included) with tracemalloc; slows the stage
+    """
+    if _stack:
+        # Keep the outer stage's peak so far before the counter is reset
+        _stack[-1]["peak"] = max(_stack[-1]["peak"], _peak_rss())
+        name = f"{_stack[-1]['name']}/{name}"
+    frame = {"name": name, "peak": 0}
+    _stack.append(frame)
+
+    _reset_peak_rss()
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile else None
+    io_start = _io_counters()
+    start = dt.datetime.now()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    status = "ok"
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    except BaseException as error:
+        status = f"error: {error!r}"
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        io_end = _io_counters()
+        peak = max(frame["peak"], _peak_rss())
+        _stack.pop()
+        if _stack:
+            _stack[-1]["peak"] = max(_stack[-1]["peak"], peak)
+
+        record = {
+            "stage": name,
+            "start": start.isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            "status": status,
+            "wall_s": round(wall, 4),
+            "cpu_s": round(cpu, 4),
+            "peak_rss_mb": round(peak / 2**20, 1),
+            "read_mb": _megabytes(io_end, io_start, "rchar"),
+            "written_mb": _megabytes(io_end, io_start, "wchar"),
+            "disk_read_mb": _megabytes(io_end, io_start, "read_bytes"),
+            "disk_written_mb": _megabytes(io_end, io_start, "write_bytes"),
+        }
+        if trace_memory:
+            record["tracemalloc_peak_mb"] = round(
+                tracemalloc.get_traced_memory()[1] / 2**20, 1
+            )
+            tracemalloc.stop()
+        if profiler:
+            os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+            record["profile"] = f"{PROFILE_DIRECTORY}/{name.replace('/', '__')}.prof"
+            profiler.dump_stats(record["profile"])
+
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def load_log(log_path=LOG, since=None):
+    """
+    Read the stage records.
+
+    :param since: optional datetime; only stages started at or after it are kept
+    :return: DataFrame with one row per measured stage
+    """
+    # Imported here, so processes that only measure stages stay light
+    import pandas as pd
+
+    if not os.path.exists(log_path):
+        return pd.DataFrame()
+    records = pd.read_json(log_path, lines=True, convert_dates=False)
+    records["start"] = pd.to_datetime(records["start"])
+    if since is not None:
+        records = records[records["start"] >= pd.Timestamp(since).floor("s")]
+    return records
+
+
+def summary(log_path=LOG, since=None):
+    """
+    Print and return a table of the stages of a sweep: one row per stage and
+    sub-step name (the run name removed), with total wall and CPU time, the
+    largest peak RSS and the total megabytes read and written.
+    """
+    records = load_log(log_path, since)
+    if len(records) == 0:
+        print("No stages recorded")
+        return records
+    # 'run/analyse/read network' -> 'analyse/read network'
+    records["step"] = records["stage"].str.split("/", n=1).str[-1]
+    table = records.groupby("step").agg(
+        runs=("stage", "size"),
+        failed=("status", lambda s: int((s != "ok").sum())),
+        wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        read_mb=("read_mb", "sum"),
+        written_mb=("written_mb", "sum"),
+    )
+    table = table.sort_values("wall_s", ascending=False)
+    print(table.round(2).to_string())
+    return table
@@ -0,0 +1,142 @@
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# Map extent in West, East, South, North (the ERA5 download area)
+EXTENT = (-125, -66.5, 24, 49.5)
+# Number of processes used to render figures in parallel
+MAX_WORKERS = 4
+
+# Base map of this process, created on first use and reused for every figure
+_base_map = {}
+
+
+def base_map():
+    """
+    Return the figure, map axes and colorbar axes shared by all figures drawn
+    in this process. The coastlines (at cartopy's automatic resolution, as
+    ax.coastlines() draws them), borders and states are added once, the latter
+    clipped to EXTENT; cartopy caches their projected paths on the first draw,
+    so later figures do not project them again.
+    """
+    if _base_map:
+        return _base_map
+
+    # A figure outside pyplot, so it is never closed by the other plotting code
+    fig = Figure(figsize=(12, 6))
+    ax = fig.add_subplot(projection=ccrs.PlateCarree())  # The projection for the plot
+
+    # Add map context: coastlines, country borders and US state borders
+    ax.coastlines()
+    for feature, linewidth in [(cfeature.BORDERS, 1), (cfeature.STATES, 0.5)]:
+        geometries = list(feature.intersecting_geometries(EXTENT))
+        ax.add_feature(
+            cfeature.ShapelyFeature(geometries, ccrs.PlateCarree()),
+            facecolor="none",
+            edgecolor="black",
+            linewidth=linewidth,
+        )
+
+    # Add gridlines and control which edges show the lat/lon labels
+    gl = ax.gridlines(
+        draw_labels=True, linewidth=0.5, color="gray", alpha=0.5, linestyle="--"
+    )
+    gl.top_labels = False
+    gl.right_labels = False
+
+    # Adjust label appearance for clarity
+    gl.xlabel_style = {"size": 10, "color": "gray"}
+    gl.ylabel_style = {"size": 10, "color": "gray"}
+
+    _base_map.update(fig=fig, ax=ax, cax=None)
+    return _base_map
+
+
+def render_map(field, variable, unit, cmap, limits, path, stipple=None):
+    """
+    Draw a 2D (latitude x longitude) field on the shared base map and save it.
+
+    :param field: 2D DataArray, e.g. a time-mean of an ERA5 variable
+    :param variable: display name, used in the title
+    :param unit: unit label for the title and colorbar
+    :param cmap: matplotlib colormap name
+    :param limits: (vmin, vmax) of the colour scale
+    :param path: output file path
+    :param stipple: optional 2D boolean DataArray on the grid of field; cells
+                    where it is True are stippled, e.g. significant cells
+    """
+    state = base_map()
+    fig, ax, cax = state["fig"], state["ax"], state["cax"]
+
+    vmin, vmax = limits
+    colorbar = {"cbar_kwargs": {"label": unit}}
+    if cax is not None:
+        # Reuse the colorbar axes laid out for the first figure
+        cax.clear()
+        colorbar["cbar_ax"] = cax
+
+    # Use xarray/matplotlib to plot the gridded dataset onto the map.
+    # transform=PlateCarree tells cartopy the data's coordinate system is regular lon/lat.
+    artist = field.plot(
+        ax=ax,
+        transform=ccrs.PlateCarree(),
+        levels=10,  # number of contour levels / filled intervals
+        cmap=cmap,
+        vmin=vmin,
+        vmax=vmax,
+        **colorbar,
+    )
+    if cax is None:
+        state["cax"] = artist.colorbar.ax
+
+    artists = [artist]
+    if stipple is not None:
+        # Hatch the True cells only; the filled colours stay visible underneath
+        artists.append(
+            ax.contourf(
+                stipple["longitude"],
+                stipple["latitude"],
+                stipple.values.astype(float),
+                levels=[0.5, 1.5],
+                colors="none",
+                hatches=[".."],
+                transform=ccrs.PlateCarree(),
+            )
+        )
+
+    # Finalize and write the figure
+    ax.set_title(f"{variable} ({unit})")
+    fig.savefig(path, bbox_inches="tight")
+
+    # Remove the field so the base map is clean for the next figure
+    for artist in artists:
+        artist.remove()
+
+
+def _render_job(job):
+    render_map(*job)
+    return job[5]
+
+
+def render_maps(jobs, max_workers=MAX_WORKERS):
+    """
+    Render many maps, e.g. all variables of one or several runs, in a process
+    pool. Each worker builds the base map once and reuses it for all the jobs
+    it receives. Inside a process started by another pool, e.g. a scheduler
+    stage, the maps are rendered one after another in that process instead,
+    so pools are never nested.
+
+    :param jobs: list of (field, variable, unit, cmap, limits, path) tuples,
+                 optionally followed by a stipple mask
+    :return: list of written paths
+    """
+    if (
+        max_workers == 1
+        or len(jobs) <= 1
+        or multiprocessing.parent_process() is not None
+    ):
+        return [_render_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        return list(pool.map(_render_job, jobs))
@@ -0,0 +1,265 @@
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+import types
+
+# Stored outputs of memoized steps, one folder per key holding entry.json and
+# a copy of every output file: {MEMO_ROOT}/{key}/
+MEMO_ROOT = "TEMP_OUTPUTS/memo"
+# Disk budget of MEMO_ROOT in megabytes; beyond it the least recently used
+# entries are removed. Set per stage from the [memo] section of config.toml.
+BUDGET_MB = 2048
+# Input files up to this size are keyed on their content, larger ones (the
+# network files) on their size and modification time
+CONTENT_HASH_MB = 64
+# Bump when the key or the entry layout changes so old entries are not reused
+MEMO_VERSION = 1
+
+# Content hashes computed in this process, by (path, size, mtime)
+_hashes = {}
+
+
+def file_signature(path, content_hash_mb=CONTENT_HASH_MB):
+    # Content hash of a small file, size and mtime of a large one
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    if stat.st_size > content_hash_mb * 2**20:
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    stamp = (path, stat.st_size, stat.st_mtime_ns)
+    if stamp not in _hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**24), b""):
+                digest.update(block)
+        _hashes[stamp] = digest.hexdigest()
+    return _hashes[stamp]
+
+
+def _stat(path):
+    # Cheap stamp of an output, to tell whether it is still the stored copy
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _stable_repr(value):
+    # Addresses in reprs (e.g. of functions in a dict) change every run
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", repr(value))
+
+
+def _in_package(module_name):
+    return module_name.split(".")[0] == __name__.split(".")[0]
+
+
+def _names(code):
+    # Global and attribute names used by a function, nested code included
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _names(const)
+    return names
+
+
+def code_version(*functions):
+    """
+    Hash of the source of the given functions, of the functions of this
+    package they call (directly or as module.function), and of the module
+    constants they read, e.g. color_map. A step is then rerun only when code
+    it depends on changes: editing a colour reruns the plots using it, but
+    not the network reading or the event detection. A module stands for all
+    the functions defined in it, for steps shaped by code that is not called
+    directly, e.g. functions held in a dict.
+
+    :return: hex digest
+    """
+    parts = {}
+    pending = []
+    for function in functions:
+        if isinstance(function, types.ModuleType):
+            pending += [
+                value
+                for value in vars(function).values()
+                if isinstance(value, types.FunctionType)
+                and value.__module__ == function.__name__
+            ]
+        else:
+            pending.append(function)
+    while pending:
+        function = pending.pop()
+        label = f"{function.__module__}.{function.__qualname__}"
+        if label in parts:
+            continue
+        try:
+            parts[label] = inspect.getsource(function)
+        except (OSError, TypeError):
+            parts[label] = function.__code__.co_code.hex()
+
+        names = _names(function.__code__)
+        used = []
+        for name in names:
+            if name not in function.__globals__:
+                continue
+            value = function.__globals__[name]
+            if isinstance(value, types.ModuleType):
+                # Attributes of a module of this package used as module.name
+                if _in_package(value.__name__):
+                    used += [
+                        (f"{value.__name__}.{attr}", getattr(value, attr))
+                        for attr in names
+                        if hasattr(value, attr)
+                    ]
+            else:
+                used.append((f"{function.__module__}.{name}", value))
+
+        for label, value in used:
+            if isinstance(value, types.FunctionType):
+                if _in_package(value.__module__):
+                    pending.append(value)
+            elif not callable(value) and not isinstance(value, types.ModuleType):
+                parts[label] = _stable_repr(value)
+            # Library functions, classes and modules are left out
+    text = json.dumps(parts, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def key(name, outputs, inputs=(), params=None, code=()):
+    """
+    Key of one step: its name and outputs, the signature of every input file,
+    its parameters and the version of its code.
+
+    :param inputs: paths of the files the step reads
+    :param params: JSON-able dict of the parameters, e.g. {'n_std': 1}
+    :param code: functions the step runs, see code_version
+    :return: hex string, the name of the entry's folder in MEMO_ROOT
+    """
+    payload = {
+        "name": name,
+        "outputs": list(outputs),
+        "inputs": {path: file_signature(path) for path in inputs},
+        "params": params or {},
+        "code": code_version(*code),
+        "memo_version": MEMO_VERSION,
+    }
+    text = json.dumps(payload, sort_keys=True, default=_stable_repr)
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def _stored_path(directory, i, path):
+    # Copy of the i-th output in an entry's folder
+    return f"{directory}/{i}_{os.path.basename(path)}"
+
+
+def restore(key, outputs, root=MEMO_ROOT):
+    """
+    Put the stored outputs of a key in place. Outputs that are still the
+    stored copies are left alone, so a hit usually copies nothing.
+
+    :return: (True, stored return value) on a hit, (False, None) otherwise
+    """
+    entry_path = f"{root}/{key}/entry.json"
+    try:
+        with open(entry_path) as f:
+            entry = json.load(f)
+        for i, path in enumerate(outputs):
+            if _stat(path) == entry["stamps"][i]:
+                continue
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # copy2 keeps the mtime, so the copy matches the stamp next time
+            shutil.copy2(_stored_path(f"{root}/{key}", i, path), path + ".tmp")
+            os.replace(path + ".tmp", path)
+        # Mark the entry as recently used for eviction
+        os.utime(entry_path)
+    except (OSError, ValueError, KeyError, IndexError):
+        # Missing, partly evicted or unreadable entries are misses
+        return False, None
+    return True, entry["value"]
+
+
+def store(key, name, outputs, value=None, root=MEMO_ROOT, budget_mb=None):
+    """
+    Copy the outputs of a step into a new entry, then evict least recently
+    used entries beyond the budget (BUDGET_MB by default).
+
+    :param value: JSON-able return value of the step, returned on later hits
+    """
+    directory = f"{root}/{key}"
+    # Build the entry under a temporary name, so it is complete when it appears
+    partial = f"{directory}.tmp{os.getpid()}"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for i, path in enumerate(outputs):
+        shutil.copy2(path, _stored_path(partial, i, path))
+    entry = {
+        "name": name,
+        "outputs": list(outputs),
+        "stamps": [_stat(path) for path in outputs],
+        "size": sum(os.path.getsize(path) for path in outputs),
+        "value": value,
+    }
+    with open(f"{partial}/entry.json", "w") as f:
+        json.dump(entry, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.replace(partial, directory)
+    except OSError:
+        # Another process stored the same key meanwhile
+        shutil.rmtree(partial, ignore_errors=True)
+    evict(BUDGET_MB if budget_mb is None else budget_mb, root)
+
+
+def cached(name, outputs, function, *args, inputs=(), params=None, code=(), **kwargs):
+    """
+    Run function(*args, **kwargs), which writes the given output files,
+    unless a step with the same key was stored before; then its outputs are
+    restored instead and its return value is returned.
+
+    :param name: step name, e.g. 'plot demand'
+    :param outputs: paths of the files the function writes
+    :param inputs, params: files and parameters the outputs depend on; params
+                           must include every argument not read from inputs
+    :param code: functions the step depends on, default the function itself
+    :return: return value of the function (JSON-able)
+    """
+    step_key = key(name, outputs, inputs, params, code or [function])
+    hit, value = restore(step_key, outputs)
+    if hit:
+        print(f"{name}: reusing stored outputs ({step_key[:8]})")
+        return value
+    value = function(*args, **kwargs)
+    store(step_key, name, outputs, value)
+    return value
+
+
+def evict(budget_mb=BUDGET_MB, root=MEMO_ROOT):
+    """
+    Remove the least recently used (stored or restored) entries until the
+    stored outputs fit in budget_mb megabytes.
+
+    :return: number of entries removed
+    """
+    if not os.path.isdir(root):
+        return 0
+    entries = []
+    for name in os.listdir(root):
+        entry_path = f"{root}/{name}/entry.json"
+        try:
+            with open(entry_path) as f:
+                size = json.load(f)["size"]
+            entries.append((os.stat(entry_path).st_mtime_ns, size, name))
+        except (OSError, ValueError, KeyError):
+            # Entries being written by another process
+            continue
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, name in sorted(entries):
+        if total <= budget_mb * 2**20:
+            break
+        shutil.rmtree(f"{root}/{name}", ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,190 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import functools
+import hashlib
+import netCDF4
+import os
+from analysis_code import read_electricity_network
+
+# Bump when the layout of the summary file changes so old files are rebuilt
+SUMMARY_VERSION = 2
+
+
+def summary_path(RUN_NAME):
+    return f"TEMP_OUTPUTS/{RUN_NAME}/network_summary.nc"
+
+
+def file_hash(path, block_size=2**24):
+    # SHA-256 of a file, read in blocks so large networks are not held in memory
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(source):
+    # Size, mtime and hash of a network file, stamped on the caches built from it
+    stat = os.stat(source)
+    return {
+        "source_size": stat.st_size,
+        "source_mtime_ns": str(stat.st_mtime_ns),
+        "source_sha256": file_hash(source),
+    }
+
+
+def check_fingerprint(fingerprint, source):
+    """
+    Check whether a cache stamped with 'fingerprint' was built from the
+    current 'source'. The cheap size/mtime stamp is checked first; the file
+    hash is only computed when the stamp differs, e.g. after the network was
+    copied or touched.
+
+    :return: (whether the content is the same, the size/mtime stamp to record
+             in place of the old one, or None if it is still current)
+    """
+    stat = os.stat(source)
+    stamp = {"source_size": stat.st_size, "source_mtime_ns": str(stat.st_mtime_ns)}
+    if (
+        fingerprint.get("source_size") == stamp["source_size"]
+        and fingerprint.get("source_mtime_ns") == stamp["source_mtime_ns"]
+    ):
+        return True, None
+    if fingerprint.get("source_sha256") != file_hash(source):
+        return False, None
+    return True, stamp
+
+
+def write_summary(data, source, path, frequency):
+    """
+    Write the output of read_electricity_network as a compact float32 summary,
+    stamped with the size, mtime and hash of the source network file.
+    """
+    generation = data["generation_by_carrier"]
+    summary = xr.Dataset(
+        {
+            "mean_hourly_price": ("time", data["mean_hourly_price"].values),
+            "total_demand": ("time", data["total_demand"].values),
+            "generation_by_carrier": (("time", "carrier"), generation.values),
+            "generator_carrier": ("generator", data["carriers"]),
+            "price_envelope": (("time", "percentile"), data["price_envelope"]),
+        },
+        coords={
+            "time": pd.DatetimeIndex(data["time"]),
+            "carrier": generation.columns.values.astype(str),
+            "percentile": read_electricity_network.ENVELOPE_PERCENTILES,
+        },
+    )
+    for name in [
+        "mean_hourly_price",
+        "total_demand",
+        "generation_by_carrier",
+        "price_envelope",
+    ]:
+        summary[name] = summary[name].astype("float32")
+
+    summary.attrs = {
+        "source": source,
+        **source_fingerprint(source),
+        "frequency": frequency,
+        "summary_version": SUMMARY_VERSION,
+    }
+
+    # Write to a temporary file first so a crash never leaves a truncated summary
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    summary.to_netcdf(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def is_current(path, source, frequency):
+    """
+    Check whether the summary at 'path' was built from the current 'source',
+    with check_fingerprint. If only the stamp changed, the new stamp is
+    recorded so the file is not hashed again.
+    """
+    if not os.path.exists(path):
+        return False
+    with xr.open_dataset(path) as summary:
+        attrs = dict(summary.attrs)
+    if (
+        attrs.get("summary_version") != SUMMARY_VERSION
+        or attrs.get("frequency") != frequency
+    ):
+        return False
+    current, stamp = check_fingerprint(attrs, source)
+    if stamp:
+        # Same content under a new stamp: record the stamp in place
+        with netCDF4.Dataset(path, "a") as summary:
+            for name, value in stamp.items():
+                summary.setncattr(name, value)
+    return current
+
+
+def load_summary(RUN_NAME, frequency, source=None):
+    """
+    Return the network data of a run in the same form as read_electricity_network.
+    The summary is read from TEMP_OUTPUTS/{RUN_NAME}/network_summary.nc, and is
+    (re)built from the network file first if it is missing or out of date.
+
+    :param RUN_NAME: run name, used for the default source DATA/{RUN_NAME}.nc
+    :param frequency: time step of the snapshots, e.g. '1H'
+    :param source: path of the network file, if not the default
+    :return: dict with keys: time, mean_hourly_price, prices, carriers,
+             total_demand, generation_by_carrier, price_envelope; 'prices'
+             opens the per-bus prices of the network file only when called,
+             see read_electricity_network.open_prices
+    """
+    source = source or f"DATA/{RUN_NAME}.nc"
+    path = summary_path(RUN_NAME)
+    if not is_current(path, source, frequency):
+        data = read_electricity_network.read_electricity_network(source, frequency)
+        write_summary(data, source, path, frequency)
+
+    with xr.open_dataset(path) as summary:
+        summary = summary.load()
+    time = pd.DatetimeIndex(summary["time"].values)
+    generation_by_carrier = pd.DataFrame(
+        summary["generation_by_carrier"].values.astype("float64"),
+        index=time,
+        columns=summary["carrier"].values.astype(str),
+    )
+
+    return {
+        "time": time.to_pydatetime().tolist(),
+        # Widen back to float64 so thresholds are computed at full precision
+        "mean_hourly_price": summary["mean_hourly_price"].astype("float64"),
+        # The per-bus prices stay in the network file, which is only opened
+        # (and closed again) by callers that need them
+        "prices": functools.partial(read_electricity_network.open_prices, source),
+        "carriers": summary["generator_carrier"].values.astype(str),
+        "total_demand": summary["total_demand"].astype("float64"),
+        "generation_by_carrier": generation_by_carrier,
+        "price_envelope": summary["price_envelope"].values.astype("float64"),
+    }
+
+
+def load_summaries(runs):
+    """
+    Load the summaries of many runs into one Dataset with a 'run' dimension,
+    for cross-run work. Runs with coarser granularity are NaN between their
+    snapshots on the common time axis.
+
+    :param runs: iterable of (RUN_NAME, frequency) pairs
+    :return: xarray Dataset with dims (run, time, carrier)
+    """
+    runs = list(runs)
+    summaries = []
+    for RUN_NAME, frequency in runs:
+        # Make sure each summary exists and is up to date before reading it
+        load_summary(RUN_NAME, frequency)
+        with xr.open_dataset(summary_path(RUN_NAME)) as summary:
+            summaries.append(summary.drop_vars("generator_carrier").load())
+    names = [RUN_NAME for RUN_NAME, _ in runs]
+    return xr.concat(
+        summaries,
+        dim=pd.Index(names, name="run"),
+        join="outer",
+        combine_attrs="drop",
+        fill_value=np.nan,
+    )
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from analysis_code import network_summary
+
+# Selection strategies understood by select_hours
+STRATEGIES = ["std", "percentile", "top_k", "rolling"]
+
+
+def select_hours(values, strategy="std", n_std=1, percentile=95, top_k=100, window=24):
+    """
+    Select high-price snapshots from a price series.
+
+    :param values: 1D array of prices, one per snapshot
+    :param strategy: 'std' (price >= mean + n_std * std),
+                     'percentile' (price >= the given percentile),
+                     'top_k' (the top_k highest prices) or
+                     'rolling' (centred rolling mean over 'window' snapshots
+                     >= its mean + n_std * std)
+    :return: (threshold, sorted array of selected snapshot indices)
+    """
+    values = np.asarray(values, dtype=float)
+
+    if strategy == "std":
+        threshold = values.mean() + n_std * values.std()
+        mask = values >= threshold
+    elif strategy == "percentile":
+        threshold = np.percentile(values, percentile)
+        mask = values >= threshold
+    elif strategy == "top_k":
+        if top_k < 1:
+            raise ValueError(f"top_k must be at least 1, got {top_k}")
+        # argpartition finds the k largest without sorting the whole series;
+        # a short (e.g. coarse) series may have fewer than top_k snapshots
+        top_k = min(top_k, len(values))
+        top = np.argpartition(values, -top_k)[-top_k:]
+        threshold = values[top].min()
+        mask = np.zeros(len(values), dtype=bool)
+        mask[top] = True
+    elif strategy == "rolling":
+        smoothed = (
+            pd.Series(values).rolling(window, center=True, min_periods=1).mean()
+        ).values
+        threshold = smoothed.mean() + n_std * smoothed.std()
+        mask = smoothed >= threshold
+    else:
+        raise ValueError(f"Unknown strategy '{strategy}', expected one of {STRATEGIES}")
+
+    return threshold, np.flatnonzero(mask)
+
+
+def find_episodes(indices, values, time):
+    """
+    Merge selected snapshots into episodes of consecutive snapshots using
+    run-length encoding of the selection mask.
+
+    :param indices: selected snapshot indices, e.g. from select_hours
+    :param values: 1D array of prices, one per snapshot
+    :param time: timestamps of the snapshots (regularly spaced)
+    :return: DataFrame with one row per episode: Start, End, Peak Time,
+             Peak Price (USD), Snapshots, Duration (hours)
+    """
+    values = np.asarray(values, dtype=float)
+    time = pd.DatetimeIndex(time)
+    mask = np.zeros(len(values), dtype=np.int8)
+    mask[indices] = 1
+
+    # +1 where an episode starts, -1 one past where it ends
+    edges = np.diff(np.concatenate([[0], mask, [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    # Peak of each episode: order selected snapshots by (episode, -price) and
+    # take the first snapshot of every episode
+    positions = np.flatnonzero(mask)
+    episode = np.searchsorted(starts, positions, side="right") - 1
+    order = np.lexsort((-values[positions], episode))
+    first = np.concatenate([[0], np.flatnonzero(np.diff(episode[order])) + 1])
+    peaks = positions[order][first] if len(positions) else positions
+
+    step = time[1] - time[0] if len(time) > 1 else pd.Timedelta(hours=1)
+    return pd.DataFrame(
+        {
+            "Start": time[starts],
+            "End": time[ends - 1],
+            "Peak Time": time[peaks],
+            "Peak Price (USD)": values[peaks],
+            "Snapshots": ends - starts,
+            "Duration (hours)": (ends - starts) * step / pd.Timedelta(hours=1),
+        }
+    )
+
+
+def threshold_sweep(values, thresholds):
+    """
+    Count high-price hours, their mean price and the number of episodes for
+    many thresholds at once, from one sort and cumulative sum of the series.
+
+    :param values: 1D array of prices, one per snapshot
+    :param thresholds: 1D array of price thresholds
+    :return: DataFrame indexed by threshold with columns Snapshots, Share,
+             Mean Price (USD) and Episodes
+    """
+    values = np.asarray(values, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+
+    # Number of snapshots >= each threshold and the sum of their prices
+    descending = np.sort(values)[::-1]
+    cumulative = np.cumsum(descending)
+    counts = np.searchsorted(-descending, -thresholds, side="right")
+    totals = np.where(counts > 0, cumulative[np.maximum(counts, 1) - 1], 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_price = totals / counts
+
+    # An episode starts at snapshot i for every threshold t with
+    # previous price < t <= price[i], so count those intervals for all t
+    previous = np.concatenate([[-np.inf], values[:-1]])
+    rising = previous < values
+    low = np.sort(previous[rising])
+    high = np.sort(values[rising])
+    episodes = (len(high) - np.searchsorted(high, thresholds, side="left")) - (
+        len(low) - np.searchsorted(low, thresholds, side="left")
+    )
+
+    return pd.DataFrame(
+        {
+            "Snapshots": counts,
+            "Share": counts / len(values),
+            "Mean Price (USD)": mean_price,
+            "Episodes": episodes,
+        },
+        index=pd.Index(thresholds, name="Threshold (USD)"),
+    )
+
+
+def n_std_sweep(values, n_stds):
+    """
+    Run threshold_sweep for thresholds of the form mean + n_std * std.
+    """
+    values = np.asarray(values, dtype=float)
+    n_stds = np.asarray(n_stds, dtype=float)
+    sweep = threshold_sweep(values, values.mean() + n_stds * values.std())
+    sweep.insert(0, "n_std", n_stds)
+    return sweep.reset_index()
+
+
+def sweep_runs(runs, n_stds):
+    """
+    Threshold sensitivity for many runs, read from their network summaries, so
+    no part of the pipeline has to be re-run for each n_std value.
+
+    :param runs: iterable of (RUN_NAME, frequency) pairs
+    :param n_stds: 1D array of n_std values
+    :return: DataFrame indexed by (Run, n_std)
+    """
+    sweeps = {}
+    for RUN_NAME, frequency in runs:
+        data = network_summary.load_summary(RUN_NAME, frequency)
+        sweeps[RUN_NAME] = n_std_sweep(data["mean_hourly_price"].values, n_stds)
+    sweeps = pd.concat(sweeps, names=["Run"]).reset_index(level=1, drop=True)
+    return sweeps.set_index("n_std", append=True)
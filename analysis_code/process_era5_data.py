@@ -1,7 +1,39 @@
 import xarray as xr
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import matplotlib.pyplot as plt
+from analysis_code import map_renderer
+from analysis_code import era5_composite
+from analysis_code import climatology
+from analysis_code import instrumentation
+from analysis_code import memo
+from analysis_code import significance
+
+# Units, colormaps and colour-scale limits of each plotted variable
+UNIT_MAP = {
+    "2m Temperature": "$^o$C",
+    "Mean Sea Level Pressure": "hPa",
+    "100m Wind Speed": "m s$^{-1}$",
+    "Global Horizontal Irradiance": "W m$^{-2}$",
+}
+COLOR_MAP = {
+    "2m Temperature": "bwr",
+    "Mean Sea Level Pressure": "cividis",
+    "100m Wind Speed": "viridis",
+    "Global Horizontal Irradiance": "magma",
+}
+LIMIT_MAP = {
+    "2m Temperature": (-15, 40),
+    "100m Wind Speed": (0, 20),
+    "Global Horizontal Irradiance": (50, 350),
+    "Mean Sea Level Pressure": (995, 1025),
+}
+# Colour-scale limits of the anomaly maps (composite minus climatology)
+ANOMALY_LIMIT_MAP = {
+    "2m Temperature": (-10, 10),
+    "100m Wind Speed": (-5, 5),
+    "Global Horizontal Irradiance": (-150, 150),
+    "Mean Sea Level Pressure": (-15, 15),
+}
+# Colour-scale limits of the standardized anomaly maps, in standard deviations
+STANDARDIZED_LIMITS = (-3, 3)
 
 
 def load_data(FOLDER, extension1, extension2, suffix):
@@ -33,97 +65,187 @@ def load_data(FOLDER, extension1, extension2, suffix):
     lat = data["latitude"]
     lon = data["longitude"]
 
-    # Map variable display names to computed DataArray objects, units and colormaps
+    # Map variable display names to computed DataArray objects
     label_map = {
         "2m Temperature": temperature_2m,
         "Mean Sea Level Pressure": sea_level_pressure,
         "100m Wind Speed": windspeed_100m,
         "Global Horizontal Irradiance": surface_radiation,
     }
-    unit_map = {
-        "2m Temperature": "$^o$C",
-        "Mean Sea Level Pressure": "hPa",
-        "100m Wind Speed": "m s$^{-1}$",
-        "Global Horizontal Irradiance": "W m$^{-2}$",
-    }
-    color_map = {
-        "2m Temperature": "bwr",
-        "Mean Sea Level Pressure": "cividis",
-        "100m Wind Speed": "viridis",
-        "Global Horizontal Irradiance": "magma",
-    }
-    limit_map = {
-        "2m Temperature": (-15, 40),
-        "100m Wind Speed": (0, 20),
-        "Global Horizontal Irradiance": (50, 350),
-        "Mean Sea Level Pressure": (995, 1025),
-    }
+    unit_map, color_map, limit_map = UNIT_MAP, COLOR_MAP, LIMIT_MAP
 
     return label_map, unit_map, color_map, limit_map, time, lat, lon
 
 
 def plot_dataset(variable, ds, unit_map, color_map, limit_map, FOLDER):
     # Take a time-mean across the 'valid_time' dimension so the plot shows
-    # an aggregated snapshot (average over the requested times).
-    dataset = ds.mean(dim="valid_time")
-
-    # Create a cartopy map axes using PlateCarree projection (simple lat/lon)
-    plt.figure(figsize=(12, 6))
-    ax = plt.axes(projection=ccrs.PlateCarree())  # The projection for the plot
-
-    vmin, vmax = limit_map[variable]
-
-    # Use xarray/matplotlib to plot the gridded dataset onto the map.
-    # transform=PlateCarree tells cartopy the data's coordinate system is regular lon/lat.
-    dataset.plot(
-        ax=ax,
-        transform=ccrs.PlateCarree(),
-        levels=10,  # number of contour levels / filled intervals
-        cmap=color_map[variable],
-        vmin=vmin,
-        vmax=vmax,
-        cbar_kwargs={"label": unit_map[variable]},
+    # an aggregated snapshot (average over the requested times), then draw it
+    # on the shared base map and write it to the Figures folder for the run.
+    map_renderer.render_map(
+        *map_job(variable, ds, unit_map, color_map, limit_map, FOLDER)
     )
 
-    # Add map context: coastlines, country borders and US state borders
-    ax.coastlines()
-    ax.add_feature(cfeature.BORDERS, linewidth=1)
-    ax.add_feature(cfeature.STATES, linewidth=0.5)
 
-    # Add gridlines and control which edges show the lat/lon labels
-    gl = ax.gridlines(
-        draw_labels=True, linewidth=0.5, color="gray", alpha=0.5, linestyle="--"
+def map_job(variable, ds, unit_map, color_map, limit_map, FOLDER):
+    # Arguments of map_renderer.render_map for one variable of one run. Only the
+    # time-mean is passed on, so jobs are small to send to worker processes.
+    return (
+        ds.mean(dim="valid_time"),
+        variable,
+        unit_map[variable],
+        color_map[variable],
+        limit_map[variable],
+        f"Figures/{FOLDER}/{variable}.png",
     )
-    gl.top_labels = False
-    gl.right_labels = False
 
-    # Adjust label appearance for clarity
-    gl.xlabel_style = {"size": 10, "color": "gray"}
-    gl.ylabel_style = {"size": 10, "color": "gray"}
 
-    # Finalize and write the figure to the Figures folder for the run
-    plt.title(f"{variable} ({unit_map[variable]})")
-    plt.savefig(f"Figures/{FOLDER}/{variable}.png", bbox_inches="tight")
-    plt.close()
+def map_jobs(FOLDER, extension1, extension2, suffix, variables=None):
+    # Compute the time-mean of every requested variable in one chunked pass
+    # over both streams, and build one map job per variable.
+    means = era5_composite.composite_means(
+        FOLDER, extension1, extension2, suffix, variables=variables
+    )
+    return [
+        (
+            mean,
+            variable,
+            UNIT_MAP[variable],
+            COLOR_MAP[variable],
+            LIMIT_MAP[variable],
+            f"Figures/{FOLDER}/{variable}.png",
+        )
+        for variable, mean in means.items()
+    ]
 
 
 def era5_processing(FOLDER, suffix):
-    # Load processed DataArrays and metadata then loop over each variable to plot.
+    # Plot every variable of the high-price ERA5 data, rendering in parallel.
+    # Maps drawn before from the same streams, style and code are restored from
+    # the memo; only the other variables are composited and rendered.
     extension1 = "data_stream-oper_stepType-instant.nc"
     extension2 = "data_stream-oper_stepType-accum.nc"
-    label_map, unit_map, color_map, limit_map, time, lat, lon = load_data(
-        FOLDER, extension1, extension2, suffix
-    )
-    for variable, ds in label_map.items():
-        plot_dataset(variable, ds, unit_map, color_map, limit_map, FOLDER)
+    inputs = [
+        f"TEMP_OUTPUTS/{FOLDER}/{suffix}/{extension}"
+        for extension in [extension1, extension2]
+    ]
+    keys = {
+        variable: memo.key(
+            "map",
+            [f"Figures/{FOLDER}/{variable}.png"],
+            inputs,
+            params={
+                "unit": UNIT_MAP[variable],
+                "cmap": COLOR_MAP[variable],
+                "limits": LIMIT_MAP[variable],
+            },
+            # The derived fields and the base map shape the figure as much as
+            # the functions called directly, so key on both modules whole
+            code=[era5_composite, map_renderer],
+        )
+        for variable in era5_composite.DERIVED_FIELDS
+    }
+    missing = [
+        variable
+        for variable, key in keys.items()
+        if not memo.restore(key, [f"Figures/{FOLDER}/{variable}.png"])[0]
+    ]
+    if not missing:
+        print(f"All maps of {FOLDER} reused from the memo")
+        return
+    with instrumentation.measure("composite"):
+        jobs = map_jobs(FOLDER, extension1, extension2, suffix, variables=missing)
+    # Time in the rendering processes is not counted in this process's CPU time
+    with instrumentation.measure("render"):
+        map_renderer.render_maps(jobs)
+    for variable in missing:
+        memo.store(keys[variable], "map", [f"Figures/{FOLDER}/{variable}.png"])
+
+
+def era5_processing_many(FOLDERS, suffix):
+    # As era5_processing, but for several runs at once, so the figures of all
+    # runs share one process pool and its base maps.
+    extension1 = "data_stream-oper_stepType-instant.nc"
+    extension2 = "data_stream-oper_stepType-accum.nc"
+    jobs = []
+    for FOLDER in FOLDERS:
+        jobs += map_jobs(FOLDER, extension1, extension2, suffix)
+    map_renderer.render_maps(jobs)
 
 
 def era5_processing_yearly(FOLDER, suffix):
-    # Load processed DataArrays and metadata then loop over each variable to plot.
+    # Plot every variable of the monthly-mean ERA5 data, rendering in parallel.
     extension1 = "data_stream-mnth_stepType-avgas.nc"
     extension2 = "data_stream-mnth_stepType-avgua.nc"
-    label_map, unit_map, color_map, limit_map, time, lat, lon = load_data(
-        FOLDER, extension1, extension2, suffix
-    )
-    for variable, ds in label_map.items():
-        plot_dataset(variable, ds, unit_map, color_map, limit_map, FOLDER)
+    map_renderer.render_maps(map_jobs(FOLDER, extension1, extension2, suffix))
+
+
+def era5_processing_baseline(FOLDER, YEAR):
+    # Plot the climatology of every variable for a weather year, built from
+    # the ERA5 hours held in the local cache (no separate download).
+    acc = climatology.update(YEAR)
+    means, _ = climatology.baseline(acc)
+    jobs = [
+        (
+            mean,
+            variable,
+            UNIT_MAP[variable],
+            COLOR_MAP[variable],
+            LIMIT_MAP[variable],
+            f"Figures/{FOLDER}/{variable}.png",
+        )
+        for variable, mean in means.items()
+    ]
+    map_renderer.render_maps(jobs)
+
+
+def era5_processing_anomaly(FOLDER, suffix, YEAR):
+    # Plot the high-price composite of every variable minus its climatology for
+    # the same hours of day, in physical units and in standard deviations.
+    extension1 = "data_stream-oper_stepType-instant.nc"
+    extension2 = "data_stream-oper_stepType-accum.nc"
+    acc = climatology.update(YEAR)
+    composites = era5_composite.composite_means(FOLDER, extension1, extension2, suffix)
+    streams = era5_composite.open_streams(FOLDER, extension1, extension2, suffix)
+    valid_times = streams[0]["valid_time"].values
+    for ds in streams:
+        ds.close()
+
+    jobs = []
+    for standardized in [False, True]:
+        fields = climatology.anomalies(composites, acc, valid_times, standardized)
+        for variable, field in fields.items():
+            name = f"{variable} {'standardized ' if standardized else ''}anomaly"
+            jobs.append(
+                (
+                    field,
+                    name,
+                    "$\\sigma$" if standardized else UNIT_MAP[variable],
+                    "RdBu_r",
+                    (
+                        STANDARDIZED_LIMITS
+                        if standardized
+                        else ANOMALY_LIMIT_MAP[variable]
+                    ),
+                    f"Figures/{FOLDER}/{name}.png",
+                )
+            )
+    map_renderer.render_maps(jobs)
+
+
+def era5_processing_significance(FOLDER, suffix):
+    # Plot every variable of the high-price ERA5 data with the cells that differ
+    # significantly from same-season weather stippled.
+    composites, pvalues = significance.significance(FOLDER, suffix)
+    jobs = [
+        (
+            mean,
+            variable,
+            UNIT_MAP[variable],
+            COLOR_MAP[variable],
+            LIMIT_MAP[variable],
+            f"Figures/{FOLDER}/{variable} significance.png",
+            significance.stipple_mask(pvalues[variable]),
+        )
+        for variable, mean in composites.items()
+    ]
+    map_renderer.render_maps(jobs)
@@ -0,0 +1,307 @@
+import numpy as np
+import pandas as pd
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# Statistics written by the pypsa-usa runs, one folder per run:
+# {FIGURES_ROOT}/figures_{year}/lv1.0_{granularity}_E/statistics/
+FIGURES_ROOT = "pypsa-usa_figures"
+# Parsed tables, one compressed .npz file per table and run:
+# {STATISTICS_ROOT}/{table}/{year}_{granularity}.npz
+STATISTICS_ROOT = "TEMP_OUTPUTS/pypsa_statistics"
+# Bump when the layout of the tables changes so old files are rebuilt
+STATISTICS_VERSION = 1
+# Number of runs parsed at the same time, each in its own process
+MAX_WORKERS = 4
+
+# Table name -> (CSV file, number of header rows, names of the index columns).
+# The statistics files have a second header row with the planning period.
+TABLES = {
+    "statistics": (
+        "statistics_dissaggregated.csv",
+        2,
+        ["component", "name", "bus", "carrier"],
+    ),
+    "carrier_statistics": ("statistics.csv", 2, ["component", "carrier"]),
+    "generators": ("generators.csv", 1, ["Generator"]),
+    "buses": ("buses.csv", 1, ["Bus"]),
+    "storage_units": ("storage_units.csv", 1, ["StorageUnit"]),
+    "links": ("links.csv", 1, ["Link"]),
+    "lines": ("lines.csv", 1, ["Line"]),
+    "regional_capacity": ("bar_regional_capacity.csv", 1, ["Region", "Carrier"]),
+    "regional_production": ("bar_regional_production.csv", 1, ["Region", "Carrier"]),
+}
+
+
+def statistics_directories(root=FIGURES_ROOT):
+    """
+    Find the statistics folders of all runs.
+
+    :return: list of (year, granularity, folder), e.g. (2019, '1H', ...)
+    """
+    found = []
+    pattern = re.compile(r"figures_(\d{4})/lv[\d.]+_(\w+?)_E/statistics$")
+    for directory, _, _ in os.walk(root):
+        match = pattern.search(directory.replace(os.sep, "/"))
+        if match:
+            found.append((int(match.group(1)), match.group(2), directory))
+    return sorted(found)
+
+
+def table_path(table, year, granularity):
+    return f"{STATISTICS_ROOT}/{table}/{year}_{granularity}.npz"
+
+
+def read_table(path, header_rows, index):
+    """
+    Parse one statistics CSV into a typed table. With two header rows the
+    second one (the planning period, e.g. 2050) is moved into a 'period'
+    column, so every metric is a plain float column.
+
+    :return: DataFrame indexed by the given index columns
+    """
+    if header_rows == 1:
+        table = pd.read_csv(path, index_col=list(range(len(index))))
+        table.index.names = index
+        return table
+
+    table = pd.read_csv(path, header=[0, 1], index_col=list(range(len(index))))
+    table.index.names = index
+    # One block of metric columns per period; pypsa-usa writes a single one
+    periods = table.columns.get_level_values(1).unique()
+    blocks = []
+    for period in periods:
+        block = table.xs(period, axis=1, level=1).astype("float64")
+        block.insert(0, "period", int(period))
+        blocks.append(block)
+    return pd.concat(blocks)
+
+
+def _signature(directory):
+    # Size and mtime of every CSV of a run, to tell when the tables are stale
+    return ";".join(
+        f"{name}:{os.stat(f'{directory}/{name}').st_size}:"
+        f"{os.stat(f'{directory}/{name}').st_mtime_ns}"
+        for name in sorted(os.listdir(directory))
+        if name.endswith(".csv")
+    )
+
+
+def _is_label(column):
+    return column.dtype == object or pd.api.types.is_string_dtype(column)
+
+
+def write_table(table, path, attrs):
+    # Store a table as one compressed .npz array per column. Text columns are
+    # stored as integer codes into an array of their distinct values (-1 for
+    # missing), so they load straight into categoricals and need no pickling.
+    frame = table.reset_index()
+    arrays = {}
+    for i, column in enumerate(frame.columns):
+        values = frame[column]
+        if _is_label(values):
+            codes, categories = pd.factorize(values)
+            arrays[f"column{i}"] = codes.astype("int32")
+            arrays[f"categories{i}"] = np.asarray(categories, dtype=str)
+        else:
+            arrays[f"column{i}"] = values.values
+    meta = {
+        **attrs,
+        "index": list(table.index.names),
+        "columns": list(frame.columns),
+    }
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    # Write to a temporary file first so a crash never leaves a truncated table
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def _stamp_path(year, granularity):
+    return f"{STATISTICS_ROOT}/stamps/{year}_{granularity}.json"
+
+
+def is_current(year, granularity, directory):
+    # Whether the stored tables of a run were built from its current CSVs
+    path = _stamp_path(year, granularity)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        stamp = json.load(f)
+    return stamp == {
+        "source_signature": _signature(directory),
+        "statistics_version": STATISTICS_VERSION,
+    }
+
+
+def ingest_run(year, granularity, directory):
+    """
+    Parse every statistics CSV of one run and store the tables.
+
+    :return: number of tables written
+    """
+    signature = _signature(directory)
+    written = 0
+    for table, (name, header_rows, index) in TABLES.items():
+        source = f"{directory}/{name}"
+        if not os.path.exists(source):
+            continue
+        attrs = {"year": year, "granularity": granularity, "source": source}
+        write_table(
+            read_table(source, header_rows, index),
+            table_path(table, year, granularity),
+            attrs,
+        )
+        written += 1
+
+    # Stamp the run last, so an interrupted run is parsed again next time
+    stamp = {"source_signature": signature, "statistics_version": STATISTICS_VERSION}
+    os.makedirs(os.path.dirname(_stamp_path(year, granularity)), exist_ok=True)
+    with open(_stamp_path(year, granularity), "w") as f:
+        json.dump(stamp, f)
+    return written
+
+
+def ingest(root=FIGURES_ROOT, max_workers=MAX_WORKERS, force=False):
+    """
+    Parse the statistics CSVs of all runs under root in a process pool and
+    store them as binary tables in STATISTICS_ROOT. Runs whose CSVs have not
+    changed since they were last stored are not parsed again.
+    """
+    runs = statistics_directories(root)
+    if not runs:
+        raise FileNotFoundError(f"No statistics folders found under '{root}'")
+    stale = [run for run in runs if force or not is_current(*run)]
+    if max_workers == 1 or len(stale) <= 1:
+        written = [ingest_run(*run) for run in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(stale))) as pool:
+            written = list(pool.map(ingest_run, *zip(*stale)))
+    print(
+        f"Stored {sum(written)} statistics tables of {len(stale)} runs "
+        f"({len(runs) - len(stale)} up to date)"
+    )
+
+
+def _read_stored(path):
+    # Stored table back as a DataFrame, text columns as categoricals
+    with np.load(path) as saved:
+        meta = json.loads(str(saved["meta"]))
+        columns = {}
+        for i, column in enumerate(meta["columns"]):
+            values = saved[f"column{i}"]
+            if f"categories{i}" in saved:
+                values = pd.Categorical.from_codes(values, saved[f"categories{i}"])
+            columns[column] = values
+    frame = pd.DataFrame(columns)
+    frame.insert(0, "granularity", meta["granularity"])
+    frame.insert(0, "year", meta["year"])
+    return frame.set_index(["year", "granularity"] + meta["index"])
+
+
+def load(table, year=None, granularity=None, **selection):
+    """
+    Read a stored table for some or all runs. Text columns are categorical,
+    so tables of many runs stay small.
+
+    :param table: name from TABLES, e.g. 'statistics' or 'generators'
+    :param year, granularity: value or list of values to keep
+    :param selection: values of other index levels to keep, e.g.
+                      component='Generator' or carrier=['Solar', 'Onshore Wind']
+    :return: DataFrame indexed by (year, granularity, *index columns of the CSV);
+             'statistics' is indexed by (year, granularity, component, name,
+             bus, carrier)
+    """
+    parts = []
+    directory = f"{STATISTICS_ROOT}/{table}"
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".npz"):
+                continue
+            run_year, run_granularity = name[: -len(".npz")].split("_", 1)
+            if not _wanted(int(run_year), year) or not _wanted(
+                run_granularity, granularity
+            ):
+                continue
+            parts.append(_read_stored(f"{directory}/{name}"))
+    if not parts:
+        raise KeyError(f"No stored '{table}' tables match the selection")
+
+    frame = pd.concat(parts)
+    for level, wanted in selection.items():
+        if level in frame.index.names:
+            values = frame.index.get_level_values(level)
+        else:
+            values = frame[level]
+        frame = frame[np.asarray(values.isin(np.atleast_1d(wanted)))]
+    # Categories differ between runs, so concat falls back to plain strings
+    for column in frame.columns:
+        if _is_label(frame[column]):
+            frame[column] = frame[column].astype("category")
+    return frame
+
+
+def _wanted(value, wanted):
+    if wanted is None:
+        return True
+    return value in np.atleast_1d(wanted)
+
+
+def carrier_statistics(component="Generator", year=None, granularity=None):
+    """
+    Capacity, supply, curtailment, capacity factor and market value of every
+    carrier of every run, aggregated from the per-bus statistics. The capacity
+    factor is weighted by the optimal capacity and the market value is the
+    revenue per unit of supply.
+
+    :return: DataFrame indexed by (year, granularity, carrier)
+    """
+    stats = load("statistics", year, granularity, component=component)
+    stats = stats.assign(
+        weighted_factor=stats["Capacity Factor"] * stats["Optimal Capacity"]
+    )
+    grouped = stats.groupby(level=["year", "granularity", "carrier"], observed=True)
+    totals = grouped[
+        ["Optimal Capacity", "Supply", "Curtailment", "Revenue", "weighted_factor"]
+    ].sum(min_count=1)
+    totals["Capacity Factor"] = totals["weighted_factor"] / totals["Optimal Capacity"]
+    totals["Market Value"] = totals["Revenue"] / totals["Supply"]
+    return totals.drop(columns="weighted_factor")
+
+
+def event_statistics(
+    name="fully_renewable-WY{weather_year}_{granularity}",
+    component="Generator",
+    year=None,
+    granularity=None,
+):
+    """
+    Join the carrier statistics of every run with its high-price events from
+    TEMP_OUTPUTS/{RUN_NAME}/highest_hours.csv: the number of high-price hours
+    and their mean price. Runs without a highest_hours.csv are left out.
+
+    :param name: run name template, as the [runs] name in config.toml
+    :return: DataFrame indexed by (year, granularity, carrier)
+    """
+    carriers = carrier_statistics(component, year, granularity)
+    events = {}
+    for run_year, run_granularity in carriers.index.droplevel("carrier").unique():
+        RUN_NAME = name.format(weather_year=run_year, granularity=run_granularity)
+        path = f"TEMP_OUTPUTS/{RUN_NAME}/highest_hours.csv"
+        if not os.path.exists(path):
+            continue
+        highest = pd.read_csv(path)
+        events[(run_year, run_granularity)] = {
+            "run": RUN_NAME,
+            "Event Hours": len(highest),
+            "Mean Event Price (USD)": highest["Mean Hourly Price (USD)"].mean(),
+        }
+    if not events:
+        raise FileNotFoundError("No highest_hours.csv found for the stored runs")
+    events = pd.DataFrame.from_dict(events, orient="index")
+    events.index.names = ["year", "granularity"]
+    return carriers.join(events, how="inner")
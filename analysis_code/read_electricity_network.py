@@ -1,30 +1,20 @@
 import xarray as xr
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
+from time import perf_counter
+import contextlib
 import datetime as dt
+import functools
 import numpy as np
 import pandas as pd
 import os
-import sys
-
-# Sort which technologies to include in the "demand-net-renewables" calculation
-renewable_map = {
-    "CCGT": False,
-    "CCGT-95CCS": False,
-    "OCGT": False,
-    "biomass": True,
-    "coal": False,
-    "geothermal": True,
-    "hydro": True,
-    "hydrogen_ct": False,
-    "nuclear": False,
-    "offwind": True,
-    "offwind_floating": True,
-    "oil": False,
-    "onwind": True,
-    "solar": True,
-    "waste": False,
-}
+import zlib
+from analysis_code import instrumentation
+from analysis_code import memo
+from analysis_code import network_summary
+from analysis_code import price_events
+from analysis_code import residual_load
 
 # Hardcode unique colours for plotting generation from each technology
 color_map = {
@@ -44,59 +34,189 @@ color_map = {
     "solar": "#FFA500",  # orange — sunlight
     "waste": "#8B4513",  # brown — waste/organic refuse
 }
+# Colours cycled through for carriers without one in color_map
+FALLBACK_COLORS = plt.cm.tab20.colors
+
+
+def carrier_color(carrier):
+    # Colour of a carrier; carriers missing from color_map get a fixed colour
+    # derived from their name, so they keep it across runs and plots
+    if carrier in color_map:
+        return color_map[carrier]
+    return FALLBACK_COLORS[zlib.crc32(str(carrier).encode()) % len(FALLBACK_COLORS)]
+
+
+# Number of snapshots read from the network file at a time. Peak memory of the
+# reader scales with this block size rather than with the length of the run.
+CHUNK_SIZE = 720
+
+# Percentiles across buses kept per snapshot for the hourly price envelope
+ENVELOPE_PERCENTILES = [0, 5, 50, 95, 100]
+
+
+def carrier_indicator(carriers):
+    """
+    Build a generator -> carrier indicator matrix, so that per-carrier
+    generation is a single matrix product: generation @ indicator.
+
+    :param carriers: carrier name for each generator
+    :return: (sorted unique carrier names, float array of shape (generators, carriers))
+    """
+    carrier_names, codes = np.unique(carriers, return_inverse=True)
+    indicator = np.zeros((len(carriers), len(carrier_names)))
+    indicator[np.arange(len(carriers)), codes] = 1.0
+    return carrier_names, indicator
+
+
+@contextlib.contextmanager
+def open_prices(file_path):
+    """
+    Per-bus prices of a network file (snapshots x buses), left on disk until
+    read. The file is closed again when the block exits:
+
+        with data["prices"]() as prices:
+            ...
 
+    :param file_path: Path to the NetCDF file.
+    """
+    with xr.open_dataset(file_path) as ds:
+        yield ds["buses_t_marginal_price"].transpose("snapshots", ...)
 
-def read_electricity_network(file_path, frequency):
+
+def read_electricity_network(file_path, frequency, chunk_size=CHUNK_SIZE):
     """Reads the electricity network data from a NetCDF file.
 
+    Snapshots are streamed in blocks of chunk_size, and the bus-mean price,
+    total load and per-carrier generation are all accumulated in the same pass.
+
     :param file_path: Path to the NetCDF file.
+    :param frequency: Time step of the snapshots, e.g. '1H'.
+    :param chunk_size: Number of snapshots read at a time.
     :return: dict with keys: time, mean_hourly_price, prices, carriers,
-             total_demand, generation_by_carrier
+             total_demand, generation_by_carrier, price_envelope; 'prices'
+             opens the per-bus prices, see open_prices
     """
-    # Open the dataset with xarray (lazy loading by default)
+    # Open the dataset with xarray (lazy loading by default); closed once read
     ds = xr.open_dataset(file_path)
 
-    # Load the marginal price data (time x buses)
-    prices = ds["buses_t_marginal_price"]
+    # Marginal price data (time x buses), left on disk until it is read block by block
+    prices = ds["buses_t_marginal_price"].transpose("snapshots", ...)
+    demand_p = ds["loads_t_p_set"].transpose("snapshots", ...)
+    generation_p = ds["generators_t_p"].transpose("snapshots", ...)
+    n_snapshots = prices.sizes["snapshots"]
 
     # Build a time index for the snapshots. The original dataset uses
     # a regular hourly frequency, so construct a cftime_range and convert.
     time = xr.cftime_range(
-        start="2050-01-01 00:00:00", periods=prices.sizes["snapshots"], freq=frequency
+        start="2050-01-01 00:00:00", periods=n_snapshots, freq=frequency
     )
     # Convert cftime objects to native Python datetimes for plotting and pandas usage
     time = cftime_to_datetime(time)
 
-    # Aggregate to get mean hourly price across all buses
-    mean_hourly_price = prices.mean(dim="buses_t_marginal_price_i")
-
-    # Load total demand: loads_t_p_set is per-load; sum across load indices to get system demand
-    demand_p = ds["loads_t_p_set"]
-    total_demand = demand_p.sum(dim="loads_t_p_set_i")
-
-    # Load generation time series per generator
-    generation_p = ds["generators_t_p"]
+    # Carrier of each generator with a time series. generators_carrier is indexed
+    # by all generators, so align it to the generators_t_p columns by id.
     gen_ids = ds["generators_t_p_i"].values.astype(str)  # generator identifiers
     carriers = ds["generators_carrier"].values.astype(str)  # carrier type per generator
-
-    # Build a pandas DataFrame indexed by time with generator columns
-    generation_df = pd.DataFrame(generation_p, index=time, columns=gen_ids)
-
-    # Create a mapping from generator id -> carrier and group by carrier to get carrier-level generation
-    gen_carrier_map = dict(zip(gen_ids, carriers))
-    generation_by_carrier = generation_df.groupby(gen_carrier_map, axis=1).sum()
-
-    # Return a compact dictionary for downstream plotting/analysis
+    if "generators_i" in ds["generators_carrier"].dims:
+        all_ids = ds["generators_i"].values.astype(str)
+        carriers = (
+            pd.Series(carriers, index=all_ids).reindex(gen_ids).values.astype(str)
+        )
+    carrier_names, indicator = carrier_indicator(carriers)
+
+    mean_hourly_price = np.empty(n_snapshots)
+    total_demand = np.empty(n_snapshots)
+    generation = np.empty((n_snapshots, len(carrier_names)))
+    price_envelope = np.empty((n_snapshots, len(ENVELOPE_PERCENTILES)))
+    for start in range(0, n_snapshots, chunk_size):
+        block = slice(start, start + chunk_size)
+        # Mean price across all buses and system demand summed across loads
+        price_block = prices[block].values
+        mean_hourly_price[block] = np.nanmean(price_block, axis=1)
+        # Spread of bus prices for the background of the hourly price plot
+        price_envelope[block] = np.nanpercentile(
+            price_block, ENVELOPE_PERCENTILES, axis=1
+        ).T
+        total_demand[block] = np.nansum(demand_p[block].values, axis=1)
+        # Carrier-level generation from the generator columns in one product
+        generation[block] = np.nan_to_num(generation_p[block].values) @ indicator
+
+    # Keep the snapshot coordinate so the series behave like the xarray reductions
+    snapshots = prices["snapshots"]
+    mean_hourly_price = xr.DataArray(mean_hourly_price, coords={"snapshots": snapshots})
+    total_demand = xr.DataArray(total_demand, coords={"snapshots": snapshots})
+    generation_by_carrier = pd.DataFrame(generation, index=time, columns=carrier_names)
+    ds.close()
+
+    # Return a compact dictionary for downstream plotting/analysis; 'prices'
+    # reopens the per-bus prices only if a plot asks for them
     return {
         "time": time,
         "mean_hourly_price": mean_hourly_price,
-        "prices": prices,
+        "prices": functools.partial(open_prices, file_path),
         "carriers": carriers,
         "total_demand": total_demand,
         "generation_by_carrier": generation_by_carrier,
+        "price_envelope": price_envelope,
     }
 
 
+def price_envelope(prices, chunk_size=CHUNK_SIZE):
+    """
+    Percentiles (ENVELOPE_PERCENTILES) of the bus prices at every snapshot,
+    read chunk_size snapshots at a time.
+
+    :param prices: (snapshots x buses) array or lazy DataArray of bus prices
+    :return: array of shape (snapshots, len(ENVELOPE_PERCENTILES))
+    """
+    envelope = np.empty((prices.shape[0], len(ENVELOPE_PERCENTILES)))
+    for start in range(0, prices.shape[0], chunk_size):
+        block = slice(start, start + chunk_size)
+        envelope[block] = np.nanpercentile(
+            np.asarray(prices[block]), ENVELOPE_PERCENTILES, axis=1
+        ).T
+    return envelope
+
+
+def lttb_indices(values, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of several series at once.
+    The buckets are shared by all series, so each step of the bucket loop is
+    vectorized across the series.
+
+    :param values: array of shape (snapshots, series)
+    :param n_out: number of points to keep per series
+    :return: int array of shape (n_out, series) with the kept snapshot indices
+    """
+    n, n_series = values.shape
+    if n_out >= n or n_out < 3:
+        return np.repeat(np.arange(n)[:, None], n_series, axis=1)
+
+    x = np.arange(n)
+    columns = np.arange(n_series)
+    # First and last points are always kept; the rest are split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty((n_out, n_series), dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        # Average of the next bucket (the last point for the final bucket)
+        next_hi = edges[b + 2] if b + 2 < len(edges) else n
+        avg_x = x[hi:next_hi].mean()
+        avg_y = values[hi:next_hi].mean(axis=0)
+        # Previously selected point of every series
+        prev_x = selected[b]
+        prev_y = values[prev_x, columns]
+        # Twice the triangle area for every candidate in the bucket
+        area = np.abs(
+            (prev_x - avg_x) * (values[lo:hi] - prev_y)
+            - (prev_x - x[lo:hi, None]) * (avg_y - prev_y)
+        )
+        selected[b + 1] = lo + np.nanargmax(np.nan_to_num(area, nan=-1), axis=0)
+    return selected
+
+
 def cftime_to_datetime(times):
     """
     Convert a sequence of cftime objects to Python datetime objects.
@@ -108,18 +228,60 @@ def cftime_to_datetime(times):
     return [dt.datetime(t.year, t.month, t.day, t.hour) for t in times]
 
 
-def plot_hourly_price(data, threshold, RUN_NAME):
+def plot_hourly_price(data, threshold, RUN_NAME, mode="envelope"):
     """
     Plot individual bus prices (light gray), mean hourly price (line),
     and a horizontal threshold line marking high-price events.
+
+    The bus prices in the background are drawn according to mode:
+    - 'envelope': min-max band of the bus prices, rasterized; looks like the
+      per-bus lines, which fill the same band (fastest, default)
+    - 'percentiles': the envelope with a 5th-95th percentile band and the
+      median on top
+    - 'lines': every bus as one rasterized LineCollection, with each series
+      downsampled by LTTB to about two points per pixel
+    - 'full': every bus drawn at every snapshot
     """
+    start_time = perf_counter()
     time = data["time"]
-    all_prices = data["prices"]
     mean_hourly_price = data["mean_hourly_price"]
 
     fig, ax = plt.subplots()
-    # Plot each bus's price time series in the background (light gray)
-    plt.plot(time, all_prices, color="lightgray")
+    if mode in ("envelope", "percentiles"):
+        # Percentile envelope from the summary if available, else from the bus prices
+        envelope = data.get("price_envelope")
+        if envelope is None:
+            with data["prices"]() as prices:
+                envelope = price_envelope(prices)
+        ax.fill_between(
+            time, envelope[:, 0], envelope[:, -1], color="lightgray", rasterized=True
+        )
+        if mode == "percentiles":
+            ax.fill_between(
+                time,
+                envelope[:, 1],
+                envelope[:, 3],
+                color="silver",
+                rasterized=True,
+                label="5th-95th Percentile of Bus Prices",
+            )
+            plt.plot(time, envelope[:, 2], color="gray", linewidth=0.5, rasterized=True)
+    elif mode == "lines":
+        # One collection of downsampled series instead of one line per bus
+        with data["prices"]() as prices:
+            all_prices = np.asarray(prices, dtype=float)
+        n_points = int(2 * fig.get_figwidth() * fig.dpi)
+        kept = lttb_indices(all_prices, n_points)
+        x = mdates.date2num(np.asarray(time))[kept]
+        y = np.take_along_axis(all_prices, kept, axis=0)
+        segments = np.stack([x.T, y.T], axis=-1)
+        ax.add_collection(LineCollection(segments, colors="lightgray", rasterized=True))
+    elif mode == "full":
+        # Plot each bus's price time series in the background (light gray)
+        with data["prices"]() as prices:
+            plt.plot(time, np.asarray(prices), color="lightgray")
+    else:
+        raise ValueError(f"Unknown mode '{mode}'")
     plt.plot(
         [], [], color="lightgray", label="Individual Hourly Bus Prices"
     )  # legend entry
@@ -155,6 +317,9 @@ def plot_hourly_price(data, threshold, RUN_NAME):
     # Save the figure to the run-specific Figures folder
     plt.savefig(f"Figures/{RUN_NAME}/hourly_prices.png")
     plt.close()
+    print(
+        f"Rendered hourly prices for {RUN_NAME} in {perf_counter() - start_time:.2f} s"
+    )
 
 
 def plot_generation(data, dates, RUN_NAME):
@@ -170,7 +335,7 @@ def plot_generation(data, dates, RUN_NAME):
         generation.index,
         generation.T,
         labels=generation.columns,
-        colors=[color_map[carrier] for carrier in generation.columns],
+        colors=[carrier_color(carrier) for carrier in generation.columns],
     )
 
     # ---- Set x-axis limits ----
@@ -199,21 +364,25 @@ def plot_generation(data, dates, RUN_NAME):
     plt.close()
 
 
-def plot_demand(data, dates, RUN_NAME):
+def plot_demand(data, dates, RUN_NAME, classes=None):
     """
     Plot total system demand and demand net renewables (total - selected renewables).
     Vertical lines indicate dates with high-price events.
+
+    :param classes: extra carrier -> class entries, e.g. the [carrier_classes]
+                    section of config.toml, see residual_load.classify
     """
     time = data["time"]
     total_demand = data["total_demand"]
     generation = data["generation_by_carrier"]
 
-    # Sum generation across carriers that are flagged as renewable in renewable_map
-    renewable_generation = generation[
-        [col for col in generation.columns if renewable_map[col]]
-    ].sum(axis=1)
-    # Compute demand net of renewable generation for comparison
-    demand_net_renewable = total_demand - renewable_generation
+    # Demand net of the generation of the renewable carrier classes
+    demand_net_renewable = residual_load.residual_load(
+        np.asarray(total_demand, dtype=float),
+        generation.values,
+        generation.columns,
+        classes=classes,
+    )
 
     fig, ax = plt.subplots()
     plt.plot(time, total_demand, label="Total Demand", color="blue")
@@ -245,50 +414,122 @@ def plot_demand(data, dates, RUN_NAME):
     plt.close()
 
 
-def find_highest_price_hours(data, n_std=1):
+def find_highest_price_hours(data, n_std=1, strategy="std", **kwargs):
     """
-    Identify hours where the mean hourly price exceeds mean + n_std * std.
+    Identify hours where the mean hourly price exceeds mean + n_std * std,
+    or another selection rule from price_events.select_hours (strategy and
+    its keyword arguments).
     Returns the threshold value and a list of (time, price) tuples for those hours.
     """
-    mean_hourly_price = data["mean_hourly_price"]
+    mean_hourly_price = np.asarray(data["mean_hourly_price"], dtype=float)
     time = data["time"]
 
-    # Compute threshold as mean plus n_std times standard deviation
-    threshold = mean_hourly_price.mean() + n_std * mean_hourly_price.std()
-    # Find indices where the mean hourly price meets/exceeds the threshold
-    top_indices = np.where(mean_hourly_price >= threshold)[0]
+    # Compute threshold and the indices where the mean hourly price meets/exceeds it
+    threshold, top_indices = price_events.select_hours(
+        mean_hourly_price, strategy, n_std=n_std, **kwargs
+    )
 
-    # Pair timestamps with numeric values (convert xarray scalar to native Python float)
-    highest_hours = [(time[i], mean_hourly_price[i].item()) for i in top_indices]
+    # Pair timestamps with numeric values as native Python floats
+    highest_hours = list(
+        zip(np.asarray(time)[top_indices], mean_hourly_price[top_indices].tolist())
+    )
     return threshold, highest_hours
 
 
-def electricity_analysis(RUN_NAME, frequency):
-    """
-    Top-level entry point for the electricity analysis.
-    Loads the specified NetCDF run, finds high-price hours, and
-    writes outputs and figures to disk.
+def write_high_price_hours(data, RUN_NAME, **selection):
     """
-    FILE = f"DATA/{RUN_NAME}.nc"
-    # Ensure the expected file exists, otherwise exit with an error message
-    if not os.path.exists(FILE):
-        print(f"Error: File '{FILE}' not found.")
-        sys.exit(1)
+    Write the high-price hours of a run to highest_hours.csv, and the episodes
+    they form to highest_episodes.csv, in TEMP_OUTPUTS/{RUN_NAME}.
 
-    # Read and preprocess the network data
-    data = read_electricity_network(FILE, frequency)
-    # Identify the threshold and the hours that exceed it
-    threshold, highest_hours = find_highest_price_hours(data)
+    :return: the price threshold
+    """
+    threshold, highest_hours = find_highest_price_hours(data, **selection)
     df = pd.DataFrame(highest_hours)
     df.columns = ["Time", "Mean Hourly Price (USD)"]
 
     # Ensure output directories exist and persist the list of high-price hours
     df.to_csv(f"TEMP_OUTPUTS/{RUN_NAME}/highest_hours.csv", index=False)
 
+    # Merge consecutive high-price hours into episodes with start, end and peak
+    episodes = price_events.find_episodes(
+        np.flatnonzero(pd.DatetimeIndex(data["time"]).isin(df["Time"])),
+        data["mean_hourly_price"],
+        data["time"],
+    )
+    episodes.to_csv(f"TEMP_OUTPUTS/{RUN_NAME}/highest_episodes.csv", index=False)
+    return float(threshold)
+
+
+def electricity_analysis(RUN_NAME, frequency, classes=None, **selection):
+    """
+    Top-level entry point for the electricity analysis.
+    Loads the specified NetCDF run, finds high-price hours, and
+    writes outputs and figures to disk.
+    Keyword arguments (strategy, n_std, percentile, ...) choose the high-price
+    hours, as in find_highest_price_hours; the [high_prices] section of
+    config.toml is passed here. classes (the [carrier_classes] section) extends
+    the carrier classes used for the demand net of renewables.
+    """
+    FILE = f"DATA/{RUN_NAME}.nc"
+    # Ensure the expected file exists, otherwise fail this run only
+    if not os.path.exists(FILE):
+        raise FileNotFoundError(f"File '{FILE}' not found.")
+
+    # Read the network data from the run's summary, rebuilt only if FILE changed
+    with instrumentation.measure("read network"):
+        data = network_summary.load_summary(RUN_NAME, frequency, FILE)
+    summary = network_summary.summary_path(RUN_NAME)
+    highest = f"TEMP_OUTPUTS/{RUN_NAME}/highest_hours.csv"
+
+    # Each step below is memoized on the summary, its parameters and its code,
+    # so e.g. a change to the colours only redraws the plots that use them
+    with instrumentation.measure("find high prices"):
+        threshold = memo.cached(
+            "find high prices",
+            [highest, f"TEMP_OUTPUTS/{RUN_NAME}/highest_episodes.csv"],
+            write_high_price_hours,
+            data,
+            RUN_NAME,
+            inputs=[summary],
+            params=selection,
+            **selection,
+        )
+
     # Extract unique dates that contain high-price hours for plotting vertical lines
+    df = pd.read_csv(highest, parse_dates=["Time"])
     dates = df["Time"].dt.strftime("%Y-%m-%d").unique().tolist()
 
     # Ensure figure directory exists and create plots
-    plot_hourly_price(data, threshold, RUN_NAME)
-    plot_generation(data, dates, RUN_NAME)
-    plot_demand(data, dates, RUN_NAME)
+    with instrumentation.measure("plot hourly price"):
+        memo.cached(
+            "plot hourly price",
+            [f"Figures/{RUN_NAME}/hourly_prices.png"],
+            plot_hourly_price,
+            data,
+            threshold,
+            RUN_NAME,
+            inputs=[summary],
+            params={"threshold": threshold},
+        )
+    with instrumentation.measure("plot generation"):
+        memo.cached(
+            "plot generation",
+            [f"Figures/{RUN_NAME}/generation_by_carrier.png"],
+            plot_generation,
+            data,
+            dates,
+            RUN_NAME,
+            inputs=[summary, highest],
+        )
+    with instrumentation.measure("plot demand"):
+        memo.cached(
+            "plot demand",
+            [f"Figures/{RUN_NAME}/total_demand.png"],
+            plot_demand,
+            data,
+            dates,
+            RUN_NAME,
+            inputs=[summary, highest],
+            params={"classes": classes},
+            classes=classes,
+        )
@@ -0,0 +1,240 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+import warnings
+from analysis_code import network_summary
+
+# Class of each pypsa-usa carrier. Carriers not listed take the class of the
+# longest listed name they start with (e.g. 'onwind_2050' -> 'wind'), or
+# 'other'. Extend it, or pass another mapping, for new carriers.
+CARRIER_CLASSES = {
+    "CCGT": "gas",
+    "CCGT-95CCS": "gas",
+    "OCGT": "gas",
+    "biomass": "bioenergy",
+    "coal": "coal",
+    "geothermal": "geothermal",
+    "hydro": "hydro",
+    "hydrogen_ct": "hydrogen",
+    "nuclear": "nuclear",
+    "offwind": "wind",
+    "offwind_floating": "wind",
+    "oil": "oil",
+    "onwind": "wind",
+    "solar": "solar",
+    "waste": "waste",
+}
+# Classes subtracted from demand for the residual load
+RENEWABLE_CLASSES = ["bioenergy", "geothermal", "hydro", "wind", "solar"]
+# Classes whose shortfall makes a renewable drought
+VARIABLE_CLASSES = ["wind", "solar"]
+# Horizons of the residual-load ramps, in hours
+RAMP_HOURS = [1, 3, 6, 24]
+# A drought is variable renewable output below DROUGHT_FRACTION of its mean
+# for at least DROUGHT_HOURS consecutive hours
+DROUGHT_FRACTION = 0.2
+DROUGHT_HOURS = 24
+
+OUTPUT = "TEMP_OUTPUTS/residual_load.nc"
+DROUGHTS = "TEMP_OUTPUTS/renewable_droughts.csv"
+
+
+def classify(carriers, classes=None, default="other"):
+    """
+    Class of every carrier: an exact match in classes, else the longest
+    listed carrier name it starts with, else default.
+
+    :param classes: carrier -> class; entries update CARRIER_CLASSES
+    :return: array of class names
+    """
+    classes = {**CARRIER_CLASSES, **(classes or {})}
+    # Longest names first, so 'offwind_floating' wins over 'offwind'
+    prefixes = sorted(classes, key=len, reverse=True)
+    result = []
+    for carrier in carriers:
+        carrier = str(carrier)
+        if carrier in classes:
+            result.append(classes[carrier])
+        else:
+            match = next((p for p in prefixes if carrier.startswith(p)), None)
+            result.append(classes[match] if match else default)
+    return np.array(result)
+
+
+def class_weights(carriers, members, classes=None):
+    # 1 for carriers in one of the given classes, else 0, so summing them is
+    # one matrix product with the generation
+    return np.isin(classify(carriers, classes), members).astype(float)
+
+
+def residual_load(
+    demand, generation, carriers, renewable=RENEWABLE_CLASSES, classes=None
+):
+    """
+    Demand net of renewable generation.
+
+    :param demand: array of shape (..., time)
+    :param generation: array of shape (..., time, carrier)
+    :param carriers: carrier names of the last axis of generation
+    :return: array of shape (..., time)
+    """
+    weights = class_weights(carriers, renewable, classes)
+    return demand - np.nan_to_num(generation) @ weights
+
+
+def ramps(values, hours=RAMP_HOURS):
+    """
+    Change of an hourly series over each horizon, ending at each hour; NaN
+    where either end is missing (e.g. between the snapshots of a 3H run).
+
+    :param values: array of shape (..., time) on an hourly axis
+    :return: array of shape (len(hours), ..., time)
+    """
+    result = np.full((len(hours),) + values.shape, np.nan)
+    for i, h in enumerate(hours):
+        result[i, ..., h:] = values[..., h:] - values[..., :-h]
+    return result
+
+
+def duration_curve(values):
+    """
+    Values sorted from highest to lowest along the last axis, with missing
+    values at the end: one sort for all runs at once.
+    """
+    return -np.sort(-values, axis=-1)
+
+
+def hold(values, steps):
+    """
+    Hold each snapshot of coarse runs for the hours it stands for, so every
+    run has a value at every hour of its period.
+
+    :param values: array of shape (run, time) on an hourly axis
+    :param steps: hours per snapshot of each run
+    """
+    hours = np.arange(values.shape[-1])
+    # Position of the last snapshot at or before each hour, per run
+    last = np.where(~np.isnan(values), hours, -1)
+    last = np.maximum.accumulate(last, axis=-1)
+    held = np.take_along_axis(values, np.maximum(last, 0), axis=-1)
+    expired = (last < 0) | (hours - last >= np.asarray(steps)[:, None])
+    return np.where(expired, np.nan, held)
+
+
+def droughts(available, fraction=DROUGHT_FRACTION, min_hours=DROUGHT_HOURS):
+    """
+    Periods with output below fraction of its mean for at least min_hours,
+    found for all runs at once by run-length encoding the shortfall mask.
+
+    :param available: array of shape (run, time) on an hourly axis
+    :return: (run index, start hour, end hour) arrays; end is exclusive
+    """
+    mean = np.nanmean(available, axis=-1, keepdims=True)
+    # NaN compares False, so missing hours end a drought
+    short = (available < fraction * mean).astype(np.int8)
+    edges = np.diff(np.pad(short, ((0, 0), (1, 1))), axis=-1)
+    run, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    long = end - start >= min_hours
+    return run[long], start[long], end[long]
+
+
+def residual_analysis(
+    runs,
+    classes=None,
+    renewable=RENEWABLE_CLASSES,
+    variable=VARIABLE_CLASSES,
+    ramp_hours=RAMP_HOURS,
+    drought_fraction=DROUGHT_FRACTION,
+    drought_hours=DROUGHT_HOURS,
+):
+    """
+    Residual load, ramps, duration curves and renewable droughts of many runs
+    in one vectorized pass over their network summaries.
+
+    :param runs: iterable of (RUN_NAME, frequency) pairs
+    :param classes: carrier -> class entries that update CARRIER_CLASSES
+    :param renewable: classes subtracted from demand for the residual load
+    :param variable: classes whose output defines a renewable drought
+    :return: (Dataset with dims run, time, ramp_hours and rank;
+              DataFrame with one row per drought)
+    """
+    runs = list(runs)
+    summaries = network_summary.load_summaries(runs)
+    # Common hourly axis; coarser runs are NaN between their snapshots
+    time = pd.date_range(
+        summaries["time"].values[0], summaries["time"].values[-1], freq="h"
+    )
+    summaries = summaries.reindex(time=time)
+    carriers = summaries["carrier"].values.astype(str)
+    demand = summaries["total_demand"].values.astype(np.float64)
+    generation = summaries["generation_by_carrier"].values.astype(np.float64)
+    price = summaries["mean_hourly_price"].values.astype(np.float64)
+    steps = [
+        pd.Timedelta(frequency.lower()) // pd.Timedelta("1h") for _, frequency in runs
+    ]
+
+    residual = residual_load(demand, generation, carriers, renewable, classes)
+    ramp = ramps(residual, ramp_hours)
+    with warnings.catch_warnings():
+        # Runs coarser than a ramp horizon have no ramps over it (all NaN)
+        warnings.simplefilter("ignore", RuntimeWarning)
+        max_up = np.nanmax(ramp, axis=-1).T
+        max_down = np.nanmin(ramp, axis=-1).T
+    variable_output = np.nan_to_num(generation) @ class_weights(
+        carriers, variable, classes
+    )
+    variable_output = np.where(np.isnan(demand), np.nan, variable_output)
+
+    ds = xr.Dataset(
+        {
+            "residual_load": (("run", "time"), residual),
+            "variable_renewable": (("run", "time"), variable_output),
+            "ramp": (("ramp_hours", "run", "time"), ramp),
+            "max_ramp_up": (("run", "ramp_hours"), max_up),
+            "max_ramp_down": (("run", "ramp_hours"), max_down),
+            "load_duration": (("run", "rank"), duration_curve(demand)),
+            "residual_load_duration": (("run", "rank"), duration_curve(residual)),
+            "price_duration": (("run", "rank"), duration_curve(price)),
+            "snapshots": ("run", (~np.isnan(demand)).sum(axis=-1)),
+        },
+        coords={
+            "run": [RUN_NAME for RUN_NAME, _ in runs],
+            "time": time,
+            "ramp_hours": ramp_hours,
+            "rank": np.arange(len(time)),
+        },
+    )
+
+    # Coarse runs hold each snapshot for its hours before looking for droughts
+    held = hold(variable_output, steps)
+    run, start, end = droughts(held, drought_fraction, drought_hours)
+    held_residual = hold(residual, steps)
+    drought_table = pd.DataFrame(
+        {
+            "Run": ds["run"].values[run],
+            "Start": time[start],
+            "End": time[end - 1],
+            "Duration (hours)": end - start,
+            "Mean Residual Load (MW)": [
+                np.nanmean(held_residual[r, s:e]) for r, s, e in zip(run, start, end)
+            ],
+        }
+    )
+    return ds, drought_table
+
+
+def residual_load_analysis(runs, classes=None, **kwargs):
+    """
+    Run residual_analysis for many runs and write the Dataset to
+    TEMP_OUTPUTS/residual_load.nc and the droughts to
+    TEMP_OUTPUTS/renewable_droughts.csv.
+    """
+    ds, drought_table = residual_analysis(runs, classes, **kwargs)
+    os.makedirs(os.path.dirname(OUTPUT), exist_ok=True)
+    encoding = {name: {"zlib": True} for name in ds.data_vars}
+    ds.astype("float32").to_netcdf(OUTPUT + ".tmp", encoding=encoding)
+    os.replace(OUTPUT + ".tmp", OUTPUT)
+    drought_table.to_csv(DROUGHTS, index=False)
+    print(f"Found {len(drought_table)} renewable droughts in {ds.sizes['run']} runs")
@@ -0,0 +1,175 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+from analysis_code import era5_composite
+from analysis_code import network_summary
+
+# One NetCDF file per run, chunked along time; together they form the cube
+# (weather_year, granularity, time, carrier/variable). The catalog is read
+# from the attributes of these files, so runs can be added concurrently.
+CUBE_ROOT = "TEMP_OUTPUTS/run_cube"
+# Snapshots per chunk along time; queries read whole chunks only
+TIME_CHUNK = 720
+
+
+def cube_path(RUN_NAME):
+    return f"{CUBE_ROOT}/{RUN_NAME}.nc"
+
+
+def add_run(RUN_NAME, WEATHER_YEAR, GRANULARITY, suffix=None):
+    """
+    Add (or replace) one run in the cube: its network summary, the high-price
+    flag of every snapshot and, if the run's ERA5 data are present, the
+    composite of each ERA5 field.
+
+    :param RUN_NAME: run name, e.g. 'fully_renewable-WY2019_1H'
+    :param WEATHER_YEAR: weather year of the run, e.g. 2019
+    :param GRANULARITY: time granularity of the run, e.g. '1H'
+    :param suffix: ERA5 data folder of the run, e.g. 'era5_data_high-prices'
+    """
+    data = network_summary.load_summary(RUN_NAME, GRANULARITY)
+    with xr.open_dataset(network_summary.summary_path(RUN_NAME)) as summary:
+        run = summary.drop_vars("generator_carrier").load()
+
+    # Event flags from the high-price hours of the electricity analysis
+    highest = pd.read_csv(f"TEMP_OUTPUTS/{RUN_NAME}/highest_hours.csv")
+    time = pd.DatetimeIndex(data["time"])
+    run["high_price"] = ("time", time.isin(pd.to_datetime(highest["Time"])))
+
+    extension1 = "data_stream-oper_stepType-instant.nc"
+    extension2 = "data_stream-oper_stepType-accum.nc"
+    if suffix and os.path.exists(f"TEMP_OUTPUTS/{RUN_NAME}/{suffix}/{extension1}"):
+        composites = era5_composite.composite_means(
+            RUN_NAME, extension1, extension2, suffix
+        )
+        run["era5_composite"] = xr.concat(
+            list(composites.values()), dim=pd.Index(list(composites), name="variable")
+        ).astype("float32")
+
+    run.attrs = {
+        "run": RUN_NAME,
+        "weather_year": int(WEATHER_YEAR),
+        "granularity": GRANULARITY,
+    }
+    encoding = {
+        name: {
+            "zlib": True,
+            "chunksizes": tuple(
+                min(TIME_CHUNK, size) if dim == "time" else size
+                for dim, size in run[name].sizes.items()
+            ),
+        }
+        for name in run.data_vars
+        if "time" in run[name].dims
+    }
+    # Write to a temporary file first so a crash never leaves a truncated run
+    os.makedirs(CUBE_ROOT, exist_ok=True)
+    run.to_netcdf(cube_path(RUN_NAME) + ".tmp", encoding=encoding)
+    os.replace(cube_path(RUN_NAME) + ".tmp", cube_path(RUN_NAME))
+
+
+def catalog():
+    """
+    List the runs in the cube.
+
+    :return: DataFrame indexed by run with columns weather_year, granularity, path
+    """
+    rows = []
+    if os.path.isdir(CUBE_ROOT):
+        for name in sorted(os.listdir(CUBE_ROOT)):
+            if not name.endswith(".nc"):
+                continue
+            with xr.open_dataset(f"{CUBE_ROOT}/{name}") as ds:
+                rows.append({**ds.attrs, "path": f"{CUBE_ROOT}/{name}"})
+    columns = ["run", "weather_year", "granularity", "path"]
+    return pd.DataFrame(rows, columns=columns).set_index("run")
+
+
+def _runs(weather_year=None, granularity=None):
+    # Catalog rows matching the given weather year(s) and granularity(ies)
+    runs = catalog()
+    for column, wanted in [
+        ("weather_year", weather_year),
+        ("granularity", granularity),
+    ]:
+        if wanted is not None:
+            wanted = wanted if isinstance(wanted, (list, tuple)) else [wanted]
+            runs = runs[runs[column].isin(wanted)]
+    return runs
+
+
+def select(
+    variable, weather_year=None, granularity=None, events_only=False, **indexers
+):
+    """
+    Read one variable for all matching runs. Runs are opened lazily and only
+    the selected part of each is read, so e.g. a few carriers or a month of
+    snapshots never load the whole cube.
+
+    :param variable: e.g. 'mean_hourly_price', 'generation_by_carrier',
+                     'high_price' or 'era5_composite'
+    :param weather_year, granularity: value or list of values to keep
+    :param events_only: keep only the high-price snapshots of each run
+    :param indexers: label selections passed to .sel, e.g. carrier=['solar']
+    :return: DataArray with dims (weather_year, granularity, ...); runs with
+             coarser granularity are NaN between their snapshots
+    """
+    parts = []
+    runs = _runs(weather_year, granularity)
+    for _, row in runs.iterrows():
+        with xr.open_dataset(row["path"]) as ds:
+            array = ds[variable].sel(
+                {k: v for k, v in indexers.items() if k in ds[variable].dims}
+            )
+            if events_only:
+                flag = ds["high_price"].sel(
+                    {k: v for k, v in indexers.items() if k == "time"}
+                )
+                array = array.isel(time=np.flatnonzero(flag.values))
+            parts.append(array.load())
+    if not parts:
+        raise KeyError(f"No runs in {CUBE_ROOT} match the selection")
+
+    combined = xr.concat(
+        parts,
+        dim=pd.Index(runs.index, name="run"),
+        join="outer",
+        fill_value=np.nan,
+        combine_attrs="drop",
+    )
+    # Split the run dimension into its weather year and granularity
+    combined = combined.assign_coords(
+        weather_year=("run", runs["weather_year"].values),
+        granularity=("run", runs["granularity"].values),
+    )
+    return combined.set_index(run=["weather_year", "granularity"]).unstack("run")
+
+
+def event_summary(weather_year=None, granularity=None):
+    """
+    Mean price and mean carrier shares of generation during high-price hours,
+    against all hours, for every matching run. Only the flags, prices and
+    generation of the flagged snapshots are read.
+
+    :return: DataFrame indexed by (weather_year, granularity)
+    """
+    rows = {}
+    for _, row in _runs(weather_year, granularity).iterrows():
+        with xr.open_dataset(row["path"]) as ds:
+            events = np.flatnonzero(ds["high_price"].values)
+            price = ds["mean_hourly_price"]
+            generation = ds["generation_by_carrier"].isel(time=events).values
+            share = generation.sum(axis=0) / generation.sum()
+            rows[(row["weather_year"], row["granularity"])] = {
+                "Event Hours": len(events),
+                "Mean Price (USD)": float(price.mean()),
+                "Mean Event Price (USD)": float(price.isel(time=events).mean()),
+                **{
+                    f"{carrier} share": value
+                    for carrier, value in zip(ds["carrier"].values.astype(str), share)
+                },
+            }
+    summary = pd.DataFrame.from_dict(rows, orient="index")
+    summary.index.names = ["weather_year", "granularity"]
+    return summary.sort_index()
@@ -0,0 +1,159 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import datetime as dt
+import importlib
+import json
+import os
+from analysis_code import instrumentation
+from analysis_code import memo
+
+# Record of finished stages, so an interrupted sweep resumes where it stopped.
+# Delete the file to force a sweep to start from scratch. Memoized stages are
+# run again regardless, and their memo decides what actually needs redoing.
+MANIFEST = "TEMP_OUTPUTS/manifest.json"
+# Number of stages run at the same time, each in its own process
+MAX_WORKERS = 4
+
+
+def stage(run, name, function, *args, after=(), wait_for=(), memoized=False, **kwargs):
+    """
+    Describe one stage of one run for the scheduler.
+    :param run: run name, e.g. 'fully_renewable-WY1988_1H'
+    :param name: stage name within the run, e.g. 'analyse'
+    :param function: 'module:function' to call in the worker process; it is
+                     imported there, so the parent never loads heavy libraries
+    :param args: positional arguments for the function
+    :param kwargs: keyword arguments for the function
+    :param after: stages that must succeed before this one starts
+    :param wait_for: stages that must finish (successfully or not) first, used
+                     only for ordering, e.g. so downloads can reuse the ERA5 cache
+    :param memoized: the function memoizes its steps (see memo.cached), so the
+                     stage is run on every sweep instead of being skipped once
+                     the manifest records it as done; changed inputs, parameters
+                     or code are then picked up and unchanged steps are restored
+    :return: dict describing the stage
+    """
+    return {
+        "name": f"{run}/{name}",
+        "function": function,
+        "args": list(args),
+        "kwargs": kwargs,
+        "after": list(after),
+        "wait_for": list(wait_for),
+        "memoized": memoized,
+    }
+
+
+def run_stage(name, function, args, kwargs, profile=False, memo_budget_mb=None):
+    # Executed inside a worker process; the stage and the sub-steps measured
+    # inside it are recorded in the instrumentation log. Steps memoized inside
+    # the stage keep their stored outputs within memo_budget_mb.
+    module_name, function_name = function.split(":")
+    if memo_budget_mb is not None:
+        memo.BUDGET_MB = memo_budget_mb
+    with instrumentation.measure(name, profile=profile):
+        getattr(importlib.import_module(module_name), function_name)(*args, **kwargs)
+
+
+def load_manifest(path=MANIFEST):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path=MANIFEST):
+    # Replace the file atomically so an interruption never corrupts it
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def run(
+    stages,
+    manifest_path=MANIFEST,
+    max_workers=MAX_WORKERS,
+    profile=(),
+    memo_budget_mb=None,
+):
+    """
+    Run a DAG of stages in a process pool. Stages whose dependencies are met
+    run concurrently, so e.g. network analysis for one run overlaps with ERA5
+    downloads for another. A failing stage only skips the stages that depend on
+    it; stages recorded as done in the manifest are not run again, except
+    memoized ones.
+    :param stages: list of dicts built with stage()
+    :param profile: names of stages to run under cProfile, e.g.
+                    ['fully_renewable-WY2019_1H/process']
+    :param memo_budget_mb: disk budget of the stored outputs of memoized steps,
+                           default memo.BUDGET_MB
+    :return: dict of stage name -> 'done', 'skipped' or 'failed: <error>'
+    """
+    start = dt.datetime.now()
+    manifest = load_manifest(manifest_path)
+    pending = {
+        s["name"]: s
+        for s in stages
+        if s.get("memoized") or manifest.get(s["name"]) != "done"
+    }
+    status = {
+        name: "done"
+        for name, state in manifest.items()
+        if state == "done" and name not in pending
+    }
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            # Skip everything downstream of a failure, however deep the chain
+            skipped = True
+            while skipped:
+                skipped = [
+                    name
+                    for name, s in pending.items()
+                    if any(status.get(dep, "done") != "done" for dep in s["after"])
+                ]
+                for name in skipped:
+                    print(f"Skipping {name}: a stage it depends on did not succeed")
+                    status[name] = manifest[name] = "skipped"
+                    del pending[name]
+
+            # Submit every stage whose dependencies are all satisfied
+            for name, s in list(pending.items()):
+                if all(status.get(dep) == "done" for dep in s["after"]) and all(
+                    dep in status for dep in s["wait_for"]
+                ):
+                    future = pool.submit(
+                        run_stage,
+                        name,
+                        s["function"],
+                        s["args"],
+                        s["kwargs"],
+                        name in profile,
+                        memo_budget_mb,
+                    )
+                    running[future] = name
+                    del pending[name]
+
+            if not running:
+                # Remaining stages depend on stages that are not in this sweep
+                for name in pending:
+                    print(f"Cannot run {name}: unknown dependency")
+                    status[name] = manifest[name] = "skipped"
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    status[name] = manifest[name] = "done"
+                else:
+                    print(f"Stage {name} failed: {error!r}")
+                    status[name] = manifest[name] = f"failed: {error!r}"
+            save_manifest(manifest, manifest_path)
+
+    save_manifest(manifest, manifest_path)
+    # Time, memory and I/O of every stage and sub-step run in this sweep
+    instrumentation.summary(since=start)
+    return manifest
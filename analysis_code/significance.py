@@ -0,0 +1,265 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from analysis_code import climatology
+from analysis_code import era5_cache
+from analysis_code import era5_composite
+
+# Cubes of cached ERA5 fields used as the resampling pool, one per set of
+# cached hours: {CUBE_ROOT}/{area_key}/{hash of the hours}.npy. Safe to delete
+# at any time.
+CUBE_ROOT = "TEMP_OUTPUTS/significance_cubes"
+# Number of bootstrap draws, and number of draws evaluated per task
+DRAWS = 2000
+CHUNK_DRAWS = 250
+# Days of year either side of a high-price day whose cached hours are in the pool
+SEASON_DAYS = 30
+# Significance level of the stippled cells
+ALPHA = 0.05
+# Number of processes evaluating chunks of draws
+MAX_WORKERS = 4
+
+
+def season_dates(valid_times, area=climatology.AREA, season_days=SEASON_DAYS):
+    """
+    Cached days of the same year(s) within season_days days of year of any of
+    the given times; their hours form the resampling pool. The cache only
+    holds what runs have downloaded, so with mode='hour' these are mostly
+    high-price hours of other runs of the weather year, not a climatological
+    sample.
+    """
+    valid_times = pd.DatetimeIndex(valid_times)
+    composite_days = np.unique(valid_times.dayofyear)
+    dates = []
+    for YEAR in np.unique(valid_times.year):
+        for date in climatology.cached_dates(YEAR, area):
+            # Circular distance in days of year, so December neighbours January
+            distance = np.abs(pd.Timestamp(date).dayofyear - composite_days)
+            if np.minimum(distance, 365 - distance).min() <= season_days:
+                dates.append(date)
+    return dates
+
+
+def cached_hours(dates, area=climatology.AREA):
+    # 'YYYY-MM-DD HH:MM' of the hours held for every variable, as in open_day
+    hours = []
+    for date in dates:
+        times = set.intersection(
+            *(era5_cache.cached_times(date, v, area) for v in era5_cache.ERA5_VARIABLES)
+        )
+        hours += [f"{date} {time}" for time in sorted(times)]
+    return hours
+
+
+def _temporary(path):
+    # Unique temporary file next to path, so concurrent stages building the
+    # same cube never write to the same file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+
+def build_cube(dates, area=climatology.AREA):
+    """
+    Write the derived fields of all cached hours of the given days into one
+    float32 array on disk, so the bootstrap reads them with memory mapping.
+    The cube is keyed on the cached hours, so it is rebuilt once more hours
+    of the same days are cached.
+
+    :return: (path of the .npy cube of shape (fields, hours, cells),
+              valid times of the hours)
+    """
+    hours = cached_hours(dates, area)
+    digest = hashlib.sha1(",".join(hours).encode()).hexdigest()[:16]
+    path = f"{CUBE_ROOT}/{era5_cache.area_key(area)}/{digest}.npy"
+    times_path = path[: -len(".npy")] + "_times.npy"
+    if os.path.exists(path) and os.path.exists(times_path):
+        return path, np.load(times_path)
+
+    # Shape from the hours and the grid of one cache file; the days themselves
+    # are read one at a time below, so at most one day is held in memory
+    variable = next(iter(era5_cache.ERA5_VARIABLES))
+    with xr.open_dataset(era5_cache.cache_path(dates[0], variable, area)) as day:
+        n_cells = day["latitude"].size * day["longitude"].size
+    n_hours = len(hours)
+    fields = list(era5_composite.DERIVED_FIELDS)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cube_tmp = _temporary(path)
+    cube = np.lib.format.open_memmap(
+        cube_tmp,
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(fields), n_hours, n_cells),
+    )
+    times = []
+    row = 0
+    for date in dates:
+        day = climatology.open_day(date, area)
+        for block_times, blocks in era5_composite.iterate_blocks([day], fields):
+            for f, field in enumerate(fields):
+                cube[f, row : row + len(block_times)] = blocks[field].reshape(
+                    len(block_times), -1
+                )
+            times.append(block_times)
+            row += len(block_times)
+        day.close()
+    cube.flush()
+    del cube
+    # Rename only once complete, so an interrupted build is never reused
+    times_tmp = _temporary(times_path)
+    with open(times_tmp, "wb") as f:
+        np.save(f, np.concatenate(times))
+    os.replace(times_tmp, times_path)
+    os.replace(cube_tmp, path)
+    return path, np.concatenate(times)
+
+
+def draw_counts(rng, n_draws, pool_hours, composite_hours):
+    """
+    Random resamples of the pool that match the composite hour by hour of day,
+    as a (draws x pool) matrix of how often each pool hour is drawn. The mean
+    of every draw is then one matrix product with the cube. Pool hours of -1
+    are never drawn.
+    """
+    counts = np.zeros((n_draws, len(pool_hours)), dtype=np.float32)
+    rows = np.arange(n_draws)[:, None]
+    for hour, n in zip(*np.unique(composite_hours, return_counts=True)):
+        candidates = np.flatnonzero(pool_hours == hour)
+        picks = candidates[rng.integers(0, len(candidates), size=(n_draws, n))]
+        np.add.at(counts, (np.broadcast_to(rows, picks.shape), picks), 1)
+    return counts / len(composite_hours)
+
+
+def _bootstrap_chunk(
+    cube_path, fields, pool_hours, composite_hours, observed, null, seed, n
+):
+    # Executed inside a worker process: count, per field and cell, the draws
+    # whose mean departs from the null mean at least as much as the composite
+    cube = np.load(cube_path, mmap_mode="r")
+    weights = draw_counts(np.random.default_rng(seed), n, pool_hours, composite_hours)
+    exceed = np.zeros(observed.shape, dtype=np.int64)
+    for i, f in enumerate(fields):
+        means = weights @ cube[f]
+        exceed[i] = (np.abs(means - null[i]) >= np.abs(observed[i] - null[i])).sum(
+            axis=0
+        )
+    return exceed
+
+
+def bootstrap_pvalues(
+    composites,
+    valid_times,
+    area=climatology.AREA,
+    n_draws=DRAWS,
+    chunk_draws=CHUNK_DRAWS,
+    season_days=SEASON_DAYS,
+    seed=0,
+    max_workers=MAX_WORKERS,
+):
+    """
+    Two-sided bootstrap p-values of a composite against same-season weather.
+    Each draw resamples, with replacement, as many cached same-season hours as
+    the composite has at each hour of day. The composite's own hours are left
+    out of the pool, so it is not compared with itself; see season_dates for
+    what the remaining pool holds. Draws are evaluated in chunks, as
+    matrix products over the memory-mapped cube, spread over a process pool;
+    every chunk has its own child seed, so results do not depend on the
+    number of workers.
+
+    :param composites: dict of field -> 2D DataArray, e.g. from
+                       era5_composite.composite_means
+    :param valid_times: timestamps of the composite
+    :return: dict of field -> 2D DataArray of p-values
+    """
+    valid_times = pd.DatetimeIndex(valid_times)
+    dates = season_dates(valid_times, area, season_days)
+    if not dates:
+        raise FileNotFoundError(
+            f"No cached ERA5 days in the season of {valid_times[0]}"
+        )
+    cube_path, pool_times = build_cube(dates, area)
+    pool_hours = np.array(pd.DatetimeIndex(pool_times).hour)
+    pool_hours[np.isin(pool_times, valid_times.values)] = -1
+    composite_hours = valid_times.hour.values
+    missing = np.setdiff1d(composite_hours, pool_hours)
+    if len(missing):
+        raise FileNotFoundError(
+            f"No cached same-season ERA5 hours outside the composite at "
+            f"{', '.join(f'{h:02d}' for h in missing)} UTC"
+        )
+
+    # Position of each composite field in the cube
+    fields = [list(era5_composite.DERIVED_FIELDS).index(v) for v in composites]
+
+    # Expected mean of a draw: the pool mean at each hour of day, weighted as
+    # the hours of the composite
+    expected = np.zeros(len(pool_hours))
+    for hour, n in zip(*np.unique(composite_hours, return_counts=True)):
+        at_hour = pool_hours == hour
+        expected[at_hour] = n / at_hour.sum() / len(composite_hours)
+    cube = np.load(cube_path, mmap_mode="r")
+    null = np.stack([expected @ cube[f] for f in fields])
+    observed = np.stack([c.values.reshape(-1) for c in composites.values()])
+
+    sizes = [
+        min(chunk_draws, n_draws - start) for start in range(0, n_draws, chunk_draws)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [
+        (cube_path, fields, pool_hours, composite_hours, observed, null, s, n)
+        for s, n in zip(seeds, sizes)
+    ]
+    if max_workers == 1 or len(args) <= 1:
+        exceed = sum(_bootstrap_chunk(*a) for a in args)
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(args))) as pool:
+            exceed = sum(pool.map(_bootstrap_chunk, *zip(*args)))
+
+    pvalues = (exceed + 1) / (n_draws + 1)
+    return {
+        field: xr.DataArray(
+            pvalues[i].reshape(composite.shape),
+            coords=composite.coords,
+            dims=composite.dims,
+            name=field,
+        )
+        for i, (field, composite) in enumerate(composites.items())
+    }
+
+
+def stipple_mask(pvalues, alpha=ALPHA):
+    # Cells where the composite differs significantly from same-season weather
+    return pvalues < alpha
+
+
+def significance(FOLDER, suffix, alpha=ALPHA, n_draws=DRAWS):
+    """
+    Test the high-price composite of a run against the other same-season
+    hours in the ERA5 cache (see season_dates) and write the p-values and
+    stipple masks to TEMP_OUTPUTS/{FOLDER}/significance.nc.
+
+    :return: (composites, p-values), dicts of field -> 2D DataArray
+    """
+    extension1 = "data_stream-oper_stepType-instant.nc"
+    extension2 = "data_stream-oper_stepType-accum.nc"
+    composites = era5_composite.composite_means(FOLDER, extension1, extension2, suffix)
+    streams = era5_composite.open_streams(FOLDER, extension1, extension2, suffix)
+    valid_times = streams[0]["valid_time"].values
+    for ds in streams:
+        ds.close()
+
+    pvalues = bootstrap_pvalues(composites, valid_times, n_draws=n_draws)
+    output = xr.Dataset(
+        {
+            **{f"{v} p-value": p for v, p in pvalues.items()},
+            **{f"{v} significant": stipple_mask(p, alpha) for v, p in pvalues.items()},
+        },
+        attrs={"alpha": alpha, "draws": n_draws},
+    )
+    output.to_netcdf(f"TEMP_OUTPUTS/{FOLDER}/significance.nc")
+    return composites, pvalues
@@ -0,0 +1,326 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+from analysis_code import climatology
+from analysis_code import era5_cache
+from analysis_code import map_renderer
+
+# Number of EOFs kept, and of regimes the days are clustered into
+N_MODES = 10
+N_REGIMES = 6
+# Days read from the ERA5 cache and added to the EOFs at a time. Memory scales
+# with this chunk and the number of modes, not with the length of the record.
+CHUNK_DAYS = 64
+# Mini-batch k-means: days per batch, number of batches, and restarts
+BATCH_SIZE = 256
+N_BATCHES = 200
+N_INIT = 5
+# Seed of the randomized SVD and of k-means, so regimes are reproducible
+SEED = 0
+# Regimes of all cached days of the weather years:
+# {REGIME_ROOT}/{area_key}/{first year}-{last year}.nc
+REGIME_ROOT = "TEMP_OUTPUTS/weather_regimes"
+# Colour-scale limits of the regime maps (mean sea level pressure anomaly), hPa
+LIMITS = (-15, 15)
+CACHE_VARIABLE = "mean_sea_level_pressure"
+
+
+def regime_path(YEARS, area=climatology.AREA):
+    return f"{REGIME_ROOT}/{era5_cache.area_key(area)}/{min(YEARS)}-{max(YEARS)}.nc"
+
+
+def daily_fields(dates, area=climatology.AREA, chunk_days=CHUNK_DAYS):
+    """
+    Daily mean of the mean sea level pressure (hPa) of cached days, in chunks.
+
+    :return: generator of (dates, array of shape (days, latitude, longitude))
+    """
+    for start in range(0, len(dates), chunk_days):
+        chunk = dates[start : start + chunk_days]
+        fields = []
+        for date in chunk:
+            path = era5_cache.cache_path(date, CACHE_VARIABLE, area)
+            with xr.open_dataset(path) as day:
+                fields.append(day["msl"].mean("valid_time").values / 100)
+        yield chunk, np.stack(fields)
+
+
+def randomized_svd(matrix, rank, oversample=10, n_iter=4, seed=SEED):
+    """
+    Leading singular triplets of a matrix with the randomized range finder of
+    Halko et al. (2011): the matrix is only touched by a few products with a
+    thin random matrix, instead of a full SVD.
+
+    :return: (U, singular values, Vt), truncated to rank
+    """
+    rng = np.random.default_rng(seed)
+    size = min(rank + oversample, *matrix.shape)
+    basis = matrix @ rng.standard_normal((matrix.shape[1], size))
+    # Power iterations, re-orthonormalized, sharpen a slowly decaying spectrum
+    for _ in range(n_iter):
+        basis, _ = np.linalg.qr(basis)
+        basis, _ = np.linalg.qr(matrix.T @ basis)
+        basis = matrix @ basis
+    basis, _ = np.linalg.qr(basis)
+    u, s, vt = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+    return (basis @ u)[:, :rank], s[:rank], vt[:rank]
+
+
+def partial_fit(state, rows, n_modes=N_MODES):
+    """
+    Update the EOFs with a chunk of rows (incremental PCA). The previous
+    components scaled by their singular values stand in for all rows seen so
+    far, with one extra row correcting for the shift of the mean, so no
+    (time x grid) matrix is ever built.
+
+    :param state: dict from the previous call, or None for the first chunk
+    :param rows: array of shape (days, grid cells)
+    :return: dict with 'n', 'mean', 'm2' (sum of squared deviations per cell),
+             'singular_values' and 'components' (modes x grid cells)
+    """
+    n_new = len(rows)
+    mean_new = rows.mean(axis=0)
+    centred = rows - mean_new
+    m2_new = (centred**2).sum(axis=0)
+    if state is None:
+        n, mean, m2 = n_new, mean_new, m2_new
+        stacked = centred
+    else:
+        n = state["n"] + n_new
+        delta = mean_new - state["mean"]
+        mean = state["mean"] + delta * n_new / n
+        m2 = state["m2"] + m2_new + delta**2 * state["n"] * n_new / n
+        correction = np.sqrt(state["n"] * n_new / n) * delta
+        stacked = np.vstack(
+            [
+                state["singular_values"][:, None] * state["components"],
+                centred,
+                correction[None, :],
+            ]
+        )
+    _, s, vt = randomized_svd(stacked, n_modes)
+    return {"n": n, "mean": mean, "m2": m2, "singular_values": s, "components": vt}
+
+
+def fit_eofs(dates, weights, area=climatology.AREA, n_modes=N_MODES):
+    # EOFs of the latitude-weighted daily fields, streamed chunk by chunk
+    state = None
+    for _, fields in daily_fields(dates, area):
+        state = partial_fit(state, fields.reshape(len(fields), -1) * weights, n_modes)
+    return state
+
+
+def principal_components(dates, state, weights, area=climatology.AREA):
+    # Projection of every day onto the EOFs, chunk by chunk
+    pcs = []
+    for _, fields in daily_fields(dates, area):
+        rows = fields.reshape(len(fields), -1) * weights - state["mean"]
+        pcs.append(rows @ state["components"].T)
+    return np.concatenate(pcs)
+
+
+def _kmeans_plus_plus(points, n_clusters, rng):
+    # Spread initial centres: each next one drawn with probability ~ distance^2
+    centres = [points[rng.integers(len(points))]]
+    for _ in range(1, n_clusters):
+        distance = ((points[:, None] - np.array(centres)[None]) ** 2).sum(-1).min(1)
+        centres.append(points[rng.choice(len(points), p=distance / distance.sum())])
+    return np.array(centres)
+
+
+def assign(points, centres):
+    # Nearest centre of every point and its squared distance
+    distance = (
+        (points**2).sum(1)[:, None]
+        - 2 * points @ centres.T
+        + (centres**2).sum(1)[None, :]
+    )
+    labels = distance.argmin(axis=1)
+    return labels, distance[np.arange(len(points)), labels]
+
+
+def minibatch_kmeans(
+    points,
+    n_clusters=N_REGIMES,
+    batch_size=BATCH_SIZE,
+    n_batches=N_BATCHES,
+    n_init=N_INIT,
+    seed=SEED,
+):
+    """
+    Mini-batch k-means (Sculley, 2010): each centre moves towards the points
+    of random batches assigned to it, by the share of the points it has seen
+    that are in the batch, so the cost per batch does not grow with the
+    number of days. The best of n_init restarts (lowest within-cluster sum of
+    squares) is kept.
+
+    :param points: array of shape (days, modes)
+    :return: (centres, labels) with regimes numbered from most to least common
+    """
+    rng = np.random.default_rng(seed)
+    best = None
+    for _ in range(n_init):
+        centres = _kmeans_plus_plus(points, n_clusters, rng)
+        seen = np.zeros(n_clusters)
+        for _ in range(n_batches):
+            batch = points[rng.integers(len(points), size=batch_size)]
+            labels, _ = assign(batch, centres)
+            # All points of a batch at once: each centre becomes the mean of
+            # the points it has seen so far
+            counts = np.bincount(labels, minlength=n_clusters)
+            sums = np.zeros_like(centres)
+            np.add.at(sums, labels, batch)
+            moved = counts > 0
+            seen[moved] += counts[moved]
+            centres[moved] += (
+                sums[moved] - counts[moved, None] * centres[moved]
+            ) / seen[moved, None]
+        labels, distance = assign(points, centres)
+        if best is None or distance.sum() < best[0]:
+            best = (distance.sum(), centres, labels)
+
+    _, centres, labels = best
+    order = np.argsort(-np.bincount(labels, minlength=n_clusters), kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(n_clusters)
+    return centres[order], rank[labels]
+
+
+def fit_regimes(YEARS, area=climatology.AREA, n_modes=N_MODES, n_regimes=N_REGIMES):
+    """
+    Weather regimes of every day of the weather years held in the ERA5 cache:
+    EOFs of the daily mean sea level pressure, and mini-batch k-means of the
+    days' principal components. Written to regime_path(YEARS).
+
+    :return: Dataset with the EOFs, the principal components and regime of
+             every day, and the mean pressure anomaly map of each regime
+    """
+    dates = [date for YEAR in YEARS for date in climatology.cached_dates(YEAR, area)]
+    if len(dates) < n_regimes:
+        raise FileNotFoundError(f"Only {len(dates)} cached ERA5 days for {YEARS}")
+    with xr.open_dataset(era5_cache.cache_path(dates[0], CACHE_VARIABLE, area)) as day:
+        lat, lon = day["latitude"].values, day["longitude"].values
+    # sqrt(cos(latitude)) weights, so every cell counts by its area
+    weights = np.repeat(np.sqrt(np.cos(np.deg2rad(lat))), lon.size)
+
+    n_modes = min(n_modes, len(dates))
+    state = fit_eofs(dates, weights, area, n_modes)
+    pcs = principal_components(dates, state, weights, area)
+    centres, labels = minibatch_kmeans(pcs, n_regimes)
+
+    # Regime maps: the centre of each regime in EOF space, back on the grid
+    shape = (lat.size, lon.size)
+    anomalies = (centres @ state["components"]) / weights
+    ds = xr.Dataset(
+        {
+            "eof": (
+                ("mode", "latitude", "longitude"),
+                (state["components"] / weights).reshape(-1, *shape),
+            ),
+            "explained_variance_ratio": (
+                "mode",
+                state["singular_values"] ** 2 / state["m2"].sum(),
+            ),
+            "pc": (("date", "mode"), pcs),
+            "regime": ("date", labels),
+            "centre": (("regime_id", "mode"), centres),
+            "anomaly": (
+                ("regime_id", "latitude", "longitude"),
+                anomalies.reshape(-1, *shape),
+            ),
+            "mean": (
+                ("latitude", "longitude"),
+                (state["mean"] / weights).reshape(shape),
+            ),
+        },
+        coords={
+            "mode": np.arange(n_modes),
+            "regime_id": np.arange(n_regimes),
+            "date": pd.DatetimeIndex(dates),
+            "latitude": lat,
+            "longitude": lon,
+        },
+        attrs={"years": list(YEARS), "units": "hPa"},
+    )
+    path = regime_path(YEARS, area)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.to_netcdf(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return ds
+
+
+def high_price_dates(RUN_NAME, WEATHER_YEAR):
+    # Days of the run's high-price hours, on the weather year as downloaded
+    hours = pd.to_datetime(
+        pd.read_csv(f"TEMP_OUTPUTS/{RUN_NAME}/highest_hours.csv")["Time"]
+    )
+    hours = hours.map(lambda d: d.replace(year=WEATHER_YEAR))
+    return pd.DatetimeIndex(hours.dt.normalize().unique())
+
+
+def regime_frequencies(regimes, days, n_regimes=N_REGIMES):
+    """
+    How often each regime occurs on the given days and on all days.
+
+    :param regimes: Dataset from fit_regimes
+    :param days: dates, e.g. the high-price days of a run; days not in the
+                 cache are left out
+    :return: DataFrame with one row per regime
+    """
+    labels = regimes["regime"].to_series()
+    on_days = labels[labels.index.isin(days)]
+    all_counts = np.bincount(labels.values, minlength=n_regimes)
+    day_counts = np.bincount(on_days.values, minlength=n_regimes)
+    table = pd.DataFrame(
+        {
+            "Regime": np.arange(n_regimes),
+            "All Days": all_counts,
+            "All Days Share": all_counts / all_counts.sum(),
+            "High-Price Days": day_counts,
+            "High-Price Share": day_counts / max(day_counts.sum(), 1),
+        }
+    )
+    # Above 1: the regime is more common on high-price days than on others
+    table["Ratio"] = table["High-Price Share"] / table["All Days Share"]
+    return table
+
+
+def regime_analysis(runs, n_modes=N_MODES, n_regimes=N_REGIMES, plot=True):
+    """
+    Fit weather regimes to all cached days of the runs' weather years, and
+    write for every run how often each regime occurs on its high-price days
+    versus all days to TEMP_OUTPUTS/{RUN_NAME}/weather_regimes.csv. With plot,
+    the pressure anomaly map of each regime is drawn to Figures/weather_regimes.
+
+    :param runs: iterable of (RUN_NAME, WEATHER_YEAR) pairs
+    """
+    runs = list(runs)
+    YEARS = sorted({WEATHER_YEAR for _, WEATHER_YEAR in runs})
+    regimes = fit_regimes(YEARS, n_modes=n_modes, n_regimes=n_regimes)
+    ratio = regimes["explained_variance_ratio"].values.sum()
+    print(
+        f"{regimes.sizes['mode']} EOFs explain {ratio:.0%} of the daily pressure variance"
+    )
+
+    for RUN_NAME, WEATHER_YEAR in runs:
+        table = regime_frequencies(
+            regimes, high_price_dates(RUN_NAME, WEATHER_YEAR), n_regimes
+        )
+        table.to_csv(f"TEMP_OUTPUTS/{RUN_NAME}/weather_regimes.csv", index=False)
+
+    if plot:
+        os.makedirs("Figures/weather_regimes", exist_ok=True)
+        labels = regimes["regime"].values
+        jobs = [
+            (
+                regimes["anomaly"].sel(regime_id=r),
+                f"Regime {r} ({(labels == r).mean():.0%} of days)",
+                "hPa",
+                "RdBu_r",
+                LIMITS,
+                f"Figures/weather_regimes/Regime {r}.png",
+            )
+            for r in range(n_regimes)
+        ]
+        map_renderer.render_maps(jobs)
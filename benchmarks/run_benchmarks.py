@@ -0,0 +1,369 @@
+"""
+Time and memory-profile the pipeline stages on synthetic data, offline.
+
+    python benchmarks/run_benchmarks.py --scales small medium
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<old>.json
+
+Every case runs in a fresh process, so the peak RSS of one case is not
+inflated by another. Results are written as JSON, one file per run of the
+suite, so regressions between versions show up with --compare.
+"""
+
+import argparse
+import datetime as dt
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+# Found next to this script, which Python puts first on the path
+import synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+# Size of the synthetic inputs. era5_days is the number of high-price days
+# with ERA5 data, each at the four default times.
+SCALES = {
+    "small": {
+        "buses": 20,
+        "generators": 60,
+        "loads": 20,
+        "snapshots": 720,
+        "era5_days": 2,
+    },
+    "medium": {
+        "buses": 134,
+        "generators": 500,
+        "loads": 134,
+        "snapshots": 8760,
+        "era5_days": 10,
+    },
+    "large": {
+        "buses": 500,
+        "generators": 2000,
+        "loads": 500,
+        "snapshots": 8760,
+        "era5_days": 40,
+    },
+}
+# Weather year the synthetic runs are mapped onto
+YEAR = 2019
+# Ratio of wall times above which --compare flags a case as slower
+REGRESSION = 1.25
+
+EXTENSION1 = "data_stream-oper_stepType-instant.nc"
+EXTENSION2 = "data_stream-oper_stepType-accum.nc"
+
+
+def prepare(scale):
+    # Write the synthetic network and ERA5 files of a scale into the working
+    # directory, laid out as the pipeline expects them
+    import pandas as pd
+
+    size = SCALES[scale]
+    run = f"bench-{scale}"
+    if not os.path.exists(f"DATA/{run}.nc"):
+        synthetic.network(
+            f"DATA/{run}.nc",
+            size["buses"],
+            size["generators"],
+            size["loads"],
+            size["snapshots"],
+        )
+    os.makedirs(f"TEMP_OUTPUTS/{run}", exist_ok=True)
+    os.makedirs(f"Figures/{run}", exist_ok=True)
+    era5_directory = f"TEMP_OUTPUTS/{run}/era5_data_high-prices"
+    if not os.path.exists(f"{era5_directory}/{EXTENSION1}"):
+        days = pd.date_range(f"{YEAR}-01-01", periods=size["era5_days"], freq="7D")
+        synthetic.era5(
+            era5_directory,
+            [day + pd.Timedelta(hours=h) for day in days for h in [0, 6, 12, 18]],
+        )
+    return run
+
+
+def _network_data(run):
+    from analysis_code import read_electricity_network
+
+    return read_electricity_network.read_electricity_network(f"DATA/{run}.nc", "1H")
+
+
+def _high_price_dates(run, data):
+    from analysis_code import read_electricity_network
+
+    threshold, highest_hours = read_electricity_network.find_highest_price_hours(data)
+    dates = sorted({t.strftime("%Y-%m-%d") for t, _ in highest_hours})
+    return threshold, highest_hours, dates
+
+
+# Each case takes the run name, does its untimed setup and returns the
+# function to time
+def case_read_electricity_network(run):
+    from analysis_code import read_electricity_network
+
+    return lambda: read_electricity_network.read_electricity_network(
+        f"DATA/{run}.nc", "1H"
+    )
+
+
+def case_find_highest_price_hours(run):
+    from analysis_code import read_electricity_network
+
+    data = _network_data(run)
+    return lambda: read_electricity_network.find_highest_price_hours(data)
+
+
+def case_plot_hourly_price(run, mode="envelope"):
+    from analysis_code import read_electricity_network
+
+    data = _network_data(run)
+    threshold = _high_price_dates(run, data)[0]
+    return lambda: read_electricity_network.plot_hourly_price(
+        data, threshold, run, mode=mode
+    )
+
+
+def case_plot_hourly_price_lines(run):
+    return case_plot_hourly_price(run, mode="lines")
+
+
+def case_plot_generation(run):
+    from analysis_code import read_electricity_network
+
+    data = _network_data(run)
+    dates = _high_price_dates(run, data)[2]
+    return lambda: read_electricity_network.plot_generation(data, dates, run)
+
+
+def case_plot_demand(run):
+    from analysis_code import read_electricity_network
+
+    data = _network_data(run)
+    dates = _high_price_dates(run, data)[2]
+    return lambda: read_electricity_network.plot_demand(data, dates, run)
+
+
+def case_electricity_analysis(run):
+    from analysis_code import network_summary
+    from analysis_code import read_electricity_network
+
+    def analyse():
+        # Remove the summary so the network file is read every time
+        if os.path.exists(network_summary.summary_path(run)):
+            os.remove(network_summary.summary_path(run))
+        read_electricity_network.electricity_analysis(run, "1H")
+
+    return analyse
+
+
+def case_get_era5(run):
+    import pandas as pd
+    from analysis_code import download_era5_data
+    from analysis_code import era5_cache
+
+    data = _network_data(run)
+    highest_hours = _high_price_dates(run, data)[1]
+    pd.DataFrame(highest_hours, columns=["Time", "Mean Hourly Price (USD)"]).to_csv(
+        f"TEMP_OUTPUTS/{run}/highest_hours.csv", index=False
+    )
+
+    def download():
+        # Start from an empty cache so every repeat fetches all the days
+        shutil.rmtree(era5_cache.CACHE_ROOT, ignore_errors=True)
+        download_era5_data.get_era5(
+            run, YEAR, "era5_data_download", client=synthetic.FakeClient()
+        )
+
+    return download
+
+
+def case_load_data(run):
+    from analysis_code import process_era5_data
+
+    def load():
+        label_map, *_ = process_era5_data.load_data(
+            run, EXTENSION1, EXTENSION2, "era5_data_high-prices"
+        )
+        # load_data is lazy; the time-means force the reads and derivations
+        for field in label_map.values():
+            field.mean(dim="valid_time").load()
+
+    return load
+
+
+def case_composite_means(run):
+    from analysis_code import era5_composite
+
+    return lambda: era5_composite.composite_means(
+        run, EXTENSION1, EXTENSION2, "era5_data_high-prices"
+    )
+
+
+def case_plot_dataset(run):
+    from analysis_code import process_era5_data
+
+    label_map, unit_map, color_map, limit_map, *_ = process_era5_data.load_data(
+        run, EXTENSION1, EXTENSION2, "era5_data_high-prices"
+    )
+    variable = "2m Temperature"
+    field = label_map[variable].load()
+    return lambda: process_era5_data.plot_dataset(
+        variable, field, unit_map, color_map, limit_map, run
+    )
+
+
+CASES = {
+    name[len("case_") :]: function
+    for name, function in list(globals().items())
+    if name.startswith("case_")
+}
+
+
+def _run_case(name, scale, workdir, repeat, offline):
+    # Executed in a fresh process: set up the case, time it 'repeat' times,
+    # then run it once more under tracemalloc for its peak allocation
+    os.chdir(workdir)
+    if offline:
+        synthetic.offline_map_features()
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    function = CASES[name](f"bench-{scale}")
+    wall, cpu = [], []
+    for _ in range(repeat):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        function()
+        wall.append(time.perf_counter() - start_wall)
+        cpu.append(time.process_time() - start_cpu)
+
+    tracemalloc.start()
+    function()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "case": name,
+        "scale": scale,
+        "wall_s": min(wall),
+        "wall_all_s": wall,
+        "cpu_s": min(cpu),
+        "tracemalloc_peak_mb": traced_peak / 2**20,
+        # ru_maxrss is in kilobytes on Linux; it includes the case's setup
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    }
+
+
+def metadata():
+    import numpy
+    import pandas
+    import xarray
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "commit": commit,
+        "date": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "xarray": xarray.__version__,
+    }
+
+
+def compare(results, baseline_path):
+    # Print the wall-time ratio of every case against an earlier results file
+    with open(baseline_path) as f:
+        baseline = {(r["case"], r["scale"]): r for r in json.load(f)["results"]}
+    print(f"\n{'case':32} {'scale':8} {'before':>9} {'after':>9} {'ratio':>7}")
+    for result in results:
+        before = baseline.get((result["case"], result["scale"]))
+        if before is None:
+            continue
+        ratio = result["wall_s"] / before["wall_s"]
+        flag = "  slower" if ratio > REGRESSION else ""
+        print(
+            f"{result['case']:32} {result['scale']:8} {before['wall_s']:9.3f} "
+            f"{result['wall_s']:9.3f} {ratio:7.2f}{flag}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=SCALES)
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", help="folder for the synthetic data (kept)")
+    parser.add_argument("--output", help="results file (default benchmarks/results/)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument(
+        "--natural-earth",
+        action="store_true",
+        help="draw maps with the Natural Earth features (downloads them if needed)",
+    )
+    args = parser.parse_args()
+    # Paths given on the command line are relative to where the suite is started
+    output = args.output and os.path.abspath(args.output)
+    baseline = args.compare and os.path.abspath(args.compare)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="era5-benchmarks-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for scale in args.scales:
+        prepare(scale)
+        for name in args.cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(
+                    _run_case,
+                    name,
+                    scale,
+                    workdir,
+                    args.repeat,
+                    not args.natural_earth,
+                ).result()
+            results.append(result)
+            print(
+                f"{name:32} {scale:8} {result['wall_s']:9.3f} s "
+                f"{result['cpu_s']:9.3f} s cpu "
+                f"{result['tracemalloc_peak_mb']:9.1f} MB traced "
+                f"{result['peak_rss_mb']:9.1f} MB rss"
+            )
+
+    report = {"meta": metadata(), "scales": SCALES, "results": results}
+    if output is None:
+        stamp = dt.datetime.now().strftime("%Y%m%dT%H%M%S")
+        output = os.path.join(
+            REPO, "benchmarks", "results", f"{stamp}_{report['meta']['commit']}.json"
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+import threading
+import zipfile
+
+# ERA5 grid of the download area (0.25 degrees, North to South, West to East)
+LATITUDE = np.arange(49.5, 23.99, -0.25)
+LONGITUDE = np.arange(-125, -66.49, 0.25)
+# Carriers drawn for the synthetic generators; all have a colour in
+# read_electricity_network.color_map
+CARRIERS = [
+    "CCGT",
+    "OCGT",
+    "biomass",
+    "coal",
+    "geothermal",
+    "hydro",
+    "nuclear",
+    "offwind",
+    "onwind",
+    "solar",
+]
+
+
+def network(path, buses, generators, loads, snapshots, seed=0):
+    """
+    Write a pypsa-usa-shaped network NetCDF file with the variables read by
+    the analysis: buses_t_marginal_price, loads_t_p_set, generators_t_p,
+    generators_carrier and the bus coordinates buses_x/buses_y.
+    """
+    rng = np.random.default_rng(seed)
+    time = pd.date_range("2050-01-01", periods=snapshots, freq="h")
+    bus_ids = [f"bus{i}" for i in range(buses)]
+    generator_ids = [f"gen{i}" for i in range(generators)]
+
+    # Log-normal prices with rare system-wide spikes lasting a few hours
+    prices = rng.lognormal(3, 0.5, (snapshots, buses))
+    spikes = rng.random(snapshots) < 0.01
+    spikes |= np.roll(spikes, 1) | np.roll(spikes, 2)
+    prices[spikes] *= rng.uniform(5, 50, (spikes.sum(), 1))
+
+    ds = xr.Dataset(
+        {
+            "buses_t_marginal_price": (
+                ("snapshots", "buses_t_marginal_price_i"),
+                prices,
+            ),
+            "loads_t_p_set": (
+                ("snapshots", "loads_t_p_set_i"),
+                rng.uniform(100, 1000, (snapshots, loads)),
+            ),
+            "generators_t_p": (
+                ("snapshots", "generators_t_p_i"),
+                rng.uniform(0, 500, (snapshots, generators)),
+            ),
+            # pypsa-usa lists the carrier of every generator, including those
+            # without a time series; the extra ones check the alignment by id
+            "generators_carrier": (
+                "generators_i",
+                rng.choice(CARRIERS, generators + 10),
+            ),
+            "buses_x": ("buses_i", rng.uniform(-124, -67, buses)),
+            "buses_y": ("buses_i", rng.uniform(25, 49, buses)),
+        },
+        coords={
+            "snapshots": time,
+            "buses_t_marginal_price_i": bus_ids,
+            "loads_t_p_set_i": [f"load{i}" for i in range(loads)],
+            # Reversed, so the generator columns are not in the order of generators_i
+            "generators_t_p_i": generator_ids[::-1],
+            "generators_i": generator_ids + [f"extra{i}" for i in range(10)],
+            "buses_i": bus_ids,
+        },
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    ds.to_netcdf(path)
+
+
+def era5(directory, valid_times, seed=0):
+    """
+    Write ERA5-shaped instant (t2m, msl, u100, v100) and accumulated (ssrd)
+    stream files, as extracted from a CDS download, for the given times.
+    """
+    rng = np.random.default_rng(seed)
+    valid_times = pd.DatetimeIndex(valid_times)
+    shape = (len(valid_times), len(LATITUDE), len(LONGITUDE))
+    coords = {"valid_time": valid_times, "latitude": LATITUDE, "longitude": LONGITUDE}
+    dims = ("valid_time", "latitude", "longitude")
+
+    def field(low, high):
+        return (dims, rng.uniform(low, high, shape).astype(np.float32))
+
+    instant = xr.Dataset(
+        {
+            "t2m": field(250, 310),
+            "msl": field(98000, 104000),
+            "u100": field(-15, 15),
+            "v100": field(-15, 15),
+        },
+        coords=coords,
+    ).assign_coords(number=0, expver=("valid_time", ["0001"] * len(valid_times)))
+    accum = xr.Dataset({"ssrd": field(0, 3e6)}, coords=coords).assign_coords(number=0)
+
+    os.makedirs(directory, exist_ok=True)
+    instant.to_netcdf(f"{directory}/data_stream-oper_stepType-instant.nc")
+    accum.to_netcdf(f"{directory}/data_stream-oper_stepType-accum.nc")
+
+
+class FakeClient:
+    """
+    Offline stand-in for cdsapi.Client: retrieve() writes a ZIP archive of
+    synthetic ERA5 stream files covering the requested dates and times.
+    """
+
+    # The HDF5 library is not thread-safe, so files are written one at a time
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.calls = 0
+
+    def retrieve(self, dataset, request, target):
+        self.calls += 1
+        if "date" in request:
+            dates = request["date"]
+        else:
+            dates = [f"{y}-{m}-01" for y in request["year"] for m in request["month"]]
+        times = pd.DatetimeIndex([f"{d} {t}" for d in dates for t in request["time"]])
+        with tempfile.TemporaryDirectory() as directory:
+            with self._lock:
+                era5(directory, times, seed=self.calls)
+            with zipfile.ZipFile(target, "w") as archive:
+                for name in os.listdir(directory):
+                    archive.write(f"{directory}/{name}", name)
+
+
+def offline_map_features(n_lines=400, seed=0):
+    """
+    Replace the Natural Earth coastlines, borders and states used by
+    map_renderer with random lines of similar complexity, so maps can be drawn
+    without downloading the Natural Earth data.
+    """
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    from cartopy.mpl.geoaxes import GeoAxes
+    from shapely.geometry import LineString
+
+    rng = np.random.default_rng(seed)
+    lines = []
+    for _ in range(n_lines):
+        start = rng.uniform([-125, 24], [-66.5, 49.5])
+        steps = rng.normal(0, 0.05, (200, 2)).cumsum(axis=0)
+        lines.append(LineString(start + steps))
+    feature = cfeature.ShapelyFeature(lines, ccrs.PlateCarree())
+    cfeature.COASTLINE = cfeature.BORDERS = cfeature.STATES = feature
+    # ax.coastlines() reads Natural Earth itself, so it is replaced as well
+    GeoAxes.coastlines = lambda ax, *args, **kwargs: ax.add_feature(
+        feature, facecolor="none", edgecolor="black"
+    )
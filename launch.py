@@ -0,0 +1,197 @@
+"""
+Command line entry point for the analysis, driven by config.toml.
+
+    python launch.py analyse --weather-year 2019 --granularity 1H
+    python launch.py download --weather-year 2019
+    python launch.py process
+    python launch.py baseline --weather-year 1988 2019
+    python launch.py sweep --stages analyse download process
+    python launch.py statistics
+    python launch.py residual --weather-year 2019
+    python launch.py regimes
+
+analyse, download and process run one stage for each selected run, one run
+after another, in this process. sweep runs the configured stages of all
+selected runs through the scheduler and resumes from its manifest; baseline
+plots the climatology of each selected weather year. statistics parses the
+pypsa-usa statistics CSVs of all runs into binary tables, and residual
+computes the residual load, ramps, duration curves and renewable droughts of
+all selected runs together. regimes clusters the cached days of the selected
+weather years into weather regimes and counts them on each run's high-price
+days.
+
+Only the argument parsing, the config and the scheduler are imported at
+startup; xarray, matplotlib, cartopy and cdsapi are imported by the stages
+that use them, so e.g. --help or a dry run starts in well under a second.
+"""
+
+import argparse
+from analysis_code import config as settings
+from analysis_code import run_scheduler
+
+# Stage run by each single-stage subcommand
+COMMANDS = {
+    "analyse": "analyse",
+    "download": "download",
+    "process": "process",
+}
+
+
+def run_stages(stages, dry_run=False, memo_budget_mb=None, runs=()):
+    # Run stages one after another in this process; each imports its module
+    # only when it starts and is recorded in the instrumentation log. The
+    # output folders of the runs are only made when the stages really run.
+    if not dry_run:
+        settings.make_folders(runs)
+    for s in stages:
+        print(f"{s['name']}: {s['function']}")
+        if not dry_run:
+            run_scheduler.run_stage(
+                s["name"],
+                s["function"],
+                s["args"],
+                s["kwargs"],
+                memo_budget_mb=memo_budget_mb,
+            )
+
+
+def single_stage(args, config):
+    runs = settings.runs(config, args.weather_year, args.granularity)
+    stages = settings.analysis_stages(config, runs, [COMMANDS[args.command]])
+    run_stages(stages, args.dry_run, config["memo"]["budget_mb"], runs)
+
+
+def baseline(args, config):
+    run_stages(
+        settings.baseline_stages(config, args.weather_year),
+        args.dry_run,
+        config["memo"]["budget_mb"],
+        settings.baseline_runs(config, args.weather_year),
+    )
+
+
+def sweep(args, config):
+    runs = settings.runs(config, args.weather_year, args.granularity)
+    stages = settings.analysis_stages(config, runs, args.stages)
+    if args.dry_run:
+        for s in stages:
+            print(f"{s['name']}: {s['function']} after {s['after']}")
+        return
+    settings.make_folders(runs)
+    run_scheduler.run(
+        stages,
+        manifest_path=config["sweep"]["manifest"],
+        max_workers=args.max_workers or config["sweep"]["max_workers"],
+        profile=config["sweep"]["profile"],
+        memo_budget_mb=config["memo"]["budget_mb"],
+    )
+
+
+def statistics(args, config):
+    # Parse the pypsa-usa statistics CSVs of all runs, skipping unchanged runs
+    stage = run_scheduler.stage(
+        "pypsa-usa", "statistics", "analysis_code.pypsa_statistics:ingest"
+    )
+    run_stages([stage], args.dry_run)
+
+
+def residual(args, config):
+    # Residual-load analytics of all selected runs in one pass
+    runs = settings.runs(config, args.weather_year, args.granularity)
+    stage = run_scheduler.stage(
+        "all-runs",
+        "residual",
+        "analysis_code.residual_load:residual_load_analysis",
+        [(run["name"], run["granularity"]) for run in runs],
+        classes=config.get("carrier_classes"),
+    )
+    run_stages([stage], args.dry_run)
+
+
+def regimes(args, config):
+    # Weather regimes of the selected weather years, shared by all their runs
+    runs = settings.runs(config, args.weather_year, args.granularity)
+    stage = run_scheduler.stage(
+        "all-runs",
+        "regimes",
+        "analysis_code.weather_regimes:regime_analysis",
+        [(run["name"], run["weather_year"]) for run in runs],
+        **config["regimes"],
+    )
+    run_stages([stage], args.dry_run)
+
+
+def parser():
+    base = argparse.ArgumentParser(add_help=False)
+    base.add_argument(
+        "--config", default=settings.CONFIG, help="settings file (config.toml)"
+    )
+    base.add_argument(
+        "--dry-run", action="store_true", help="list the stages without running them"
+    )
+    common = argparse.ArgumentParser(add_help=False, parents=[base])
+    common.add_argument(
+        "--weather-year",
+        type=int,
+        nargs="+",
+        help="configured weather years to run (default all)",
+    )
+    runs = argparse.ArgumentParser(add_help=False, parents=[common])
+    runs.add_argument(
+        "--granularity", nargs="+", help="configured granularities to run (default all)"
+    )
+
+    cli = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = cli.add_subparsers(dest="command", required=True)
+    descriptions = {
+        "analyse": "find the high-price hours of each run and plot the network",
+        "download": "fetch the ERA5 data of the high-price hours of each run",
+        "process": "plot the ERA5 composites of each run",
+    }
+    for command, description in descriptions.items():
+        commands.add_parser(command, parents=[runs], help=description).set_defaults(
+            handler=single_stage
+        )
+    commands.add_parser(
+        "baseline",
+        parents=[common],
+        help="plot the climatology of each weather year from the ERA5 cache",
+    ).set_defaults(handler=baseline)
+    commands.add_parser(
+        "statistics",
+        parents=[base],
+        help="parse the pypsa-usa statistics CSVs of all runs into binary tables",
+    ).set_defaults(handler=statistics)
+    commands.add_parser(
+        "residual",
+        parents=[runs],
+        help="residual load, ramps, duration curves and droughts of all runs",
+    ).set_defaults(handler=residual)
+    commands.add_parser(
+        "regimes",
+        parents=[runs],
+        help="weather regimes of the cached days and their share of high-price days",
+    ).set_defaults(handler=regimes)
+    sweep_parser = commands.add_parser(
+        "sweep", parents=[runs], help="run the configured stages of all runs"
+    )
+    sweep_parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=settings.STAGES,
+        help="stages to run (default the [sweep] stages of the config)",
+    )
+    sweep_parser.add_argument(
+        "--max-workers", type=int, help="stages run at the same time"
+    )
+    sweep_parser.set_defaults(handler=sweep)
+    return cli
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    args.handler(args, settings.load(args.config))
+
+
+if __name__ == "__main__":
+    main()
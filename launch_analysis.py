@@ -1,17 +1,23 @@
-from analysis_code.read_electricity_network import electricity_analysis
-from analysis_code.download_era5_data import get_era5
-from analysis_code.process_era5_data import era5_processing
-import os
+from analysis_code import config
+from analysis_code import run_scheduler
 
-for WEATHER_YEAR in [1988, 1998, 2019, 2021]:
-    for GRANULARITY in ["1H", "2H", "3H", "4H", "6H"]:
-        # Change these lines as needed for different electricity market runs
-        RUN_NAME = f"fully_renewable-WY{WEATHER_YEAR}_{GRANULARITY}"
+# Each run goes through network analysis, per-bus and regional price-spike
+# detection, ERA5 download, ERA5 processing, ERA5 anomalies against the
+# climatology of the weather year, per-bus weather series and a significance
+# test of the ERA5 composite, and is then added to the cross-run cube. The
+# runs, high-price rule and stages are set in config.toml. The scheduler runs
+# independent stages of different runs in parallel and records finished stages
+# in TEMP_OUTPUTS/manifest.json, so an interrupted sweep picks up where it
+# stopped. Equivalent to 'python launch.py sweep'.
+settings = config.load()
+stages = config.analysis_stages(settings, config.runs(settings))
 
-        os.makedirs(f"TEMP_OUTPUTS/{RUN_NAME}", exist_ok=True)
-        os.makedirs(f"Figures/{RUN_NAME}", exist_ok=True)
-
-        # Performs full analysis
-        electricity_analysis(RUN_NAME, GRANULARITY)
-        get_era5(RUN_NAME, WEATHER_YEAR, "era5_data_high-prices")
-        era5_processing(RUN_NAME, "era5_data_high-prices")
+if __name__ == "__main__":
+    config.make_folders(config.runs(settings))
+    run_scheduler.run(
+        stages,
+        manifest_path=settings["sweep"]["manifest"],
+        max_workers=settings["sweep"]["max_workers"],
+        profile=settings["sweep"]["profile"],
+        memo_budget_mb=settings["memo"]["budget_mb"],
+    )
@@ -1,15 +1,12 @@
-from analysis_code.download_era5_yearly import get_era5
-from analysis_code.process_era5_data import era5_processing_yearly
-import os
+from analysis_code import config
+from analysis_code import run_scheduler
 
-for WEATHER_YEAR in [1988, 1998, 2019, 2021]:
-    # Change these lines as needed for different electricity market runs
-    RUN_NAME = f"average-WY{WEATHER_YEAR}"
+# Plots the climatology of each weather year in config.toml from the ERA5 hours
+# held in the local cache, so no separate monthly-means download is needed.
+# Equivalent to 'python launch.py baseline'.
+settings = config.load()
+stages = config.baseline_stages(settings)
 
-    os.makedirs(f"TEMP_OUTPUTS/{RUN_NAME}", exist_ok=True)
-    os.makedirs(f"Figures/{RUN_NAME}", exist_ok=True)
-
-    # Performs full analysis
-    suffix = "era5_data_yearly_average"
-    get_era5(RUN_NAME, WEATHER_YEAR, suffix)
-    era5_processing_yearly(RUN_NAME, suffix)
+if __name__ == "__main__":
+    config.make_folders(config.baseline_runs(settings))
+    run_scheduler.run(stages)
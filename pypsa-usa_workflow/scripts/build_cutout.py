@@ -16,6 +16,7 @@ For this rule to work you must have
 
     atlite:
         nprocesses:
+        show_progress:
         cutouts:
             {cutout}:
 
@@ -79,22 +80,163 @@ Using the ERA5 cutout, the following parameters are accessible:
                                                  (Jm**-2). Takes values between 0 and 1.
     ===================  ==========  ==========  =========================================================
 
+The cutout is built from one part per feature and month, written to
+``cutouts/{cutout}_parts/`` and prepared concurrently by ``atlite: nprocesses``
+worker processes. Parts already prepared by an earlier, interrupted job are
+not fetched again. The state of every part is recorded in
+``cutouts/{cutout}.progress.json``. Once all parts are prepared they are
+merged into the cutout and deleted. The existing cutout itself is not
+checked for features or months: the workflow forces this rule with
+``-R build_cutout`` and Snakemake deletes the output before the job starts,
+so only the parts directory survives between jobs.
+
 The **USA Interconnect** weather data is shown below:
 
     .. image:: _static/cutouts/weather.png
         :scale: 80 %
 """
 
+import json
 import logging
+import shutil
+import time as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
 import atlite
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import xarray as xr
 from _helpers import configure_logging
 from pandas import Timestamp
 
 logger = logging.getLogger(__name__)
 
+# Features prepared when the cutout configuration does not list any
+DEFAULT_FEATURES = [
+    "influx",  # solar
+    "runoff",  # hydro
+    "wind",  # wind
+    "temperature",  # ERA5 variable "t2m"
+]
+
+
+def prepared_features(path):
+    """
+    Features held by a cutout file, an empty set if the file does not exist.
+    """
+    if not Path(path).exists():
+        return set()
+    with xr.open_dataset(path) as ds:
+        return {str(f) for f in np.atleast_1d(ds.attrs.get("prepared_features", []))}
+
+
+def month_slices(time):
+    """
+    Split a time slice into calendar months.
+    """
+    start, end = Timestamp(time.start), Timestamp(time.stop)
+    months = pd.date_range(start.to_period("M").start_time, end, freq="MS")
+    return [
+        (
+            f"{month:%Y-%m}",
+            slice(
+                max(month, start),
+                min(month + pd.offsets.MonthEnd(0) + pd.Timedelta("23h"), end),
+            ),
+        )
+        for month in months
+    ]
+
+
+def prepare_part(path, feature, params, show_progress=False):
+    """
+    Prepare one feature of one month as its own cutout. atlite writes the file
+    only once the data is complete, so an existing part file is a finished
+    part.
+    """
+    start = timer.perf_counter()
+    cutout = atlite.Cutout(path, **params)
+    cutout.prepare(
+        features=[feature],
+        monthly_requests=False,
+        concurrent_requests=False,
+        show_progress=show_progress,
+    )
+    return timer.perf_counter() - start
+
+
+def write_progress(path, progress):
+    # Replace the record atomically, so an interrupted job never leaves it corrupt
+    tmp = Path(f"{path}.tmp")
+    tmp.write_text(json.dumps(progress, indent=2, sort_keys=True))
+    tmp.replace(path)
+
+
+def prepare_parts(parts, nprocesses, progress, progress_path, show_progress=False):
+    """
+    Prepare the missing parts in a pool of ``nprocesses`` worker processes.
+    A failing part does not stop the others; the failures are raised once all
+    parts have been tried, and the prepared parts are kept for the next run.
+    """
+    failed = []
+    with ProcessPoolExecutor(max_workers=nprocesses) as pool:
+        futures = {
+            pool.submit(prepare_part, path, feature, params, show_progress): name
+            for name, (path, feature, params) in parts.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as error:
+                logger.exception(f"Preparing cutout part {name} failed")
+                progress["parts"][name] = {"status": f"failed: {error!r}"}
+                failed.append(name)
+            else:
+                logger.info(f"Prepared cutout part {name} in {seconds:.0f} s")
+                progress["parts"][name] = {
+                    "status": "done",
+                    "seconds": round(seconds, 1),
+                }
+            write_progress(progress_path, progress)
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} cutout parts failed ({', '.join(sorted(failed))}); "
+            "rerun the rule to prepare only those"
+        )
+
+
+def merge_parts(output, part_paths, features):
+    """
+    Merge the monthly parts of every feature along time and write the cutout
+    atomically.
+    """
+    datasets = []
+    for paths in part_paths.values():
+        months = [xr.open_dataset(path, chunks={}) for path in paths]
+        # Variables without a time dimension (e.g. height) are taken once
+        datasets.append(
+            xr.concat(
+                months,
+                dim="time",
+                data_vars="minimal",
+                coords="minimal",
+                compat="override",
+            )
+        )
+    merged = xr.merge(datasets, compat="override", combine_attrs="override")
+    merged.attrs["prepared_features"] = sorted(features)
+
+    tmp = Path(output).with_suffix(".tmp.nc")
+    encoding = {name: {"zlib": True} for name in merged.data_vars}
+    merged.to_netcdf(tmp, encoding=encoding)
+    for ds in datasets:
+        ds.close()
+    tmp.replace(output)
+
+
 if __name__ == "__main__":
     if "snakemake" not in globals():
         from _helpers import mock_snakemake
@@ -139,25 +281,44 @@ if __name__ == "__main__":
     cutout_params.update(interconnect_params)
 
     logging.info(f"Preparing cutout with parameters {cutout_params}.")
-    features = cutout_params.pop("features", None)
-    # Create empty cutout
-    cutout = atlite.Cutout(snakemake.output[0], **cutout_params)
-
-    # Features you want to download one-by-one
-    feature_sets = [
-        ["influx"],  # solar
-        ["runoff"],  # hydro
-        ["wind"],  # wind
-        ["temperature"],  # ERA5 variable "t2m"
-    ]
+    features = cutout_params.pop("features", None) or DEFAULT_FEATURES
+    features = list(np.atleast_1d(features))
+    atlite_config = snakemake.config.get("atlite", {})
+    nprocesses = atlite_config.get("nprocesses") or 4
+    show_progress = atlite_config.get("show_progress", False)
 
-    # Download each group separately (Atlite merges them automatically)
-    for fs in feature_sets:
-        logging.info(f"Preparing cutout features: {fs}")
-        cutout.prepare(
-            features=fs,
-            monthly_requests=True,
-            concurrent_requests=True,
-        )
+    output = Path(snakemake.output[0])
+    parts_dir = output.parent / f"{output.stem}_parts"
+    progress_path = output.with_suffix(".progress.json")
+
+    # One part per feature and month; parts finished by an earlier job are reused
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    parts = {}
+    part_paths = {feature: [] for feature in features}
+    progress = {"cutout": str(output), "features": features, "parts": {}}
+    for feature in features:
+        for month, month_time in month_slices(cutout_params["time"]):
+            name = f"{feature}_{month}"
+            path = parts_dir / f"{name}.nc"
+            part_paths[feature].append(path)
+            if feature in prepared_features(path):
+                progress["parts"][name] = {"status": "done"}
+                continue
+            progress["parts"][name] = {"status": "pending"}
+            parts[name] = (path, feature, {**cutout_params, "time": month_time})
+    write_progress(progress_path, progress)
+    logging.info(
+        f"Preparing {len(parts)} of {len(progress['parts'])} cutout parts "
+        f"with {nprocesses} processes."
+    )
+
+    if parts:
+        prepare_parts(parts, nprocesses, progress, progress_path, show_progress)
+
+    logging.info(f"Merging cutout parts into {output}.")
+    merge_parts(output, part_paths, features)
+    progress["merged"] = True
+    write_progress(progress_path, progress)
+    shutil.rmtree(parts_dir)
 
     logging.info("All features downloaded and merged into cutout.")